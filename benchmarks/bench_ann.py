@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""Recall@k and queries per second of IVFIndex against exact FaceGallery.
+
+    python benchmarks/bench_ann.py --size 1000000 --nprobe 8 16 32
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.ann import IVFIndex
+from utils.gallery import FaceGallery
+
+
+def synthetic_embeddings(size, dim, clusters=4096, noise=0.5, seed=0):
+    """Clustered unit vectors, closer to real face embeddings than uniform."""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    data = np.empty((size, dim), np.float32)
+    step = 65536
+    for start in range(0, size, step):
+        n = min(step, size - start)
+        data[start:start + n] = centers[rng.integers(0, clusters, n)]
+        data[start:start + n] += noise * rng.standard_normal(
+            (n, dim)).astype(np.float32)
+    return data
+
+
+def timed_search(index, probes, k, batch, **kwargs):
+    results = []
+    t0 = time.perf_counter()
+    for start in range(0, len(probes), batch):
+        results.extend(index.search_batch(probes[start:start + batch], k,
+                                          **kwargs))
+    return results, len(probes) / (time.perf_counter() - t0)
+
+
+def recall(exact, approx):
+    hits = total = 0
+    for e, a in zip(exact, approx):
+        truth = set(pid for pid, _ in e)
+        hits += len(truth.intersection(pid for pid, _ in a))
+        total += len(truth)
+    return hits / float(total or 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size', type=int, default=200000)
+    parser.add_argument('--dim', type=int, default=128)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--batch', type=int, default=1,
+                        help='probes per search_batch call')
+    parser.add_argument('--nlist', type=int, default=1024)
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[4, 16, 64])
+    parser.add_argument('--json', action='store_true',
+                        help='print one JSON object per result')
+    args = parser.parse_args()
+
+    data = synthetic_embeddings(args.size, args.dim)
+    rng = np.random.default_rng(1)
+    picks = rng.choice(args.size, args.queries, replace=False)
+    probes = data[picks] + 0.1 * rng.standard_normal(
+        (args.queries, args.dim)).astype(np.float32)
+
+    gallery = FaceGallery(args.dim, capacity=args.size)
+    gallery.enroll_batch(range(args.size), data)
+    exact, exact_qps = timed_search(gallery, probes, args.k, args.batch)
+    rows = [{'index': 'exact', 'size': args.size, 'qps': exact_qps,
+             'recall': 1.0}]
+
+    t0 = time.perf_counter()
+    ivf = IVFIndex.from_gallery(gallery, nlist=args.nlist)
+    build = time.perf_counter() - t0
+    for nprobe in args.nprobe:
+        approx, qps = timed_search(ivf, probes, args.k, args.batch,
+                                   nprobe=nprobe)
+        rows.append({'index': 'ivf', 'size': args.size, 'nlist': ivf.nlist,
+                     'nprobe': nprobe, 'qps': qps, 'build_s': build,
+                     'recall': recall(exact, approx)})
+
+    for row in rows:
+        if args.json:
+            print(json.dumps(row))
+        else:
+            print('{:6s} nprobe={:>5} recall@{}={:.3f} qps={:10.1f}'.format(
+                row['index'], row.get('nprobe', '-'), args.k,
+                row['recall'], row['qps']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""Headless benchmarks of the frame conversion and render hot paths.
+
+    python benchmarks/bench_render.py --output new.json
+    python benchmarks/bench_render.py --compare old.json --threshold 0.1
+
+Runs under QT_QPA_PLATFORM=offscreen with synthetic frames. Every case
+reports median / p95 time per call and, from tracemalloc, the peak bytes
+allocated inside one call and the number of memory blocks a call leaves
+allocated, its result included. With --compare the run fails (exit status 1)
+when a case's median is more than --threshold slower than the baseline.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import numpy as np
+from PyQt5.QtCore import QSize
+from PyQt5.QtGui import QImage, QPixmap
+from PyQt5.QtWidgets import QApplication
+
+RESOLUTIONS = {'720p': (1280, 720), '1080p': (1920, 1080),
+               '4k': (3840, 2160)}
+WINDOWS = [(800, 600), (1280, 720), (1920, 1080)]
+
+
+def synthetic_frame(width, height, channels=3, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 256, (height, width, channels), np.uint8)
+
+
+def allocations():
+    """tracemalloc snapshot without tracemalloc's own blocks."""
+    return tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(False, tracemalloc.__file__)])
+
+
+def measure(fn, iterations, warmup=3):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    # allocations are measured in a separate pass, tracing slows calls
+    tracemalloc.start()
+    peaks, blocks = [], []
+    try:
+        for _ in range(min(iterations, 5)):
+            before = allocations()
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            out = fn()
+            peaks.append(tracemalloc.get_traced_memory()[1] - base)
+            blocks.append(sum(max(0, stat.count_diff) for stat in
+                              allocations().compare_to(before, 'lineno')))
+            del out
+    finally:
+        tracemalloc.stop()
+    times = np.array(times) * 1000
+    return {'median_ms': float(np.median(times)),
+            'p95_ms': float(np.percentile(times, 95)),
+            'peak_alloc_bytes': int(max(peaks)),
+            'alloc_blocks': int(np.median(blocks)), 'iterations': iterations}
+
+
+def conversion_cases(res_names):
+    from utils.utils import (np2qimage, qimage2np, qimage_view,
+                             FrameConverter)
+    import utils.utils as uu
+    for name in res_names:
+        w, h = RESOLUTIONS[name]
+        frame = synthetic_frame(w, h)
+        bgra = synthetic_frame(w, h, 4)
+        yield 'np2qimage/bgr/' + name, lambda: np2qimage(frame, mode='bgr')
+        yield 'np2qimage/bgra/' + name, lambda: np2qimage(bgra, mode='bgr')
+        # the swap path taken on Qt < 5.14
+        converter = FrameConverter(mode='bgr')
+        has_bgr888 = uu.HAS_BGR888
+        uu.HAS_BGR888 = False
+        try:
+            yield 'frameconverter/swap/' + name, lambda: converter(frame)
+            yield 'np2qimage/swap-alloc/' + name, lambda: np2qimage(
+                frame, mode='bgr')
+        finally:
+            uu.HAS_BGR888 = has_bgr888
+        qimg = QImage(np2qimage(frame, mode='bgr').convertToFormat(
+            QImage.Format_RGB888))
+        yield 'qimage2np/' + name, lambda: qimage2np(qimg)
+        out = np.empty_like(frame)
+        yield 'qimage2np/out/' + name, lambda: qimage2np(qimg, out=out)
+        yield 'qimage_view/' + name, lambda: qimage_view(qimg)
+
+
+def paint_cases(res_names):
+    from widget import MainWindow
+    window = MainWindow(detector='none', visit_log='', autostart=False,
+                        streams=[{'source': 'synthetic', 'width': 1280,
+                                  'height': 720, 'detect': False}])
+    window.hud.hide()
+    window.show()
+    tile = window.tiles[0]
+    try:
+        for name in res_names:
+            w, h = RESOLUTIONS[name]
+            frame = synthetic_frame(w, h)
+            for ww, wh in WINDOWS:
+                window.resize(ww, wh)
+                QApplication.processEvents()
+                tile.source_size = (w, h)
+                window.updateLayoutCache()
+                for scaled in (False, True):
+                    # scaled: the grabber already resized to the tile
+                    display = (tile.grabber.scaled(frame) if scaled
+                               else frame)
+                    tile.image = tile.converter(display)
+                    case = 'paint/{}/{}/{}x{}'.format(
+                        'prescaled' if scaled else 'painter-scaled',
+                        name, ww, wh)
+                    yield case, window.repaint
+    finally:
+        window.close()
+
+
+def image_widget_cases():
+    from ui import ImageWidget, scaled_cache
+    widget = ImageWidget()
+    widget.resize(QSize(140, 140))
+    widget.show()
+    QApplication.processEvents()
+    a = QPixmap.fromImage(QImage('test.jpg'))
+    b = QPixmap.fromImage(QImage('images/main.png'))
+    state = [a, b]
+
+    def cached():
+        state.reverse()
+        widget.pixmap = state[0]
+
+    def uncached():
+        scaled_cache.clear()
+        state.reverse()
+        widget.pixmap = state[0]
+
+    yield 'imagewidget/cached', cached
+    yield 'imagewidget/uncached', uncached
+    yield 'imagewidget/repaint', widget.repaint
+    widget.close()
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for case, res in sorted(results['cases'].items()):
+        old = baseline['cases'].get(case)
+        if old is None:
+            continue
+        ratio = res['median_ms'] / max(old['median_ms'], 1e-9)
+        flag = ''
+        if ratio > 1 + threshold:
+            regressions.append(case)
+            flag = '  REGRESSION'
+        print('{:<48s} {:9.3f} -> {:9.3f} ms  x{:.2f}{}'.format(
+            case, old['median_ms'], res['median_ms'], ratio, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--resolutions', nargs='+', default=list(RESOLUTIONS),
+                        choices=list(RESOLUTIONS))
+    parser.add_argument('--iterations', type=int, default=30)
+    parser.add_argument('--only', default=None,
+                        help='run the cases whose name starts with this')
+    parser.add_argument('--output', default=None,
+                        help='write the results as JSON to this file')
+    parser.add_argument('--compare', default=None,
+                        help='baseline JSON from an earlier --output')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='allowed relative slowdown of a median')
+    args = parser.parse_args()
+
+    app = QApplication(sys.argv[:1])
+    from utils.log import logger
+    logger.setLevel('WARNING')
+    # cases are (name, fn) pairs, a generator keeps its setup alive
+    # until the next case is requested
+    groups = [conversion_cases(args.resolutions),
+              paint_cases(args.resolutions),
+              image_widget_cases()]
+    results = {'python': platform.python_version(),
+               'numpy': np.__version__, 'cases': {}}
+    for group in groups:
+        for case, fn in group:
+            if args.only and not case.startswith(args.only):
+                continue
+            res = measure(fn, args.iterations)
+            results['cases'][case] = res
+            print('{:<48s} {:9.3f} ms  p95 {:9.3f} ms  peak {:>10d} B  '
+                  '{:>4d} blocks'.format(
+                      case, res['median_ms'], res['p95_ms'],
+                      res['peak_alloc_bytes'], res['alloc_blocks']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    status = 0
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('{} case(s) regressed more than {:.0%}'.format(
+                len(regressions), args.threshold))
+            status = 1
+    app.quit()
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
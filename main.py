@@ -7,13 +7,18 @@ import os
 import time
 import traceback
 import logging
+import argparse
 
-from PyQt5.QtCore import *
-from PyQt5.QtGui import *
-from PyQt5.QtWidgets import *
+from utils.profile import startup
 
-from utils.log import logger
-from widget import MainWindow
+# only what is needed before the first window shows, cv2 / numpy and the
+# widgets are imported once the placeholder is on screen
+from PyQt5.QtCore import Qt, QCoreApplication
+from PyQt5.QtGui import QFont, QPixmap
+from PyQt5.QtWidgets import QApplication, QMessageBox, QSplashScreen
+
+from utils.log import logger, addFileSink
+startup.mark('import qt')
 
 APP_ROOT = os.path.dirname(os.path.abspath(__file__))
 APP_NAME = 'test'
@@ -62,8 +67,110 @@ def excepthook(excType, excValue, tracebackobj):
 
 sys.excepthook = excepthook
 
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='main.py')
+    parser.add_argument('--renderer', default='raster',
+                        choices=['raster', 'opengl', 'software-opengl'],
+                        help='video surface backend, software-opengl forces '
+                             'Mesa llvmpipe on GPU-less machines')
+    parser.add_argument('--detector', default='haar',
+                        choices=['haar', 'dnn', 'yunet', 'none'],
+                        help='face detector feeding the welcome widget; '
+                             'haar needs OpenCV 4.x, yunet and dnn load '
+                             'their model from models/')
+    parser.add_argument('--detect-every', type=int, default=5,
+                        help='run detection on every Nth displayed frame')
+    parser.add_argument('--detect-pool', default='thread',
+                        choices=['thread', 'process'],
+                        help='run detection in threads or in processes fed '
+                             'through shared memory')
+    parser.add_argument('--recognizer', default='none',
+                        choices=['dnn', 'dummy', 'none'],
+                        help='face embedding model matched against --gallery')
+    parser.add_argument('--gallery', default='gallery',
+                        help='FaceGallery prefix (<prefix>.npy, _ids.npy)')
+    parser.add_argument('--photos', default=None,
+                        help='directory of enrolled photos <person_id>.jpg '
+                             'to greet matches with, default <gallery>_photos')
+    parser.add_argument('--recognize-batch', type=int, default=8,
+                        help='max faces per embedding batch')
+    parser.add_argument('--recognize-delay', type=float, default=20,
+                        help='max ms a face waits for its batch to fill')
+    parser.add_argument('--recognize-workers', type=int, default=1,
+                        help='embedding workers')
+    parser.add_argument('--recognize-pool', default='thread',
+                        choices=['thread', 'process'],
+                        help='run the embedding workers as threads or '
+                             'processes')
+    parser.add_argument('--visit-log', default='visits.db',
+                        help='sqlite file of the visit log, empty to disable')
+    parser.add_argument('--config', default=None,
+                        help='JSON camera config, see utils.capture.loadStreams')
+    parser.add_argument('--metrics-file', default=None,
+                        help='dump pipeline metrics as JSON every 5 s')
+    parser.add_argument('--log-file', default=None,
+                        help='also log to this file, rotated at 10 MB')
+    parser.add_argument('--log-json', action='store_true',
+                        help='write --log-file as JSON lines')
+    parser.add_argument('--offline', default=None, metavar='PATH',
+                        help='process a video file or directory headless '
+                             'and exit, no window')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='--offline worker processes, default all cores')
+    parser.add_argument('--chunk-seconds', type=float, default=60.0,
+                        help='--offline video seconds per work item')
+    parser.add_argument('--report', default='offline_report.json',
+                        help='--offline per-stage timing report (JSON)')
+    parser.add_argument('--offline-visit-log', default='offline_visits.db',
+                        help='--offline sqlite visit log, kept apart from '
+                             '--visit-log; empty to disable')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='print a per-phase startup timing breakdown')
+    # leave 'debug', 'fast' and Qt's own options alone
+    args, _ = parser.parse_known_args(argv[1:])
+    return args
+
+
+def run_offline(args):
+    from utils import offline
+    result = offline.run(
+        args.offline, visit_log=args.offline_visit_log or None,
+        report=args.report,
+        jobs=args.jobs, chunk_seconds=args.chunk_seconds,
+        detector=args.detector, detect_every=args.detect_every,
+        recognizer=args.recognizer, gallery=args.gallery,
+        batch=args.recognize_batch)
+    print('{video_s}s of video in {wall_s}s ({realtime_factor}x real time), '
+          '{visits} visits'.format(**result))
+    if result['failed'] == result['chunks']:
+        print('no chunk of {} could be processed'.format(args.offline),
+              file=sys.stderr)
+        return 1
+    return 0
+
+
 if __name__ == "__main__":
+    args = parse_args(sys.argv)
+    if args.offline:
+        # no QApplication, so no message box either
+        sys.excepthook = sys.__excepthook__
+        if args.log_file:
+            addFileSink(args.log_file, json_lines=args.log_json)
+        sys.exit(run_offline(args))
+    renderer = args.renderer
+    if renderer == 'software-opengl':
+        os.environ['LIBGL_ALWAYS_SOFTWARE'] = '1'
+        QCoreApplication.setAttribute(Qt.AA_UseSoftwareOpenGL)
+        renderer = 'opengl'
+    if renderer == 'opengl':
+        QCoreApplication.setAttribute(Qt.AA_ShareOpenGLContexts)
     app = QApplication(sys.argv)
+    startup.mark('qapplication')
+    splash = QSplashScreen(QPixmap('test.jpg'))
+    splash.show()
+    app.processEvents()
+    startup.mark('placeholder shown')
     try:
         app.setFont(QFont('微软雅黑'))
     except Exception:
@@ -71,8 +178,31 @@ if __name__ == "__main__":
     debug = 'debug' in sys.argv
     if debug:
         logger.setLevel(logging.DEBUG)
+    if args.log_file:
+        addFileSink(args.log_file, json_lines=args.log_json)
     logger.info('start main app ...')
-    myapp = MainWindow(debug=debug)
+    fast_scaling = 'fast' in sys.argv
+
+    from utils.capture import loadStreams
+    from widget import MainWindow
+    startup.mark('import widget')
+    layout, streams = loadStreams(args.config)
+    myapp = MainWindow(debug=debug, fast_scaling=fast_scaling,
+                       renderer=renderer, detector=args.detector,
+                       detect_every=args.detect_every,
+                       visit_log=args.visit_log, streams=streams,
+                       layout=layout, metrics_file=args.metrics_file,
+                       recognizer=args.recognizer, gallery=args.gallery,
+                       photos=args.photos,
+                       recognize_batch=args.recognize_batch,
+                       recognize_delay=args.recognize_delay / 1000.0,
+                       recognize_workers=args.recognize_workers,
+                       recognize_pool=args.recognize_pool,
+                       detect_pool=args.detect_pool)
     myapp.setWindowTitle(APP_NAME)
+    startup.mark('main window built')
+    if args.profile_startup:
+        startup.waitFor(['first frame', 'background loaded'], startup.report)
     myapp.show()
+    splash.finish(myapp)
     sys.exit(app.exec_())
\ No newline at end of file
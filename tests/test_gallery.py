@@ -0,0 +1,41 @@
+# -*- coding:utf-8 -*-
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.gallery import FaceGallery
+
+
+def make_gallery(n=500, dim=128):
+    rng = np.random.RandomState(0)
+    gallery = FaceGallery(dim)
+    gallery.enroll_batch(['p%d' % i for i in range(n)],
+                         rng.randn(n, dim).astype(np.float32))
+    return gallery
+
+
+def test_save_over_own_memory_map(tmp_path):
+    prefix = str(tmp_path / 'gallery')
+    saved = make_gallery()
+    saved.save(prefix)
+
+    loaded = FaceGallery.load(prefix, mmap=True)
+    assert isinstance(loaded._data, np.memmap)
+    loaded.save(prefix)
+
+    again = FaceGallery.load(prefix)
+    assert again.ids == saved.ids
+    np.testing.assert_array_equal(again.embeddings, saved.embeddings)
+    assert not os.path.exists(prefix + '.npy.tmp')
+
+
+def test_open_checks_embedding_size(tmp_path):
+    prefix = str(tmp_path / 'gallery')
+    make_gallery(n=10, dim=128).save(prefix)
+    assert len(FaceGallery.open(prefix, 128)) == 10
+    with pytest.raises(ValueError):
+        FaceGallery.open(prefix, 512)
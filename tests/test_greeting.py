@@ -0,0 +1,88 @@
+# -*- coding:utf-8 -*-
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.greeting import GreetingScheduler
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def drain(scheduler):
+    order = []
+    entry = scheduler.pop()
+    while entry is not None:
+        order.append(entry['person_id'])
+        entry = scheduler.pop()
+    return order
+
+
+def test_vip_then_first_today_then_most_recent():
+    clock = FakeClock()
+    scheduler = GreetingScheduler(clock=clock)
+    for person_id, kwargs in (('old', {}), ('first', {'first_today': True}),
+                              ('vip', {'vip': True}), ('new', {})):
+        scheduler.offer(person_id, person_id, **kwargs)
+        clock.now += 1.0
+    assert drain(scheduler) == ['vip', 'first', 'new', 'old']
+
+
+def test_pending_sightings_collapse():
+    clock = FakeClock()
+    scheduler = GreetingScheduler(clock=clock)
+    assert scheduler.offer('a', 'a', image='crop1')
+    clock.now += 1.0
+    assert scheduler.offer('b', 'b')
+    clock.now += 1.0
+    # seen again: one entry, newest crop, now the most recent sighting
+    assert not scheduler.offer('a', 'a', image='crop2')
+    assert len(scheduler) == 2
+    entry = scheduler.pop()
+    assert entry['person_id'] == 'a' and entry['image'] == 'crop2'
+    assert scheduler.pop()['person_id'] == 'b'
+    assert scheduler.pop() is None
+    assert scheduler.stats()['deduped'] == 1
+
+
+def test_greeted_person_is_not_greeted_again_within_window():
+    clock = FakeClock()
+    scheduler = GreetingScheduler(dedup_window=30.0, clock=clock)
+    scheduler.offer('a', 'a')
+    assert scheduler.pop()['person_id'] == 'a'
+    clock.now += 10.0
+    assert not scheduler.offer('a', 'a')
+    assert scheduler.pop() is None
+    clock.now += 30.0
+    assert scheduler.offer('a', 'a')
+    assert scheduler.pop()['person_id'] == 'a'
+
+
+def test_old_greetings_expire():
+    clock = FakeClock()
+    scheduler = GreetingScheduler(max_wait=10.0, clock=clock)
+    scheduler.offer('gone', 'gone')
+    clock.now += 5.0
+    scheduler.offer('here', 'here', vip=True)
+    clock.now += 6.0
+    assert drain(scheduler) == ['here']
+    assert scheduler.stats()['expired'] == 1
+
+
+def test_hold_time_shrinks_with_backlog():
+    scheduler = GreetingScheduler(hold=1.5, min_hold=0.4, clock=FakeClock())
+    assert scheduler.holdTime() == 1.5
+    assert scheduler.cooldownTime() == scheduler.cooldown
+    for i in range(4):
+        scheduler.offer(str(i), str(i))
+    assert 0.4 <= scheduler.holdTime() < 1.5
+    assert scheduler.cooldownTime() == 0.0
+    for i in range(4, 100):
+        scheduler.offer(str(i), str(i))
+    assert scheduler.holdTime() == 0.4
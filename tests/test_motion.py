@@ -0,0 +1,135 @@
+# -*- coding:utf-8 -*-
+import os
+import sys
+import time
+
+import numpy as np
+import cv2
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from utils.motion import MotionGate
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def scene():
+    return cv2.imread(os.path.join(ROOT, 'test.jpg'))
+
+
+def test_still_scene_turns_idle():
+    clock = FakeClock()
+    gate = MotionGate(idle_after=1.0, clock=clock)
+    frame = scene()
+    assert gate.update(frame)
+    for _ in range(20):
+        clock.now += 0.1
+        assert not gate.update(frame)
+    assert gate.idle
+    assert gate.stats()['moving'] == 1
+
+
+def test_motion_wakes_the_gate():
+    clock = FakeClock()
+    gate = MotionGate(idle_after=1.0, clock=clock)
+    frame = scene()
+    for _ in range(20):
+        gate.update(frame)
+        clock.now += 0.1
+    assert gate.idle
+    moved = frame.copy()
+    moved[100:300, 100:300] = 255 - moved[100:300, 100:300]
+    assert gate.update(moved)
+    assert not gate.idle
+
+
+def test_reduced_decode_only_reseeds():
+    clock = FakeClock()
+    gate = MotionGate(idle_after=1.0, clock=clock)
+    packet = cv2.imencode('.jpg', scene())[1]
+    full = cv2.imdecode(packet, cv2.IMREAD_COLOR)
+    reduced = cv2.imdecode(packet, cv2.IMREAD_REDUCED_COLOR_4)
+    for _ in range(20):
+        gate.update(full)
+        clock.now += 0.1
+    assert gate.idle
+    # the DCT-scaled decode is not the full one strided
+    assert gate.update(reduced)
+    gate = MotionGate(idle_after=1.0, clock=clock)
+    for _ in range(20):
+        gate.update(full)
+        clock.now += 0.1
+    for _ in range(10):
+        assert not gate.update(reduced, source='reduced')
+        clock.now += 0.1
+    assert gate.idle
+    assert not gate.update(full)
+    assert gate.idle
+
+
+class StaticMjpegCamera(object):
+    ''' MJPG camera that hands out the same JPEG packet forever '''
+    def __init__(self, frame, fps=200.0):
+        self.packet = cv2.imencode('.jpg', frame)[1].reshape(1, -1)
+        self.frame = frame
+        self.convert = 1
+        self.interval = 1.0 / fps
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_CONVERT_RGB:
+            self.convert = value
+        return True
+
+    def get(self, prop):
+        return {cv2.CAP_PROP_FRAME_WIDTH: self.frame.shape[1],
+                cv2.CAP_PROP_FRAME_HEIGHT: self.frame.shape[0],
+                cv2.CAP_PROP_FPS: 1.0 / self.interval,
+                cv2.CAP_PROP_FOURCC: cv2.VideoWriter_fourcc(*'MJPG')
+                }.get(prop, 0)
+
+    def isOpened(self):
+        return True
+
+    def grab(self):
+        time.sleep(self.interval)
+        return True
+
+    def retrieve(self):
+        return True, (self.frame.copy() if self.convert else self.packet)
+
+    def read(self):
+        self.grab()
+        return self.retrieve()
+
+    def release(self):
+        pass
+
+
+def test_static_mjpeg_stays_idle():
+    pytest.importorskip('PyQt5')
+    from PyQt5.QtCore import Qt
+    from utils.capture import MjpegCapture
+    from widget import FrameGrabber
+
+    cap = MjpegCapture.open(StaticMjpegCamera(scene()))
+    assert cap is not None
+    grabber = FrameGrabber(0, name='static')
+    grabber.openCapture = lambda: cap
+    grabber.detect_width = 160
+    grabber.gate.idle_after = 0.3
+    changes = []
+    grabber.idleChanged.connect(changes.append, type=Qt.DirectConnection)
+    grabber.start()
+    time.sleep(2.0)
+    grabber.stop()
+    assert changes == [True]
+    assert grabber.gate.idle
+    assert grabber.idle_skipped > 0
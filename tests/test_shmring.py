@@ -0,0 +1,79 @@
+# -*- coding:utf-8 -*-
+import os
+import sys
+import time
+import threading
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.shmring import FrameRing, FrameWorkerPool
+
+
+class SumTask(object):
+    ''' picklable task, runs in the worker processes '''
+    def __call__(self, frame, meta):
+        return tuple(frame.shape), int(frame.sum(dtype=np.int64))
+
+
+def test_ring_views_and_stale_slots():
+    ring = FrameRing(2, (4, 6, 3))
+    try:
+        frame = np.arange(72, dtype=np.uint8).reshape(4, 6, 3)
+        seq = ring.write(0, frame)
+        other = FrameRing.attach(ring.spec())
+        view = other.view(0, seq)
+        np.testing.assert_array_equal(view, frame)
+        assert not view.flags.writeable
+        small = np.ones((2, 3, 3), np.uint8)
+        new_seq = ring.write(0, small)
+        assert other.view(0, seq) is None
+        np.testing.assert_array_equal(other.view(0, new_seq), small)
+        with pytest.raises(ValueError):
+            ring.write(1, np.zeros((5, 6, 3), np.uint8))
+        del view
+        other.close()
+    finally:
+        ring.close()
+        ring.unlink()
+
+
+def test_worker_pool_runs_tasks_and_grows():
+    results = []
+    done = threading.Condition()
+
+    def callback(meta, result, error):
+        with done:
+            results.append((meta, result, error))
+            done.notify_all()
+
+    def wait_for(n, timeout=30.0):
+        deadline = time.time() + timeout
+        with done:
+            while len(results) < n and time.time() < deadline:
+                done.wait(0.1)
+        return len(results) >= n
+
+    pool = FrameWorkerPool(SumTask, workers=1, callback=callback,
+                           max_shape=(8, 8, 3))
+    try:
+        frame = np.full((8, 8, 3), 2, np.uint8)
+        deadline = time.time() + 30.0
+        while not pool.submit(frame, 'a') and time.time() < deadline:
+            time.sleep(0.05)
+        assert wait_for(1)
+        assert results[0] == ('a', ((8, 8, 3), 384), None)
+
+        # a larger frame is dropped while the ring is rebuilt for it
+        big = np.ones((16, 16, 3), np.uint8)
+        assert not pool.submit(big, 'b')
+        deadline = time.time() + 30.0
+        while not pool.submit(big, 'c') and time.time() < deadline:
+            time.sleep(0.05)
+        assert wait_for(2)
+        assert results[1] == ('c', ((16, 16, 3), 768), None)
+        assert pool.stats()['rebuilds'] == 1
+    finally:
+        pool.close()
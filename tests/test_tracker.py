@@ -0,0 +1,118 @@
+# -*- coding:utf-8 -*-
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip('PyQt5')
+
+from utils.tracker import FaceTracker, TrackingStage, SESSION
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def face(x, y, size=60, text='访客'):
+    return {'box': (x, y, size, size), 'text': text}
+
+
+def test_new_face_needs_verify_once():
+    clock = FakeClock()
+    tracker = FaceTracker(reverify=3.0, clock=clock)
+    first = tracker.update([face(100, 100)])[0]
+    assert first['verify'] and first['track_id'] == 1
+    first['person_id'], first['score'] = 'alice', 0.9
+    assert tracker.identify([first]) == [first]
+
+    clock.now += 0.2
+    again = tracker.update([face(105, 102)])[0]
+    assert again['track_id'] == 1
+    assert not again['verify']
+    assert again['person_id'] == 'alice' and again['score'] == 0.9
+    assert tracker.stats()['reused'] == 1
+
+
+def test_reverify_after_timeout_and_low_score():
+    clock = FakeClock()
+    tracker = FaceTracker(reverify=3.0, min_score=0.6, clock=clock)
+    f = tracker.update([face(100, 100)])[0]
+    f['person_id'], f['score'] = 'bob', 0.5
+    tracker.identify([f])
+    clock.now += 0.2
+    # a weak match is asked again at once
+    assert tracker.update([face(100, 100)])[0]['verify']
+
+    tracker = FaceTracker(reverify=3.0, max_age=10.0, clock=clock)
+    f = tracker.update([face(100, 100)])[0]
+    f['person_id'], f['score'] = 'bob', 0.9
+    tracker.identify([f])
+    clock.now += 1.0
+    assert not tracker.update([face(100, 100)])[0]['verify']
+    clock.now += 3.0
+    assert tracker.update([face(100, 100)])[0]['verify']
+
+
+def test_arrival_once_per_track_and_on_change():
+    clock = FakeClock()
+    tracker = FaceTracker(reverify=0.0, clock=clock)
+    f = tracker.update([face(100, 100)])[0]
+    f['person_id'] = 'alice'
+    assert tracker.identify([f]) == [f]
+    clock.now += 0.1
+    f = tracker.update([face(100, 100)])[0]
+    f['person_id'] = 'alice'
+    assert tracker.identify([f]) == []
+    clock.now += 0.1
+    f = tracker.update([face(100, 100)])[0]
+    f['person_id'] = 'carol'
+    assert tracker.identify([f]) == [f]
+    assert tracker.stats()['arrivals'] == 2
+
+
+def test_far_apart_faces_are_separate_tracks():
+    tracker = FaceTracker(clock=FakeClock())
+    faces = tracker.update([face(0, 0), face(400, 0)])
+    assert [f['track_id'] for f in faces] == [1, 2]
+    assert len(tracker) == 2
+
+
+def test_unknown_faces_get_distinct_track_ids():
+    tracker = FaceTracker(clock=FakeClock(), name='door')
+    faces = tracker.update([face(0, 0), face(400, 0)])
+    arrived = tracker.identify(faces)
+    ids = [f['person_id'] for f in arrived]
+    assert ids == ['track:{}:door:1'.format(SESSION),
+                   'track:{}:door:2'.format(SESSION)]
+    assert all(f['text'] == '访客' for f in arrived)
+
+
+def test_stale_frame_is_not_associated():
+    clock = FakeClock()
+    tracker = FaceTracker(clock=clock)
+    tracker.update([face(100, 100)], stamp=2.0)
+    old = tracker.update([face(100, 100)], stamp=1.0)[0]
+    assert old['track_id'] is None and not old['verify']
+    assert tracker.stats()['stale'] == 1
+
+
+def test_tracking_stage_keeps_streams_apart():
+    clock = FakeClock()
+    stage = TrackingStage(lambda name: FaceTracker(clock=clock, name=name))
+    a = stage.tracker('a').update([face(100, 100)])
+    b = stage.tracker('b').update([face(100, 100)])
+    # the same box on another camera is a new track there
+    assert a[0]['verify'] and b[0]['verify']
+    for f, stream in ((a[0], 'a'), (b[0], 'b')):
+        f['stream'] = stream
+    arrived = []
+    stage.arrived.connect(arrived.extend)
+    stage.onDetected(a + b)
+    assert sorted(f['person_id'] for f in arrived) == [
+        'track:{}:a:1'.format(SESSION), 'track:{}:b:1'.format(SESSION)]
@@ -0,0 +1,50 @@
+# -*- coding:utf-8 -*-
+import os
+import sys
+import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip('PyQt5')
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from PyQt5.QtWidgets import QApplication
+
+from widget import VisitTableModel, TableWidget
+
+
+def test_merged_visit_moves_to_top():
+    model = VisitTableModel(max_rows=3, merge_window=60)
+    assert model.addRecord('a', 100.0, person_id='p1')
+    assert model.addRecord('b', 110.0, person_id='p2')
+    assert model.addRecord('c', 120.0, person_id='p3')
+    assert not model.addRecord('a', 130.0, person_id='p1')
+    assert model.records() == [('a', 130.0), ('c', 120.0), ('b', 110.0)]
+    assert not model.addRecord('a', 140.0, person_id='p1')
+    assert model.records()[0] == ('a', 140.0)
+    assert model.rowCount() == 3
+
+
+def test_visit_outside_window_is_a_new_row():
+    model = VisitTableModel(max_rows=3, merge_window=60)
+    model.addRecord('a', 100.0, person_id='p1')
+    model.addRecord('b', 110.0, person_id='p2')
+    assert model.addRecord('a', 200.0, person_id='p1')
+    assert model.records() == [('a', 200.0), ('b', 110.0), ('a', 100.0)]
+    model.addRecord('c', 210.0, person_id='p3')
+    assert model.records() == [('c', 210.0), ('a', 200.0), ('b', 110.0)]
+
+
+def test_count_starts_over_after_midnight():
+    app = QApplication.instance() or QApplication([])
+    table = TableWidget()
+    table.addVisit('a', person_id='p1')
+    table.addVisit('b', person_id='p2')
+    assert table.getAccessNum() == 2
+    # the minute tick after midnight, nobody came in yet
+    table._day -= datetime.timedelta(days=1)
+    table.updateAccessNum()
+    assert table.ui.label.text().endswith(' 0')
+    table.stop_timer()
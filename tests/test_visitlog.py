@@ -0,0 +1,53 @@
+# -*- coding:utf-8 -*-
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import visitlog
+from utils.visitlog import VisitLog, timezone
+
+DAY = 24 * 3600.0
+
+
+def test_day_rollover(tmp_path, monkeypatch):
+    path = str(tmp_path / 'visits.db')
+    log = VisitLog(path, tz=timezone)
+    now = time.time()
+    today = log.dayOf(now)
+    assert log.record('p1', 'a', now)
+    assert not log.record('p1', 'a', now + 1)
+    assert log.record('p2', 'b', now + 2)
+    assert log.todayCount() == 2 and log.seenToday('p1')
+
+    # the first visit after midnight starts a new day
+    tomorrow = log.dayOf(now + DAY)
+    assert log.record('p1', 'a', now + DAY)
+    # a late row of the day before is kept but is not today's
+    assert not log.record('p3', 'c', now + 3)
+    real_time = time.time
+    monkeypatch.setattr(visitlog.time, 'time', lambda: real_time() + DAY)
+    assert log.todayCount() == 1
+    assert log.seenToday('p1') and not log.seenToday('p2')
+    assert log.countOn(today) == 3
+    assert log.countOn(tomorrow) == 1
+    log.close()
+
+    # a restart reads today's visitors back from disk
+    log = VisitLog(path, tz=timezone)
+    assert log.todayCount() == 1
+    assert not log.record('p1', 'a', now + DAY + 5)
+    assert log.latest()[0][1] == 'p1'
+    log.close()
+
+
+def test_count_is_zero_on_a_day_without_visits(tmp_path, monkeypatch):
+    log = VisitLog(str(tmp_path / 'visits.db'), tz=timezone)
+    log.record('p1', 'a')
+    assert log.todayCount() == 1
+    real_time = time.time
+    monkeypatch.setattr(visitlog.time, 'time', lambda: real_time() + DAY)
+    assert log.todayCount() == 0
+    assert not log.seenToday('p1')
+    log.close()
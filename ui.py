@@ -3,17 +3,59 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+from collections import OrderedDict
+
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 
 
+_default_pixmap = None
+
+
+def defaultPixmap():
+    """images/head.png, loaded once per process."""
+    global _default_pixmap
+    if _default_pixmap is None:
+        _default_pixmap = QPixmap('images/head.png')
+    return _default_pixmap
+
+
+class ScaledPixmapCache(object):
+    ''' LRU of smooth scaled pixmaps keyed by (source cacheKey, width) '''
+    def __init__(self, max_size=64):
+        self.max_size = max_size
+        self._items = OrderedDict()
+
+    def get(self, pixmap, width):
+        if pixmap.width() == width:
+            # already the right size, e.g. a THUMB_SIZE face thumbnail
+            return pixmap
+        key = (pixmap.cacheKey(), width)
+        scaled = self._items.get(key)
+        if scaled is not None:
+            self._items.move_to_end(key)
+            return scaled
+        scaled = pixmap.scaledToWidth(width, Qt.SmoothTransformation)
+        self._items[key] = scaled
+        if len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+        return scaled
+
+    def clear(self):
+        self._items.clear()
+
+
+scaled_cache = ScaledPixmapCache()
+
+
 class ImageWidget(QFrame):
     def __init__(self, pixmap=None, parent=None, min_size=QSize(128, 128),
                  margin=5):
         super(ImageWidget, self).__init__(parent)
-        self.default_pixmap = QPixmap('images/head.png')
-        self.pixmap = pixmap
+        self.default_pixmap = defaultPixmap()
+        self._pixmap = pixmap
+        self._shown_key = None
         self.imageLabel = QLabel()
         self.imageLabel.setMinimumSize(min_size)
         self.imageLabel.setMaximumSize(QSize(128, 128))
@@ -30,20 +72,32 @@ class ImageWidget(QFrame):
         border-radius: 6px
         }
         ''')
+        self.updateImage()
+
+    @property
+    def pixmap(self):
+        return self._pixmap
+
+    @pixmap.setter
+    def pixmap(self, pixmap):
+        self._pixmap = pixmap
+        self.updateImage()
 
-    def paintEvent(self, event):
+    def resizeEvent(self, event):
+        super(ImageWidget, self).resizeEvent(event)
         self.updateImage()
-        super(ImageWidget, self).paintEvent(event)
 
     def updateImage(self):
-        if self.pixmap:
-            show_map = self.pixmap.copy()
-        else:
-            show_map = self.default_pixmap.copy()
+        """Rescale only when the source pixmap or the label width changed."""
+        source = self._pixmap if self._pixmap else self.default_pixmap
         size = self.imageLabel.width() - 2
-        show_map = show_map.scaledToWidth(size,
-                                          Qt.SmoothTransformation)
-        self.imageLabel.setPixmap(show_map)
+        if source.isNull() or size <= 0:
+            return
+        key = (source.cacheKey(), size)
+        if key == self._shown_key:
+            return
+        self._shown_key = key
+        self.imageLabel.setPixmap(scaled_cache.get(source, size))
 
 
 class UI_NoticeWidget(object):
@@ -133,7 +187,7 @@ class UI_TableWidget(object):
         form.setObjectName('TableWidget')
         self.label = QLabel('今日到访人数： 0')
         self.label.setMaximumHeight(30)
-        self.table = QTableWidget()
+        self.table = QTableView()
         self.init_table()
         down_layout = QHBoxLayout()
         down_layout.addStretch()
@@ -161,7 +215,7 @@ class UI_TableWidget(object):
             font-style: bold;
             background-color:rgb(255, 102, 51, 230)
             }
-            QTableWidget {
+            QTableView {
             color: white;
             gridline-color: rgb(167, 97, 83, 200);
             border: 5px;
@@ -176,26 +230,12 @@ class UI_TableWidget(object):
     def init_table(self):
         self.table.setMinimumHeight(340)
         self.table.setMaximumWidth(200)
-        self.table.setColumnCount(2)
-        self.table.setRowCount(10)
-        self.table.setHorizontalHeaderLabels(['姓名', '访问时间'])
-        # self.table.horizontalHeader().setStretchLastSection(True)
-        # self.table.setShowGrid(False)
         self.table.verticalHeader().setVisible(False)
+        self.table.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
         self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
         self.table.setFocusPolicy(Qt.NoFocus)
-        # self.table.setSelectionBehavior(QAbstractItemView.NoSelection)
         self.table.setSelectionMode(QAbstractItemView.NoSelection)
         self.table.horizontalHeader().setSectionResizeMode(QHeaderView.Fixed)
-        for i in range(self.table.rowCount()):
-            for j in range(self.table.colorCount()):
-                item = QTableWidgetItem('{}, {}'.format(i, j))
-                item.setTextAlignment(Qt.AlignCenter)
-                if i % 2 > 0:
-                    item.setBackground(QColor(255, 102, 51, 200))
-                else:
-                    item.setBackground(QColor(193, 108, 91, 200))
-                self.table.setItem(i, j, item)
 
         self.table.horizontalHeader().setStyleSheet(
             '''
@@ -263,3 +303,32 @@ class UI_WelcomeWidget(object):
             }
             '''
         )
+
+
+class UI_MetricsWidget(object):
+    def setupUI(self, form: QFrame):
+        layout = QVBoxLayout()
+        layout.setContentsMargins(6, 6, 6, 6)
+        form.setObjectName('MetricsWidget')
+        self.label = QLabel()
+        self.label.setObjectName('MetricsLabel')
+        self.label.setFont(QFontDatabase.systemFont(QFontDatabase.FixedFont))
+        layout.addWidget(self.label)
+        form.resize(240, 200)
+        form.setLayout(layout)
+
+        form.setStyleSheet(
+            '''
+            #MetricsWidget {
+            background-color: rgb(0, 0, 0, 160);
+            border: 2px solid rgb(120, 120, 120, 200);
+            }
+            #MetricsWidget:hover {
+            border: 2px solid rgb(220, 220, 220, 230);
+            }
+            #MetricsLabel {
+            color: rgb(0, 255, 120);
+            font-size: 12px;
+            }
+            '''
+        )
@@ -0,0 +1,165 @@
+# -*- coding:utf-8 -*-
+import numpy as np
+
+from utils.gallery import l2_normalize, topk
+from utils.log import logger
+
+
+def spherical_kmeans(data, nlist, iters=10, seed=0):
+    """Cluster unit vectors by cosine, return nlist unit centroids."""
+    rng = np.random.default_rng(seed)
+    centroids = data[rng.choice(len(data), nlist, replace=False)].copy()
+    for _ in range(iters):
+        assign = np.argmax(data.dot(centroids.T), axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, data)
+        counts = np.bincount(assign, minlength=nlist)
+        empty = counts == 0
+        if empty.any():
+            # restart empty clusters on random points
+            sums[empty] = data[rng.choice(len(data), empty.sum())]
+        centroids = l2_normalize(sums)
+    return centroids
+
+
+class _InvertedList(object):
+    def __init__(self, dim):
+        self.data = np.zeros((16, dim), np.float32)
+        self.ids = []
+
+    def append(self, person_id, vec):
+        row = len(self.ids)
+        if row == len(self.data):
+            data = np.zeros((row * 2, self.data.shape[1]), np.float32)
+            data[:row] = self.data
+            self.data = data
+        self.data[row] = vec
+        self.ids.append(person_id)
+        return row
+
+    def pop(self, row):
+        """Remove row, return the id moved into it or None."""
+        last = len(self.ids) - 1
+        moved = None
+        if row != last:
+            self.data[row] = self.data[last]
+            moved = self.ids[row] = self.ids[last]
+        self.ids.pop()
+        return moved
+
+
+class IVFIndex(object):
+    ''' Approximate cosine search with an inverted file (IVF-Flat)
+
+    Embeddings are bucketed by their nearest of `nlist` k-means centroids.
+    A query only scores the vectors in its `nprobe` closest buckets, so
+    the cost drops to about nprobe / nlist of the exact FaceGallery
+    search. Raise nprobe for recall, lower it for latency.
+    '''
+    def __init__(self, dim, nlist=1024, nprobe=16):
+        self.dim = dim
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.centroids = None
+        self._lists = []
+        self._where = {}
+
+    def __len__(self):
+        return len(self._where)
+
+    def __contains__(self, person_id):
+        return person_id in self._where
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    def train(self, sample, iters=10, seed=0):
+        sample = l2_normalize(np.reshape(sample, (-1, self.dim)))
+        nlist = min(self.nlist, len(sample))
+        self.centroids = spherical_kmeans(sample, nlist, iters, seed)
+        self.nlist = nlist
+        self._lists = [_InvertedList(self.dim) for _ in range(nlist)]
+        self._where = {}
+        logger.debug('train ivf index: {} lists on {} samples'.format(
+            nlist, len(sample)))
+
+    def enroll_batch(self, person_ids, embeddings):
+        if not self.is_trained:
+            raise RuntimeError('IVFIndex.train() must be called first')
+        vecs = l2_normalize(np.reshape(embeddings, (-1, self.dim)))
+        assign = np.argmax(vecs.dot(self.centroids.T), axis=1)
+        for person_id, vec, li in zip(person_ids, vecs, assign):
+            self.remove(person_id)
+            row = self._lists[li].append(person_id, vec)
+            self._where[person_id] = (li, row)
+
+    def enroll(self, person_id, embedding):
+        self.enroll_batch([person_id], [embedding])
+
+    def remove(self, person_id):
+        where = self._where.pop(person_id, None)
+        if where is None:
+            return False
+        li, row = where
+        moved = self._lists[li].pop(row)
+        if moved is not None:
+            self._where[moved] = (li, row)
+        return True
+
+    def search_batch(self, probes, k=5, nprobe=None):
+        """Top-k (id, score) lists for each probe of an N x dim array."""
+        probes = l2_normalize(np.reshape(probes, (-1, self.dim)))
+        if not self._where:
+            return [[] for _ in range(len(probes))]
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        coarse, _ = topk(probes.dot(self.centroids.T), nprobe)
+        # group probes by bucket so every bucket is one matrix multiply
+        visits = {}
+        for pi, lists in enumerate(coarse):
+            for li in lists:
+                visits.setdefault(li, []).append(pi)
+        cand_ids = [[] for _ in range(len(probes))]
+        cand_scores = [[] for _ in range(len(probes))]
+        for li, pis in visits.items():
+            inv = self._lists[li]
+            n = len(inv.ids)
+            if n == 0:
+                continue
+            scores = probes[pis].dot(inv.data[:n].T)
+            for pi, row in zip(pis, scores):
+                cand_ids[pi].append((li, n))
+                cand_scores[pi].append(row)
+        results = []
+        for ids, scores in zip(cand_ids, cand_scores):
+            if not scores:
+                results.append([])
+                continue
+            flat = np.concatenate(scores)
+            idx, vals = topk(flat, k)
+            # map flat candidate positions back to (bucket, row)
+            ends = np.cumsum([n for _, n in ids])
+            chunks = np.searchsorted(ends, idx, side='right')
+            found = []
+            for i, c, v in zip(idx, chunks, vals):
+                row = i - (ends[c - 1] if c else 0)
+                found.append((self._lists[ids[c][0]].ids[row], float(v)))
+            results.append(found)
+        return results
+
+    def search(self, probe, k=5, nprobe=None):
+        return self.search_batch(probe, k, nprobe)[0]
+
+    @classmethod
+    def from_gallery(cls, gallery, nlist=1024, nprobe=16, train_size=65536,
+                     seed=0):
+        """Build an index with the contents of a FaceGallery."""
+        index = cls(gallery.dim, nlist, nprobe)
+        data = gallery.embeddings
+        rng = np.random.default_rng(seed)
+        sample = data
+        if len(data) > train_size:
+            sample = data[rng.choice(len(data), train_size, replace=False)]
+        index.train(sample, seed=seed)
+        index.enroll_batch(gallery.ids, data)
+        return index
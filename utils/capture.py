@@ -0,0 +1,305 @@
+# -*- coding:utf-8 -*-
+import os
+import json
+import time
+
+import numpy as np
+import cv2
+
+from utils.log import logger
+
+
+class PacedCapture(object):
+    ''' Base for captures that deliver frames at a fixed rate
+
+    Like cv2.VideoCapture, grab() waits for the next frame and
+    retrieve() produces it; read() does both.
+    '''
+    def __init__(self, fps):
+        self.fps = fps or 25.0
+        self._next = None
+
+    def wait(self):
+        now = time.monotonic()
+        if self._next is None or now - self._next > 1.0:
+            self._next = now
+        delay = self._next - now
+        if delay > 0:
+            time.sleep(delay)
+        self._next += 1.0 / self.fps
+
+
+class SyntheticCapture(PacedCapture):
+    ''' cv2.VideoCapture stand-in that draws a moving test pattern
+
+    Source strings look like 'synthetic', 'synthetic:640x480' or
+    'synthetic:640x480@15'.
+    '''
+    def __init__(self, source='synthetic', width=1280, height=720, fps=25.0):
+        spec = source.partition(':')[2]
+        if '@' in spec:
+            spec, _, rate = spec.partition('@')
+            fps = float(rate)
+        if spec:
+            width, height = (int(v) for v in spec.split('x'))
+        super(SyntheticCapture, self).__init__(fps)
+        self.width = width
+        self.height = height
+        self.index = 0
+        self._opened = True
+        ramp = np.linspace(0, 255, width, dtype=np.uint8)
+        self._background = np.empty((height, width, 3), np.uint8)
+        self._background[:] = ramp[None, :, None]
+
+    def isOpened(self):
+        return self._opened
+
+    def set(self, prop, value):
+        return False
+
+    def get(self, prop):
+        return {cv2.CAP_PROP_FRAME_WIDTH: self.width,
+                cv2.CAP_PROP_FRAME_HEIGHT: self.height,
+                cv2.CAP_PROP_FPS: self.fps}.get(prop, 0)
+
+    def grab(self):
+        if not self._opened:
+            return False
+        self.wait()
+        return True
+
+    def retrieve(self):
+        frame = self._background.copy()
+        x = (self.index * 8) % max(1, self.width - 40)
+        frame[:, x:x + 40] = (0, 0, 255)
+        self.index += 1
+        return True, frame
+
+    def read(self):
+        if not self.grab():
+            return False, None
+        return self.retrieve()
+
+    def release(self):
+        self._opened = False
+
+
+class FileCapture(PacedCapture):
+    ''' Video file played at its own frame rate, optionally looped '''
+    def __init__(self, path, loop=True):
+        self.cap = cv2.VideoCapture(path)
+        super(FileCapture, self).__init__(self.cap.get(cv2.CAP_PROP_FPS))
+        self.loop = loop
+
+    def isOpened(self):
+        return self.cap.isOpened()
+
+    def set(self, prop, value):
+        return self.cap.set(prop, value)
+
+    def get(self, prop):
+        return self.cap.get(prop)
+
+    def grab(self):
+        self.wait()
+        b = self.cap.grab()
+        if not b and self.loop:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            b = self.cap.grab()
+        return b
+
+    def retrieve(self):
+        return self.cap.retrieve()
+
+    def read(self):
+        if not self.grab():
+            return False, None
+        return self.retrieve()
+
+    def release(self):
+        self.cap.release()
+
+
+# DCT-scaled JPEG decode: (factor, imdecode flag), largest factor first
+_REDUCED = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+            (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+
+def fourccString(value):
+    """'MJPG' for the int value of CAP_PROP_FOURCC, '' if unset."""
+    value = int(value)
+    text = ''.join(chr((value >> (8 * i)) & 0xff) for i in range(4))
+    return text.strip('\x00 ') if value > 0 else ''
+
+
+class MjpegCapture(object):
+    ''' Camera in MJPG mode that hands out the JPEG data undecoded
+
+    read() returns (ok, buffer) of the encoded frame; decode() gives the
+    full BGR frame and decodeReduced() a DCT-scaled one at 1/2, 1/4 or
+    1/8 size, which skips most of the IDCT work. Use open() to get one,
+    it returns None when the backend decodes anyway.
+    '''
+    encoded = True
+
+    def __init__(self, cap):
+        self.cap = cap
+        self.decode_failed = 0
+
+    @classmethod
+    def open(cls, cap):
+        if not cap.set(cv2.CAP_PROP_CONVERT_RGB, 0):
+            return None
+        b, packet = cap.read()
+        if (b and packet is not None and packet.dtype == np.uint8 and
+                packet.size > 2 and packet.reshape(-1)[:2].tolist() ==
+                [0xff, 0xd8]):
+            return cls(cap)
+        cap.set(cv2.CAP_PROP_CONVERT_RGB, 1)
+        return None
+
+    def isOpened(self):
+        return self.cap.isOpened()
+
+    def set(self, prop, value):
+        return self.cap.set(prop, value)
+
+    def get(self, prop):
+        return self.cap.get(prop)
+
+    def grab(self):
+        return self.cap.grab()
+
+    def retrieve(self):
+        return self.cap.retrieve()
+
+    def read(self):
+        return self.cap.read()
+
+    def decode(self, packet):
+        frame = cv2.imdecode(packet.reshape(-1), cv2.IMREAD_COLOR)
+        if frame is None:
+            self.decode_failed += 1
+        return frame
+
+    def decodeReduced(self, packet, min_width):
+        """Smallest DCT-scaled decode at least min_width wide."""
+        width = self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)
+        for factor, flag in _REDUCED:
+            if width / factor >= min_width:
+                break
+        else:
+            flag = cv2.IMREAD_COLOR
+        frame = cv2.imdecode(packet.reshape(-1), flag)
+        if frame is None:
+            self.decode_failed += 1
+        return frame
+
+    def release(self):
+        self.cap.release()
+
+
+def negotiate(cap, width=None, height=None, fourcc=None, fps=None,
+              buffer_size=None):
+    """Ask a camera for a pixel format, size, rate and queue depth.
+
+    FOURCC goes first, V4L2 picks the sizes and rates on offer from it.
+    A camera may settle on other values, see captureInfo().
+    """
+    if fourcc:
+        cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*fourcc))
+    if width:
+        cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+    if height:
+        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+    if fps:
+        cap.set(cv2.CAP_PROP_FPS, fps)
+    if buffer_size:
+        # a short driver queue keeps latency at a frame or two
+        cap.set(cv2.CAP_PROP_BUFFERSIZE, buffer_size)
+
+
+def captureInfo(cap):
+    """Settings the capture actually runs with."""
+    info = {'width': int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            'height': int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+            'fps': round(cap.get(cv2.CAP_PROP_FPS) or 0, 2),
+            'fourcc': fourccString(cap.get(cv2.CAP_PROP_FOURCC) or 0),
+            'buffer_size': int(cap.get(cv2.CAP_PROP_BUFFERSIZE) or 0),
+            'encoded': getattr(cap, 'encoded', False)}
+    raw = getattr(cap, 'cap', cap)
+    if hasattr(raw, 'getBackendName'):
+        try:
+            info['backend'] = raw.getBackendName()
+        except cv2.error:
+            pass
+    return info
+
+
+def openCapture(source, width=None, height=None, loop=True, fourcc=None,
+                fps=None, buffer_size=None):
+    """Open a camera index, stream URL, video file or synthetic source.
+
+    Cameras negotiate fourcc ('MJPG', 'YUYV'), fps and buffer_size; an
+    MJPG camera whose backend can pass JPEG data through comes back as
+    an MjpegCapture.
+    """
+    if isinstance(source, str) and source.startswith('synthetic'):
+        return SyntheticCapture(source, width or 1280, height or 720,
+                                fps or 25.0)
+    if isinstance(source, str) and os.path.isfile(source):
+        return FileCapture(source, loop=loop)
+    cap = cv2.VideoCapture(source)
+    negotiate(cap, width, height, fourcc, fps, buffer_size)
+    if cap.isOpened() and fourccString(cap.get(cv2.CAP_PROP_FOURCC)) in (
+            'MJPG', 'mjpg'):
+        return MjpegCapture.open(cap) or cap
+    return cap
+
+
+default_streams = {
+    'layout': 'grid',
+    'streams': [{'source': 0, 'width': 1280, 'height': 720}],
+}
+
+
+def loadStreams(path=None):
+    """Read the camera config file, a JSON object like
+
+    {"layout": "grid" | "pip",
+     "streams": [{"name": "door", "source": 0, "width": 1280,
+                  "height": 720, "fourcc": "MJPG", "fps": 30,
+                  "buffer_size": 1, "detect": true},
+                 {"source": "rtsp://...", "detect": false},
+                 {"source": "lobby.mp4", "loop": true},
+                 {"source": "synthetic:640x480@15"}]}
+    """
+    config = default_streams
+    if path:
+        with open(path) as f:
+            config = json.load(f)
+    streams = []
+    for i, item in enumerate(config.get('streams', [])):
+        # only the settings the config gives are negotiated
+        stream = {'name': str(item.get('source', i)), 'width': None,
+                  'height': None, 'fourcc': None, 'fps': None,
+                  'buffer_size': None, 'loop': True, 'detect': None}
+        stream.update(item)
+        if stream['fourcc'] and len(stream['fourcc']) != 4:
+            raise ValueError('fourcc {!r} of stream {} is not 4 characters'
+                             .format(stream['fourcc'], stream['name']))
+        streams.append(stream)
+    if not streams:
+        raise ValueError('no streams in camera config {}'.format(path))
+    if all(s['detect'] is None for s in streams):
+        # detect on the first stream unless told otherwise
+        streams[0]['detect'] = True
+    for s in streams:
+        s['detect'] = bool(s['detect'])
+    layout = config.get('layout', 'grid')
+    if layout not in ('grid', 'pip'):
+        raise ValueError('unknown layout {}'.format(layout))
+    logger.info('streams: {}'.format(
+        ', '.join('{}{}'.format(s['name'], '*' if s['detect'] else '')
+                  for s in streams)))
+    return layout, streams
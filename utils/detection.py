@@ -0,0 +1,327 @@
+# -*- coding:utf-8 -*-
+import os
+import threading
+import itertools
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+from PyQt5.QtCore import *
+
+from utils.log import logger
+from utils.metrics import metrics, clock
+from utils.thumbnails import crop_thumbnail
+from utils.shmring import FrameWorkerPool
+
+
+class HaarFaceDetector(object):
+    ''' OpenCV Haar cascade face detector
+
+    Needs cv2.CascadeClassifier, which OpenCV 5 no longer ships in the
+    main modules; use OpenCV 4.x there or the 'yunet' / 'dnn' detector.
+    '''
+    default_cascade = 'haarcascade_frontalface_default.xml'
+
+    def __init__(self, cascade_path=None, scale_factor=1.1, min_neighbors=5,
+                 min_size=(30, 30)):
+        if not hasattr(cv2, 'CascadeClassifier'):
+            raise RuntimeError(
+                'OpenCV {} has no CascadeClassifier, the haar detector needs '
+                'OpenCV 4.x; use --detector yunet or dnn'.format(
+                    cv2.__version__))
+        if cascade_path is None:
+            cascade_path = os.path.join(
+                getattr(cv2, 'data', None) and cv2.data.haarcascades or '',
+                self.default_cascade)
+        self.classifier = cv2.CascadeClassifier(cascade_path)
+        if self.classifier.empty():
+            raise IOError('load haar cascade {} failed'.format(cascade_path))
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+        self.min_size = min_size
+
+    def detect(self, img):
+        if img.ndim == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        boxes = self.classifier.detectMultiScale(
+            img, scaleFactor=self.scale_factor,
+            minNeighbors=self.min_neighbors, minSize=self.min_size)
+        return [tuple(int(v) for v in box) for box in boxes]
+
+
+class DnnFaceDetector(object):
+    ''' OpenCV DNN (res10 SSD caffe model) face detector, OpenCV 4.x '''
+    def __init__(self, prototxt='models/deploy.prototxt',
+                 model='models/res10_300x300_ssd_iter_140000.caffemodel',
+                 confidence=0.5, input_size=(300, 300)):
+        if not hasattr(cv2.dnn, 'readNetFromCaffe'):
+            raise RuntimeError(
+                'OpenCV {} has no Caffe importer, the dnn detector needs '
+                'OpenCV 4.x; use --detector yunet'.format(cv2.__version__))
+        self.net = cv2.dnn.readNetFromCaffe(prototxt, model)
+        self.confidence = confidence
+        self.input_size = input_size
+
+    def detect(self, img):
+        h, w = img.shape[:2]
+        blob = cv2.dnn.blobFromImage(img, 1.0, self.input_size,
+                                     (104.0, 177.0, 123.0))
+        self.net.setInput(blob)
+        out = self.net.forward()
+        boxes = []
+        for det in out[0, 0]:
+            if det[2] < self.confidence:
+                continue
+            x0, y0 = max(0, int(det[3] * w)), max(0, int(det[4] * h))
+            x1, y1 = min(w, int(det[5] * w)), min(h, int(det[6] * h))
+            if x1 > x0 and y1 > y0:
+                boxes.append((x0, y0, x1 - x0, y1 - y0))
+        return boxes
+
+
+class YuNetFaceDetector(object):
+    ''' OpenCV FaceDetectorYN (YuNet ONNX model) face detector
+
+    Available from OpenCV 4.5.4 on, including 5.x.
+    '''
+    def __init__(self, model='models/face_detection_yunet_2023mar.onnx',
+                 confidence=0.6, nms_threshold=0.3, top_k=50):
+        if not hasattr(cv2, 'FaceDetectorYN'):
+            raise RuntimeError('OpenCV {} has no FaceDetectorYN'.format(
+                cv2.__version__))
+        if not os.path.isfile(model):
+            raise IOError('yunet model {} not found'.format(model))
+        self.net = cv2.FaceDetectorYN.create(model, '', (320, 320),
+                                             confidence, nms_threshold, top_k)
+        self.input_size = None
+
+    def detect(self, img):
+        h, w = img.shape[:2]
+        if self.input_size != (w, h):
+            self.net.setInputSize((w, h))
+            self.input_size = (w, h)
+        faces = self.net.detect(img)[1]
+        if faces is None:
+            return []
+        boxes = []
+        for det in faces:
+            x0, y0 = max(0, int(det[0])), max(0, int(det[1]))
+            x1, y1 = min(w, int(det[0] + det[2])), min(h, int(det[1] + det[3]))
+            if x1 > x0 and y1 > y0:
+                boxes.append((x0, y0, x1 - x0, y1 - y0))
+        return boxes
+
+
+detectors = {
+    'haar': HaarFaceDetector,
+    'dnn': DnnFaceDetector,
+    'yunet': YuNetFaceDetector,
+}
+
+
+def detect_frame(frame, detect_width=320):
+    """frame downscaled to detect_width in one INTER_AREA resize."""
+    h, w = frame.shape[:2]
+    if not detect_width or w <= detect_width:
+        return frame
+    return cv2.resize(frame, (detect_width, int(h * detect_width / float(w))),
+                      interpolation=cv2.INTER_AREA)
+
+
+def scale_boxes(boxes, scale):
+    return [(int(x / scale), int(y / scale), int(bw / scale), int(bh / scale))
+            for x, y, bw, bh in boxes]
+
+
+def detect_boxes(detector, frame, detect_width=320, small=None):
+    """Run detector on frame downscaled to detect_width, boxes in frame
+    coordinates. A `small` copy of frame made earlier (a DCT-scaled JPEG
+    decode) is used instead of resizing the full frame."""
+    roi = detect_frame(small if small is not None else frame, detect_width)
+    scale = roi.shape[1] / float(frame.shape[1])
+    return scale_boxes(detector.detect(roi), scale)
+
+
+class DetectTask(object):
+    ''' detect_boxes() in a FrameWorkerPool process '''
+    def __init__(self, detector_factory, detect_width=320):
+        self.detector = detector_factory()
+        self.detect_width = detect_width
+
+    def __call__(self, frame, meta):
+        return detect_boxes(self.detector, frame, self.detect_width)
+
+
+class DetectionPipeline(QObject):
+    ''' Runs a face detector on sampled frames in a worker pool
+
+    Frames are offered with submit() from the camera path. Only every
+    `every`-th frame of each stream is considered and it is dropped at
+    once when `max_pending` detections are already running, so detection
+    can never hold back the video. Results are delivered with the `detected` signal
+    as a list of dicts with 'box' (x, y, w, h in frame coordinates),
+    'crop' (BGR face crop), 'thumb' (THUMB_SIZE square BGR thumbnail,
+    with trackers only for the faces sent to verify, the only ones that
+    can arrive and be greeted) and 'text'. describe(face) may also set 'photo', the path of the
+    enrolled photo, which is used for the thumbnail through `thumbnails`
+    (a ThumbnailCache) when the face can't be cropped. Every face also
+    gets the 'stream' it was submitted with. With `trackers`, a callable
+    returning the FaceTracker of a stream (TrackingStage.tracker), every
+    result also passes that tracker's update() in the worker, which adds
+    'track_id' and 'verify'. Call
+    detector_factory() once beforehand (off the GUI thread) to fail
+    early on a missing model.
+
+    With pool='process' the detector runs in `workers` processes fed
+    through a shared memory FrameRing (utils.shmring), which sidesteps
+    the GIL; detector_factory must then be picklable (a class or a
+    module level function). Only the detect_width frame goes through the
+    ring; crops, thumbnails and tracking stay in this process.
+    '''
+    detected = pyqtSignal(object)
+
+    def __init__(self, detector_factory, every=5, detect_width=320,
+                 workers=2, max_pending=2, describe=None, thumbnails=None,
+                 trackers=None, pool='thread', parent=None):
+        super(DetectionPipeline, self).__init__(parent)
+        self.detector_factory = detector_factory
+        self.every = max(1, every)
+        self.detect_width = detect_width
+        self.max_pending = max_pending
+        self.describe = describe or (lambda face: '访客')
+        self.thumbnails = thumbnails
+        self.trackers = trackers
+        self._frames = None
+        self._inflight = {}
+        self._keys = itertools.count()
+        if pool == 'process':
+            # detect frames are at most detect_width wide, a square ring
+            # fits landscape cameras of any aspect without a rebuild
+            self._frames = FrameWorkerPool(
+                partial(DetectTask, detector_factory, detect_width),
+                workers=workers, callback=self._onBoxes,
+                max_shape=((detect_width, detect_width, 3)
+                           if detect_width else None))
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        # cv2 detectors are not thread safe, one instance per worker
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pending = 0
+        # frames offered per stream, each camera is sampled on its own
+        self._counts = {}
+        self.submitted = 0
+        self.skipped = 0
+        self.dropped = 0
+        self.faces = 0
+        self.hist = metrics.histogram('detection')
+
+    def detector(self):
+        det = getattr(self._local, 'detector', None)
+        if det is None:
+            det = self._local.detector = self.detector_factory()
+        return det
+
+    def submit(self, frame, small=None, stream=None):
+        """Offer a frame, return True if it was queued for detection.
+
+        small is an optional reduced copy of frame to detect on, stream
+        the key of the camera it comes from.
+        """
+        count = self._counts[stream] = self._counts.get(stream, 0) + 1
+        if count % self.every:
+            self.skipped += 1
+            return False
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.dropped += 1
+                return False
+            self._pending += 1
+        stamp = clock()
+        if self._frames is not None:
+            key = next(self._keys)
+            self._inflight[key] = (frame, stamp, stream)
+            small = detect_frame(small if small is not None else frame,
+                                 self.detect_width)
+            if not self._frames.submit(small, (key, small.shape[1])):
+                del self._inflight[key]
+                with self._lock:
+                    self._pending -= 1
+                    self.dropped += 1
+                return False
+        else:
+            self._pool.submit(self._run, frame, stamp, small=small,
+                              stream=stream)
+        self.submitted += 1
+        return True
+
+    def _run(self, frame, stamp, boxes=None, error=None, small=None,
+             stream=None):
+        t0 = clock() if boxes is None else stamp
+        faces = []
+        try:
+            if error is not None:
+                raise RuntimeError(error)
+            if boxes is None:
+                boxes = detect_boxes(self.detector(), frame,
+                                     self.detect_width, small)
+            faces = self.buildFaces(frame, boxes, thumbs=False)
+            for face in faces:
+                face['stream'] = stream
+            if self.trackers is not None:
+                self.trackers(stream).update(faces, frame, stamp)
+            for face in faces:
+                if self.trackers is None or face['verify']:
+                    self.addThumbnail(frame, face)
+            self.hist.record(clock() - t0)
+        except Exception as e:
+            logger.error('face detection failed: {}'.format(e))
+            faces = []
+        finally:
+            with self._lock:
+                self._pending -= 1
+                self.faces += len(faces)
+        if faces:
+            self.detected.emit(faces)
+
+    def _onBoxes(self, meta, boxes, error):
+        """FrameWorkerPool callback, runs on its collector thread."""
+        key, width = meta
+        frame, stamp, stream = self._inflight.pop(key)
+        # the workers saw the small frame
+        boxes = scale_boxes(boxes or [], width / float(frame.shape[1]))
+        self._run(frame, stamp, boxes, error, stream=stream)
+
+    def detectFaces(self, frame):
+        return self.buildFaces(
+            frame, detect_boxes(self.detector(), frame, self.detect_width))
+
+    def buildFaces(self, frame, boxes, thumbs=True):
+        faces = []
+        for box in boxes:
+            x0, y0 = max(0, box[0]), max(0, box[1])
+            crop = frame[y0:y0 + box[3], x0:x0 + box[2]].copy()
+            face = {'box': box, 'crop': crop, 'thumb': None}
+            face['text'] = self.describe(face)
+            if thumbs:
+                self.addThumbnail(frame, face)
+            faces.append(face)
+        return faces
+
+    def addThumbnail(self, frame, face):
+        face['thumb'] = crop_thumbnail(frame, face['box'])
+        if (face['thumb'] is None and face.get('photo')
+                and self.thumbnails is not None):
+            face['thumb'] = self.thumbnails.photo(face['photo'])
+
+    def stats(self):
+        stats = {'submitted': self.submitted, 'skipped': self.skipped,
+                 'dropped': self.dropped, 'faces': self.faces}
+        if self._frames is not None:
+            stats['workers'] = self._frames.stats()
+        return stats
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True)
+        if self._frames is not None:
+            self._frames.close()
@@ -0,0 +1,165 @@
+# -*- coding:utf-8 -*-
+import os
+
+import numpy as np
+
+from utils.log import logger
+
+
+def l2_normalize(x, axis=-1, eps=1e-12):
+    x = np.asarray(x, dtype=np.float32)
+    n = np.linalg.norm(x, axis=axis, keepdims=True)
+    return x / np.maximum(n, eps)
+
+
+def topk(scores, k):
+    """Indices and values of the k largest scores along the last axis."""
+    k = min(k, scores.shape[-1])
+    if k <= 0:
+        shape = scores.shape[:-1] + (0,)
+        return np.empty(shape, np.int64), np.empty(shape, scores.dtype)
+    if k < scores.shape[-1]:
+        idx = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    else:
+        idx = np.broadcast_to(np.arange(scores.shape[-1]), scores.shape)
+    part = np.take_along_axis(scores, idx, axis=-1)
+    order = np.argsort(-part, axis=-1)
+    return (np.take_along_axis(idx, order, axis=-1),
+            np.take_along_axis(part, order, axis=-1))
+
+
+class FaceGallery(object):
+    ''' Exact cosine search over enrolled face embeddings
+
+    Embeddings are L2 normalized on enroll and kept in one contiguous
+    float32 matrix, so a probe (or a batch of probes) is scored against
+    the whole gallery with a single matrix multiply. Rows grow by
+    doubling and removal swaps the last row into the hole, so neither
+    needs a rebuild.
+    '''
+    def __init__(self, dim, capacity=1024):
+        self.dim = dim
+        self._data = np.zeros((max(1, capacity), dim), np.float32)
+        self._ids = []
+        self._rows = {}
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, person_id):
+        return person_id in self._rows
+
+    @property
+    def ids(self):
+        return list(self._ids)
+
+    @property
+    def embeddings(self):
+        """Normalized embeddings of the enrolled ids, in ids order."""
+        return self._data[:len(self._ids)]
+
+    def _writable(self, rows):
+        if rows > self._data.shape[0]:
+            capacity = max(rows, self._data.shape[0] * 2)
+            data = np.zeros((capacity, self.dim), np.float32)
+            data[:len(self._ids)] = self._data[:len(self._ids)]
+            self._data = data
+        elif not self._data.flags.writeable:
+            # memory mapped read only, copy on first change
+            self._data = np.array(self._data)
+
+    def enroll(self, person_id, embedding):
+        """Add or replace the embedding of person_id."""
+        vec = l2_normalize(np.reshape(embedding, (self.dim,)))
+        row = self._rows.get(person_id)
+        if row is None:
+            row = len(self._ids)
+            self._writable(row + 1)
+            self._ids.append(person_id)
+            self._rows[person_id] = row
+        else:
+            self._writable(row + 1)
+        self._data[row] = vec
+
+    def enroll_batch(self, person_ids, embeddings):
+        for person_id, embedding in zip(person_ids, embeddings):
+            self.enroll(person_id, embedding)
+
+    def remove(self, person_id):
+        row = self._rows.pop(person_id, None)
+        if row is None:
+            return False
+        self._writable(len(self._ids))
+        last = len(self._ids) - 1
+        if row != last:
+            moved = self._ids[last]
+            self._data[row] = self._data[last]
+            self._ids[row] = moved
+            self._rows[moved] = row
+        self._ids.pop()
+        return True
+
+    def search_batch(self, probes, k=5):
+        """Top-k (id, score) lists for each probe of an N x dim array."""
+        probes = l2_normalize(np.reshape(probes, (-1, self.dim)))
+        if not self._ids:
+            return [[] for _ in range(len(probes))]
+        scores = probes.dot(self.embeddings.T)
+        idx, vals = topk(scores, k)
+        return [[(self._ids[i], float(v)) for i, v in zip(row_i, row_v)]
+                for row_i, row_v in zip(idx, vals)]
+
+    def search(self, probe, k=5):
+        return self.search_batch(probe, k)[0]
+
+    def match(self, probe, threshold=0.5):
+        """Best matching id of probe or None below threshold."""
+        best = self.search(probe, 1)
+        if best and best[0][1] >= threshold:
+            return best[0]
+        return None
+
+    def save(self, prefix):
+        """Write <prefix>.npy (embeddings) and <prefix>_ids.npy.
+
+        Each file is written next to the old one and moved over it, so a
+        gallery memory mapped from prefix can be saved back to it and a
+        crash never leaves a truncated file.
+        """
+        for path, data in ((prefix + '.npy', self.embeddings),
+                           (prefix + '_ids.npy',
+                            np.array(self._ids, dtype=str))):
+            tmp = path + '.tmp'
+            with open(tmp, 'wb') as f:
+                np.save(f, data)
+            os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, prefix, mmap=True):
+        data = np.load(prefix + '.npy', mmap_mode='r' if mmap else None)
+        ids = np.load(prefix + '_ids.npy').tolist()
+        if len(ids) != len(data):
+            raise ValueError('gallery {} has {} ids for {} embeddings'.format(
+                prefix, len(ids), len(data)))
+        gallery = cls(data.shape[1], capacity=1)
+        gallery._data = data
+        gallery._ids = ids
+        gallery._rows = dict((pid, i) for i, pid in enumerate(ids))
+        logger.info('load gallery {}: {} faces'.format(prefix, len(ids)))
+        return gallery
+
+    @classmethod
+    def open(cls, prefix, dim, mmap=True):
+        """Load prefix if it exists, otherwise return an empty gallery.
+
+        Raises ValueError when the stored embeddings are not dim wide,
+        the gallery was enrolled with another model.
+        """
+        if os.path.exists(prefix + '.npy'):
+            gallery = cls.load(prefix, mmap=mmap)
+            if gallery.dim != dim:
+                raise ValueError(
+                    'gallery {} holds {}-d embeddings, the recognizer makes '
+                    '{}-d ones'.format(prefix, gallery.dim, dim))
+            return gallery
+        return cls(dim)
@@ -0,0 +1,115 @@
+# -*- coding:utf-8 -*-
+import heapq
+import itertools
+import time
+from collections import deque
+
+
+class GreetingScheduler(object):
+    ''' Orders pending visitor greetings
+
+    Sightings of the same person within `dedup_window` seconds collapse
+    into one greeting (the pending entry keeps the newest crop). Pending
+    greetings are served VIP first, then first visit today, then most
+    recent sighting; ones older than `max_wait` are dropped because the
+    visitor has most likely walked past. holdTime() shortens as the
+    backlog grows so a busy entrance is still greeted.
+    '''
+    def __init__(self, dedup_window=30.0, max_wait=10.0, hold=1.5,
+                 min_hold=0.4, cooldown=1.0, backlog_scale=2.0,
+                 latency_samples=256, clock=time.monotonic):
+        self.dedup_window = dedup_window
+        self.max_wait = max_wait
+        self.hold = hold
+        self.min_hold = min_hold
+        self.cooldown = cooldown
+        self.backlog_scale = backlog_scale
+        self.clock = clock
+        self._heap = []
+        self._order = itertools.count()
+        self._pending = {}
+        self._greeted = {}
+        self._latency = deque(maxlen=latency_samples)
+        self.offered = 0
+        self.deduped = 0
+        self.expired = 0
+        self.greeted = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def offer(self, person_id, text, image=None, vip=False,
+              first_today=False):
+        """Queue a greeting, return False if it merged into an earlier one."""
+        now = self.clock()
+        self.offered += 1
+        last = self._greeted.get(person_id)
+        if last is not None and now - last < self.dedup_window:
+            self.deduped += 1
+            return False
+        entry = self._pending.get(person_id)
+        if entry is not None:
+            entry['text'] = text
+            entry['image'] = image
+            entry['seen'] = now
+            entry['vip'] = entry['vip'] or vip
+            # the stale heap item is skipped in pop()
+            self._push(entry)
+            self.deduped += 1
+            return False
+        entry = {'person_id': person_id, 'text': text, 'image': image,
+                 'vip': vip, 'first_today': first_today,
+                 'arrived': now, 'seen': now}
+        self._pending[person_id] = entry
+        self._push(entry)
+        return True
+
+    def _push(self, entry):
+        heapq.heappush(self._heap, (-int(entry['vip']),
+                                    -int(entry['first_today']),
+                                    -entry['seen'], next(self._order), entry))
+
+    def pop(self):
+        """Next greeting to show or None."""
+        now = self.clock()
+        while self._heap:
+            item = heapq.heappop(self._heap)
+            entry = item[-1]
+            if (self._pending.get(entry['person_id']) is not entry or
+                    -item[2] != entry['seen']):
+                continue
+            del self._pending[entry['person_id']]
+            if now - entry['seen'] > self.max_wait:
+                self.expired += 1
+                continue
+            self._greeted[entry['person_id']] = now
+            self._latency.append(now - entry['arrived'])
+            self.greeted += 1
+            self._forget(now)
+            return entry
+        return None
+
+    def _forget(self, now):
+        if len(self._greeted) > 1024:
+            self._greeted = dict(
+                (k, t) for k, t in self._greeted.items()
+                if now - t < self.dedup_window)
+
+    def holdTime(self):
+        """Seconds to keep a greeting on screen for the current backlog."""
+        factor = 1.0 + len(self._pending) / float(self.backlog_scale)
+        return max(self.min_hold, self.hold / factor)
+
+    def cooldownTime(self):
+        return 0.0 if self._pending else self.cooldown
+
+    def stats(self):
+        latency = sorted(self._latency)
+        n = len(latency)
+        return {
+            'depth': len(self._pending), 'offered': self.offered,
+            'deduped': self.deduped, 'expired': self.expired,
+            'greeted': self.greeted,
+            'latency_p50': latency[n // 2] if n else None,
+            'latency_max': latency[-1] if n else None,
+        }
@@ -1,38 +1,151 @@
 # -*- coding:utf-8 -*-
+import json
+import queue
+import atexit
 import logging
-import copy
+import logging.handlers
 
 
 class ColoredConsoleHandler(logging.StreamHandler):
-    def emit(self, record):
-        # Need to make a actual copy of the record
-        # to prevent altering the message for other loggers
-        myrecord = copy.copy(record)
-        levelno = myrecord.levelno
-        if levelno >= 50:  # CRITICAL / FATAL
-            color = '\x1b[31m'  # red
-        elif levelno >= 40:  # ERROR
-            color = '\x1b[31m'  # red
-        elif levelno >= 30:  # WARNING
-            color = '\x1b[33m'  # yellow
-        elif levelno >= 20:  # INFO
-            color = '\x1b[32m'  # green
-        elif levelno >= 10:  # DEBUG
-            color = '\x1b[35m'  # pink
-        else:  # NOTSET and anything else
-            color = '\x1b[0m'  # normal
-        myrecord.msg = color + str(myrecord.msg) + '\x1b[0m'  # normal
-        logging.StreamHandler.emit(self, myrecord)
+    colors = (
+        (50, '\x1b[31m'),  # CRITICAL / FATAL red
+        (40, '\x1b[31m'),  # ERROR red
+        (30, '\x1b[33m'),  # WARNING yellow
+        (20, '\x1b[32m'),  # INFO green
+        (10, '\x1b[35m'),  # DEBUG pink
+    )
+
+    def format(self, record):
+        # color the formatted line instead of a copy of the record
+        text = logging.StreamHandler.format(self, record)
+        for levelno, color in self.colors:
+            if record.levelno >= levelno:
+                return color + text + '\x1b[0m'
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    ''' One JSON object per line '''
+    def format(self, record):
+        entry = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'file': record.filename,
+            'line': record.lineno,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class RateLimitFilter(logging.Filter):
+    ''' Token bucket per logger and call site
+
+    Each call site may log `burst` records at once and `rate` per second
+    after that. The next record let through after a flood says how many
+    were suppressed.
+    '''
+    def __init__(self, rate=10.0, burst=20):
+        super(RateLimitFilter, self).__init__()
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        self.suppressed = 0
+
+    def filter(self, record):
+        key = (record.name, record.pathname, record.lineno)
+        now = record.created
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [self.burst, now, 0]
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            bucket[2] += 1
+            self.suppressed += 1
+            return False
+        bucket[0] = tokens - 1
+        if bucket[2]:
+            record.msg = '{} ({} similar suppressed)'.format(
+                record.getMessage(), bucket[2])
+            record.args = None
+            bucket[2] = 0
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    ''' Enqueues records as they are, dropping them when the queue is full
+
+    The stock prepare() formats the message on the calling thread; here
+    all formatting is left to the listener thread.
+    '''
+    def __init__(self, q, max_size=10000):
+        super(NonBlockingQueueHandler, self).__init__(q)
+        self.max_size = max_size
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        # SimpleQueue has no bound but a lock-free put
+        if self.queue.qsize() >= self.max_size:
+            self.dropped += 1
+        else:
+            self.queue.put_nowait(record)
+
 
 logger = logging.getLogger('face_demo')
 
 if not logging.root.handlers and logger.level == logging.NOTSET:
     logger.setLevel(logging.INFO)
 
-handler = ColoredConsoleHandler()
 fmt = "[%(asctime)-15s] %(levelname)s %(filename)s:%(lineno)d - %(message)s"
 datefmt = "%a %d %b %Y %H:%M:%S"
 formatter = logging.Formatter(fmt, datefmt)
+
+handler = ColoredConsoleHandler()
 handler.setFormatter(formatter)
-logger.addHandler(handler)
 
+# the logging thread only enqueues, console and file handlers run on the
+# listener thread
+log_queue = queue.SimpleQueue()
+rate_limit = RateLimitFilter()
+queue_handler = NonBlockingQueueHandler(log_queue)
+queue_handler.addFilter(rate_limit)
+logger.addHandler(queue_handler)
+listener = logging.handlers.QueueListener(log_queue, handler,
+                                          respect_handler_level=True)
+listener.start()
+atexit.register(listener.stop)
+
+
+def addHandler(h):
+    """Run another handler on the listener thread."""
+    listener.handlers = listener.handlers + (h,)
+    return h
+
+
+def addFileSink(path, max_bytes=10 << 20, backups=5, json_lines=False,
+                level=logging.NOTSET):
+    """Log to path, rotated at max_bytes, as text or JSON lines."""
+    sink = logging.handlers.RotatingFileHandler(
+        path, maxBytes=max_bytes, backupCount=backups, encoding='utf-8')
+    sink.setFormatter(JsonFormatter() if json_lines else formatter)
+    sink.setLevel(level)
+    return addHandler(sink)
+
+
+def flush():
+    """Wait until the queued records are written."""
+    listener.stop()
+    listener.start()
+
+
+def stats():
+    return {'queued': log_queue.qsize(), 'dropped': queue_handler.dropped,
+            'suppressed': rate_limit.suppressed}
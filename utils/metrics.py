@@ -0,0 +1,152 @@
+# -*- coding:utf-8 -*-
+import os
+import json
+import time
+import threading
+from array import array
+
+import numpy as np
+
+
+clock = time.perf_counter
+
+
+class Histogram(object):
+    ''' Latency samples (seconds) in a preallocated ring buffer
+
+    record() is a couple of attribute stores so it stays well under a
+    microsecond. Concurrent writers may overwrite each other's slot, which
+    loses a sample but never blocks.
+    '''
+    __slots__ = ('name', 'size', 'count', '_buf', '_i')
+
+    def __init__(self, name, size=2048):
+        self.name = name
+        self.size = size
+        self.count = 0
+        self._buf = array('d', bytes(8 * size))
+        self._i = 0
+
+    def record(self, value):
+        i = self._i
+        self._buf[i] = value
+        self._i = 0 if i + 1 == self.size else i + 1
+        self.count += 1
+
+    def samples(self):
+        n = min(self.count, self.size)
+        return np.frombuffer(self._buf, np.float64)[:n].copy()
+
+    def summary(self):
+        data = self.samples()
+        if not len(data):
+            return {'count': self.count}
+        p50, p95, p99 = np.percentile(data, (50, 95, 99)) * 1000
+        return {'count': self.count, 'mean_ms': float(data.mean() * 1000),
+                'p50_ms': float(p50), 'p95_ms': float(p95),
+                'p99_ms': float(p99), 'max_ms': float(data.max() * 1000)}
+
+
+class RateMeter(object):
+    ''' Events per second over the last `size` event timestamps '''
+    __slots__ = ('name', 'size', 'count', '_buf', '_i')
+
+    def __init__(self, name, size=128):
+        self.name = name
+        self.size = size
+        self.count = 0
+        self._buf = array('d', bytes(8 * size))
+        self._i = 0
+
+    def tick(self, now=None):
+        i = self._i
+        self._buf[i] = clock() if now is None else now
+        self._i = 0 if i + 1 == self.size else i + 1
+        self.count += 1
+
+    def rate(self):
+        n = min(self.count, self.size)
+        if n < 2:
+            return 0.0
+        oldest = self._buf[self._i if n == self.size else 0]
+        # measured up to now, so a stalled stream decays towards 0
+        span = clock() - oldest
+        return (n - 1) / span if span > 0 else 0.0
+
+
+class Metrics(object):
+    ''' Registry of the frame pipeline's histograms, rates and counters
+
+    Stages used by the app: capture (retrieving and decoding a frame,
+    not waiting for it), convert, paint, detection, recognition. Rates:
+    display. Counters: dropped.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}
+        self.rates = {}
+        self.sources = {}
+
+    def histogram(self, name):
+        hist = self.histograms.get(name)
+        if hist is None:
+            with self._lock:
+                hist = self.histograms.setdefault(name, Histogram(name))
+        return hist
+
+    def rate(self, name):
+        meter = self.rates.get(name)
+        if meter is None:
+            with self._lock:
+                meter = self.rates.setdefault(name, RateMeter(name))
+        return meter
+
+    def record(self, name, seconds):
+        """Record one sample, hot paths should keep histogram(name)."""
+        self.histogram(name).record(seconds)
+
+    def tick(self, name):
+        self.rate(name).tick()
+
+    def setCounter(self, name, fn):
+        """Report fn() under counters[name], e.g. frames dropped."""
+        self.sources[name] = fn
+
+    def report(self):
+        return {
+            'time': time.time(),
+            'stages': dict((n, h.summary())
+                           for n, h in sorted(self.histograms.items())),
+            'fps': dict((n, round(r.rate(), 2))
+                        for n, r in sorted(self.rates.items())),
+            'counters': dict((n, fn()) for n, fn in self.sources.items()),
+        }
+
+    def formatText(self):
+        report = self.report()
+        lines = ['{:<11s}{:>7s}{:>7s}{:>7s}'.format('stage ms', 'p50',
+                                                   'p95', 'p99')]
+        for name, s in report['stages'].items():
+            if 'p50_ms' in s:
+                lines.append('{:<11s}{:7.1f}{:7.1f}{:7.1f}'.format(
+                    name, s['p50_ms'], s['p95_ms'], s['p99_ms']))
+        for name, fps in report['fps'].items():
+            lines.append('{} fps: {:.1f}'.format(name, fps))
+        for name, value in report['counters'].items():
+            lines.append('{}: {}'.format(name, value))
+        return '\n'.join(lines)
+
+    def dump(self, path):
+        """Write report() as JSON, atomically replacing path."""
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.report(), f)
+        os.replace(tmp, path)
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+            self.rates.clear()
+
+
+metrics = Metrics()
@@ -0,0 +1,118 @@
+# -*- coding:utf-8 -*-
+import time
+
+import numpy as np
+
+from utils.metrics import clock
+
+
+class MotionGate(object):
+    ''' Cheap scene change test on a strided thumbnail of each frame
+
+    update() samples about `width` columns of the frame with plain array
+    striding (no resize), sums the channels and compares the result with
+    a running average of the scene. A frame moves when more than
+    `min_fraction` of the samples differ by over `pixel_threshold` grey
+    levels. The gate turns idle after `idle_after` seconds without motion
+    and active again on the first moving frame. Frames decoded another
+    way (a DCT-scaled JPEG decode against a full one) never compare
+    equal; update() them with a different `source` and the first frame of
+    a new source only reseeds the background.
+    '''
+    def __init__(self, width=64, pixel_threshold=20, min_fraction=0.01,
+                 idle_after=30.0, alpha=0.05, clock=clock):
+        self.width = width
+        self.pixel_threshold = pixel_threshold
+        self.min_fraction = min_fraction
+        self.idle_after = idle_after
+        self.alpha = alpha
+        self.clock = clock
+        self._background = None
+        self._source = None
+        self.last_motion = clock()
+        self.idle = False
+        self.frames = 0
+        self.moving = 0
+
+    def update(self, frame, source=None):
+        """Return True if frame differs from the recent scene."""
+        step = max(1, frame.shape[1] // self.width)
+        small = frame[::step, ::step]
+        if small.ndim == 3:
+            # channel sum, no need for true luma weights here
+            small = small.sum(axis=2, dtype=np.float32)
+            channels = frame.shape[2]
+        else:
+            small = small.astype(np.float32)
+            channels = 1
+        self.frames += 1
+        now = self.clock()
+        background = self._background
+        if background is None:
+            self._background = small
+            moving = True
+        elif source != self._source:
+            self._background = small
+            moving = False
+        elif background.shape != small.shape:
+            self._background = small
+            moving = True
+        else:
+            diff = np.abs(small - background)
+            changed = np.count_nonzero(
+                diff > self.pixel_threshold * channels)
+            moving = changed > self.min_fraction * diff.size
+            # let slow light changes and parked objects fade in
+            background += self.alpha * (small - background)
+        self._source = source
+        if moving:
+            self.moving += 1
+            self.last_motion = now
+            self.idle = False
+        elif not self.idle and now - self.last_motion > self.idle_after:
+            self.idle = True
+        return moving
+
+    def stats(self):
+        return {'frames': self.frames, 'moving': self.moving,
+                'idle': self.idle}
+
+
+class PowerMeter(object):
+    ''' Process CPU time spent in the active and the idle mode '''
+    def __init__(self):
+        self.idle = False
+        self.wall = {False: 0.0, True: 0.0}
+        self.cpu = {False: 0.0, True: 0.0}
+        self._wall0 = clock()
+        self._cpu0 = time.process_time()
+
+    def _accumulate(self):
+        wall, cpu = clock(), time.process_time()
+        self.wall[self.idle] += wall - self._wall0
+        self.cpu[self.idle] += cpu - self._cpu0
+        self._wall0, self._cpu0 = wall, cpu
+
+    def setIdle(self, idle):
+        if idle != self.idle:
+            self._accumulate()
+            self.idle = idle
+
+    def stats(self):
+        self._accumulate()
+        load = dict((mode, self.cpu[mode] / self.wall[mode]
+                     if self.wall[mode] > 0 else None)
+                    for mode in (False, True))
+        saved = None
+        if load[False] and load[True] is not None:
+            saved = round(100 * (1 - load[True] / load[False]), 1)
+        return {
+            'idle': self.idle,
+            'active_s': round(self.wall[False], 1),
+            'idle_s': round(self.wall[True], 1),
+            'cpu_active_pct': (round(100 * load[False], 1)
+                               if load[False] is not None else None),
+            'cpu_idle_pct': (round(100 * load[True], 1)
+                             if load[True] is not None else None),
+            'cpu_saved_pct': saved,
+        }
@@ -0,0 +1,286 @@
+# -*- coding:utf-8 -*-
+import os
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import cv2
+
+from utils.log import logger
+from utils.metrics import Histogram, clock
+from utils.utils import FrameConverter
+from utils.motion import MotionGate
+from utils.tracker import FaceTracker
+from utils.detection import detectors, detect_boxes
+from utils.recognition import embedders
+from utils.gallery import FaceGallery
+
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mkv', '.mov', '.m4v', '.ts', '.webm')
+STAGES = ('decode', 'convert', 'detection', 'recognition')
+
+
+def list_videos(path):
+    """path itself or the video files in directory path, sorted."""
+    if os.path.isfile(path):
+        return [path]
+    return sorted(os.path.join(path, name) for name in os.listdir(path)
+                  if name.lower().endswith(VIDEO_EXTENSIONS))
+
+
+def plan_chunks(videos, chunk_seconds=60.0):
+    """Split the videos into (path, index, first, last frame, fps) tasks."""
+    tasks = []
+    for path in videos:
+        cap = cv2.VideoCapture(path)
+        if not cap.isOpened():
+            logger.warning('cannot open {}'.format(path))
+            continue
+        fps = cap.get(cv2.CAP_PROP_FPS) or 25.0
+        frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        cap.release()
+        if frames <= 0:
+            logger.warning('{} has no frame count, skipped'.format(path))
+            continue
+        step = max(1, int(chunk_seconds * fps))
+        for i, first in enumerate(range(0, frames, step)):
+            tasks.append((path, i, first, min(frames, first + step), fps))
+    return tasks
+
+
+class ChunkWorker(object):
+    ''' The per-frame part of the pipeline for one process '''
+    def __init__(self, options):
+        self.options = options
+        self.detector = None
+        if options['detector'] in detectors:
+            self.detector = detectors[options['detector']]()
+        self.embedder = None
+        self.gallery = None
+        if options['recognizer'] in embedders:
+            self.embedder = embedders[options['recognizer']]()
+            if options['gallery']:
+                self.gallery = FaceGallery.open(
+                    options['gallery'], getattr(self.embedder, 'dim', 128))
+
+    def run(self, task):
+        path, index, first, last, fps = task
+        opts = self.options
+        hists = dict((name, Histogram(name, size=1 << 16))
+                     for name in STAGES)
+        video_now = [first / fps]
+        # unknown visitors of different chunks are different tracks
+        tracker = FaceTracker(clock=lambda: video_now[0], name='{}#{}'.format(
+            os.path.basename(path), index))
+        gate = MotionGate(clock=lambda: video_now[0])
+        converter = FrameConverter()
+        pending, events = [], []
+        sampled = still = 0
+        t_start = clock()
+        cap = cv2.VideoCapture(path)
+        if first:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, first)
+        n = first
+        while n < last:
+            t0 = clock()
+            take = (n - first) % opts['detect_every'] == 0
+            # grab() skips the colour conversion of unsampled frames
+            ok = cap.grab()
+            frame = cap.retrieve()[1] if ok and take else None
+            hists['decode'].record(clock() - t0)
+            if not ok:
+                break
+            video_now[0] = n / fps
+            n += 1
+            if frame is None:
+                continue
+            sampled += 1
+            if opts['motion'] and not gate.update(frame):
+                still += 1
+                continue
+            if opts['convert']:
+                t0 = clock()
+                converter(frame)
+                hists['convert'].record(clock() - t0)
+            if self.detector is None:
+                continue
+            t0 = clock()
+            faces = []
+            for box in detect_boxes(self.detector, frame,
+                                    opts['detect_width']):
+                x0, y0 = max(0, box[0]), max(0, box[1])
+                faces.append({'box': box, 'text': '访客',
+                              'crop': frame[y0:y0 + box[3],
+                                            x0:x0 + box[2]].copy()})
+            tracker.update(faces, frame)
+            hists['detection'].record(clock() - t0)
+            for face in faces:
+                if face['verify'] and face['crop'].size:
+                    face['seen'] = video_now[0]
+                    pending.append(face)
+            # micro-batches in video time, like RecognitionPipeline
+            if (len(pending) >= opts['batch'] or pending and
+                    video_now[0] - pending[0]['seen'] >= opts['delay']):
+                events += self.identify(tracker, pending, hists)
+                pending = []
+        if pending:
+            events += self.identify(tracker, pending, hists)
+        cap.release()
+        return {'path': path, 'index': index, 'frames': n - first,
+                'sampled': sampled, 'still': still, 'events': events,
+                'seconds': (n - first) / fps, 'wall': clock() - t_start,
+                'stages': dict((name, h.samples().tolist())
+                               for name, h in hists.items())}
+
+    def identify(self, tracker, faces, hists):
+        """Recognize faces in one batch, return (t, id, name, score) of
+        the tracks that arrived."""
+        if self.embedder is not None:
+            t0 = clock()
+            embeddings = self.embedder.embed([f['crop'] for f in faces])
+            if self.gallery is not None and len(self.gallery):
+                results = self.gallery.search_batch(embeddings, 1)
+                for face, best in zip(faces, results):
+                    if best and best[0][1] >= self.options['threshold']:
+                        face['person_id'], face['score'] = best[0]
+                        face['text'] = face['person_id']
+            hists['recognition'].record(clock() - t0)
+        return [(face['seen'], face.get('person_id') or face['text'],
+                 face['text'], face.get('score'))
+                for face in tracker.identify(faces)]
+
+
+_worker = None
+
+
+def _init_worker(options):
+    global _worker
+    # one OpenCV thread per process, the pool already uses every core
+    cv2.setNumThreads(1)
+    _worker = ChunkWorker(options)
+
+
+def _run_chunk(task):
+    return _worker.run(task)
+
+
+def merge_events(results, starts, merge_window=60.0):
+    """Visits in time order. A person seen again within merge_window
+    seconds of their last visit, also across a chunk boundary where the
+    track restarts, is the same visit."""
+    events = []
+    for res in results:
+        start = starts[res['path']]
+        events += [(start + t, pid, name, score)
+                   for t, pid, name, score in res['events']]
+    events.sort(key=lambda e: e[0])
+    last, visits = {}, []
+    for event in events:
+        stamp, person_id = event[0], event[1]
+        if person_id in last and stamp - last[person_id] < merge_window:
+            continue
+        last[person_id] = stamp
+        visits.append(event)
+    return visits
+
+
+def start_time(path):
+    """Recording start as epoch seconds: mtime minus the duration."""
+    cap = cv2.VideoCapture(path)
+    fps = cap.get(cv2.CAP_PROP_FPS) or 25.0
+    duration = cap.get(cv2.CAP_PROP_FRAME_COUNT) / fps
+    cap.release()
+    return os.path.getmtime(path) - duration
+
+
+def run(source, visit_log=None, report=None, jobs=None, chunk_seconds=60.0,
+        detector='haar', detect_every=5, detect_width=320, recognizer='none',
+        gallery=None, batch=8, delay=0.5, threshold=0.5, motion=True,
+        convert=True, start=None, merge_window=60.0):
+    """Run the pipeline over recorded video without a display.
+
+    Chunks of `chunk_seconds` are decoded and processed in `jobs`
+    processes; every frame is grabbed but only every `detect_every`th is
+    decoded to pixels. `start` is the epoch of the first frame, by default
+    the file mtime minus its duration. Returns the report dict, also
+    written as JSON to `report`; the merged visits go to the `visit_log`
+    SQLite file. The detector and recognizer are built once here first,
+    so a missing model raises before any chunk runs.
+    """
+    videos = list_videos(source)
+    if not videos:
+        raise ValueError('no video in {}'.format(source))
+    tasks = plan_chunks(videos, chunk_seconds)
+    jobs = jobs or os.cpu_count() or 1
+    options = {'detector': detector, 'detect_every': max(1, detect_every),
+               'detect_width': detect_width, 'recognizer': recognizer,
+               'gallery': gallery, 'batch': batch, 'delay': delay,
+               'threshold': threshold,
+               'motion': motion, 'convert': convert}
+    logger.info('offline: {} videos, {} chunks, {} jobs'.format(
+        len(videos), len(tasks), jobs))
+    # a missing model fails here once, not in every chunk
+    ChunkWorker(options)
+    t0 = clock()
+    results, failed = [], 0
+    with ProcessPoolExecutor(
+            max_workers=jobs, initializer=_init_worker, initargs=(options,),
+            mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = dict((pool.submit(_run_chunk, task), task)
+                       for task in tasks)
+        for i, future in enumerate(as_completed(futures)):
+            try:
+                res = future.result()
+            except Exception:
+                path, index = futures[future][:2]
+                logger.exception('chunk {} #{} failed'.format(path, index))
+                failed += 1
+                continue
+            results.append(res)
+            logger.info('chunk {}/{} {} #{}: {:.0f}s of video in {:.1f}s'
+                        .format(i + 1, len(tasks),
+                                os.path.basename(res['path']), res['index'],
+                                res['seconds'], res['wall']))
+    wall = clock() - t0
+
+    starts = dict((path, start if start is not None else start_time(path))
+                  for path in videos)
+    visits = merge_events(results, starts, merge_window)
+    if visit_log:
+        from utils.visitlog import VisitLog, timezone
+        log = VisitLog(visit_log, tz=timezone)
+        for stamp, person_id, name, _ in visits:
+            log.record(person_id, name, stamp)
+        log.close()
+
+    seconds = sum(r['seconds'] for r in results)
+    stages = {}
+    for name in STAGES:
+        samples = np.concatenate([np.asarray(r['stages'][name], np.float64)
+                                  for r in results] or [np.zeros(0)])
+        hist = Histogram(name, size=max(1, len(samples)))
+        for value in samples:
+            hist.record(value)
+        summary = hist.summary()
+        summary['total_s'] = round(float(samples.sum()), 3)
+        stages[name] = summary
+    out = {
+        'source': source, 'videos': len(videos), 'chunks': len(tasks),
+        'failed': failed, 'jobs': jobs,
+        'frames': sum(r['frames'] for r in results),
+        'sampled': sum(r['sampled'] for r in results),
+        'still': sum(r['still'] for r in results),
+        'video_s': round(seconds, 1), 'wall_s': round(wall, 2),
+        'realtime_factor': round(seconds / wall, 1) if wall else None,
+        'fps': round(sum(r['frames'] for r in results) / wall, 1)
+        if wall else None,
+        'visits': len(visits), 'stages': stages, 'options': options,
+    }
+    logger.info('offline: {video_s}s of video in {wall_s}s '
+                '({realtime_factor}x real time), {visits} visits'
+                .format(**out))
+    if report:
+        with open(report, 'w') as f:
+            json.dump(out, f, indent=1, ensure_ascii=False)
+    return out
@@ -0,0 +1,48 @@
+# -*- coding:utf-8 -*-
+import sys
+import time
+
+
+class StartupProfiler(object):
+    ''' Records named startup phases relative to process start
+
+    Kept free of heavy imports so main.py can load it first.
+    '''
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.enabled = False
+        self.phases = []
+        self._seen = set()
+        self._waiting = set()
+        self._callback = None
+
+    def mark(self, name):
+        """Record the first time phase `name` is reached."""
+        if name in self._seen:
+            return
+        self._seen.add(name)
+        self.phases.append((name, time.perf_counter()))
+        if self._callback is not None and self._waiting <= self._seen:
+            callback, self._callback = self._callback, None
+            callback()
+
+    def waitFor(self, names, callback):
+        """Call callback once every phase in names has been marked."""
+        self._waiting = set(names)
+        self._callback = callback
+        if self._waiting <= self._seen:
+            self._callback = None
+            callback()
+
+    def report(self, out=None):
+        out = out or sys.stderr
+        last = self.t0
+        out.write('startup profile:\n')
+        for name, t in self.phases:
+            out.write('  {:<24s} +{:8.1f} ms  {:8.1f} ms\n'.format(
+                name, (t - last) * 1000, (t - self.t0) * 1000))
+            last = t
+        out.flush()
+
+
+startup = StartupProfiler()
@@ -0,0 +1,309 @@
+# -*- coding:utf-8 -*-
+import threading
+import multiprocessing
+from queue import Queue, Empty, Full
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import cv2
+
+from PyQt5.QtCore import *
+
+from utils.log import logger
+from utils.gallery import l2_normalize
+from utils.metrics import metrics, clock
+from utils.thumbnails import find_photo
+
+
+class DnnEmbedder(object):
+    ''' Face embeddings from an OpenCV DNN model (ONNX, caffe, ...)
+
+    embed() runs a whole list of crops as one N x 3 x H x W blob. Models
+    exported with a fixed batch of 1 are detected on the first call and
+    then run crop by crop.
+    '''
+    def __init__(self, model='models/face_embedding.onnx', config=None,
+                 input_size=(112, 112), scale=1 / 127.5,
+                 mean=(127.5, 127.5, 127.5), swap_rb=True):
+        self.net = cv2.dnn.readNet(model, config or '')
+        self.input_size = input_size
+        self.scale = scale
+        self.mean = mean
+        self.swap_rb = swap_rb
+        self.batched = True
+
+    def _forward(self, crops):
+        blob = cv2.dnn.blobFromImages(crops, self.scale, self.input_size,
+                                      self.mean, self.swap_rb)
+        self.net.setInput(blob)
+        return self.net.forward().reshape(len(crops), -1)
+
+    def embed(self, crops):
+        """N x dim float32 array of L2 normalized embeddings."""
+        if self.batched and len(crops) > 1:
+            try:
+                return l2_normalize(self._forward(crops))
+            except cv2.error:
+                logger.info('embedding model has a fixed batch size of 1')
+                self.batched = False
+        return l2_normalize(np.concatenate(
+            [self._forward([crop]) for crop in crops]))
+
+
+class DummyEmbedder(object):
+    ''' Model-free stand-in: a fixed random projection of a tiny grey crop
+
+    Deterministic, so the same crop always gives the same embedding.
+    '''
+    def __init__(self, dim=128, input_size=(16, 16), seed=0):
+        self.dim = dim
+        self.input_size = input_size
+        rng = np.random.default_rng(seed)
+        self.projection = rng.standard_normal(
+            (input_size[0] * input_size[1], dim)).astype(np.float32)
+
+    def embed(self, crops):
+        batch = np.empty((len(crops), self.projection.shape[0]), np.float32)
+        for row, crop in zip(batch, crops):
+            if crop.ndim == 3:
+                crop = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+            row[:] = cv2.resize(crop, self.input_size,
+                                interpolation=cv2.INTER_AREA).ravel()
+        batch -= batch.mean(axis=1, keepdims=True)
+        return l2_normalize(batch.dot(self.projection))
+
+
+embedders = {
+    'dnn': DnnEmbedder,
+    'dummy': DummyEmbedder,
+}
+
+
+# process pool workers keep their own embedder
+_process_embedder = None
+
+
+def _init_process(factory):
+    global _process_embedder
+    _process_embedder = factory()
+
+
+def _embed_in_process(crops):
+    return _process_embedder.embed(crops)
+
+
+class RecognitionPipeline(QObject):
+    ''' Micro-batched face embedding and gallery matching
+
+    submit(faces) takes the face dicts of DetectionPipeline.detected from
+    any thread. A dispatcher thread groups queued faces into batches of up
+    to `max_batch`, flushing early once the oldest face has waited
+    `max_delay` seconds, and runs each batch as one embed() call in a pool
+    of `workers` threads (pool='thread') or processes (pool='process').
+    A larger max_batch / max_delay uses the CPU better when many faces
+    are in view, a smaller one answers a lone visitor sooner.
+
+    Results are emitted with `recognized` as the same face dicts with
+    'embedding' added and, when `gallery` (a FaceGallery or IVFIndex)
+    holds a match above `threshold`, 'person_id', 'score' and 'text'.
+    A matched person's enrolled photo, <photo_dir>/<person_id>.jpg, is
+    set as 'photo' and, through `thumbnails` (a ThumbnailCache), as the
+    'thumb' to greet them with.
+
+    A process pool broken by a crashed worker is rebuilt, up to
+    `max_restarts` times; after that recognition is off and queued faces
+    are dropped. shutdown() never blocks on a full queue.
+    '''
+    recognized = pyqtSignal(object)
+
+    def __init__(self, embedder_factory, gallery=None, max_batch=8,
+                 max_delay=0.02, workers=1, pool='thread', threshold=0.5,
+                 max_queue=64, photo_dir=None, thumbnails=None,
+                 max_restarts=5, parent=None):
+        super(RecognitionPipeline, self).__init__(parent)
+        self.embedder_factory = embedder_factory
+        self.gallery = gallery
+        self.max_batch = max(1, max_batch)
+        self.max_delay = max_delay
+        self.threshold = threshold
+        self.photo_dir = photo_dir
+        self.thumbnails = thumbnails
+        self.workers = workers
+        self.max_restarts = max_restarts
+        self.pool = pool
+        self._pool = self._makePool()
+        self._dead = False
+        self._stop = threading.Event()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # at most one batch queued behind each busy worker
+        self._slots = threading.BoundedSemaphore(workers * 2)
+        self._queue = Queue(maxsize=max_queue)
+        self.submitted = 0
+        self.dropped = 0
+        self.batches = 0
+        self.faces = 0
+        self.matched = 0
+        self.failed = 0
+        self.restarts = 0
+        self.hist = metrics.histogram('recognition')
+        self.wait_hist = metrics.histogram('recognition_wait')
+        self._dispatcher = threading.Thread(target=self._dispatch,
+                                            name='recognition', daemon=True)
+        self._dispatcher.start()
+
+    def _makePool(self):
+        if self.pool == 'process':
+            # spawn, forking a process that runs Qt is not safe
+            return ProcessPoolExecutor(
+                max_workers=self.workers, initializer=_init_process,
+                initargs=(self.embedder_factory,),
+                mp_context=multiprocessing.get_context('spawn'))
+        return ThreadPoolExecutor(max_workers=self.workers)
+
+    def embedder(self):
+        emb = getattr(self._local, 'embedder', None)
+        if emb is None:
+            emb = self._local.embedder = self.embedder_factory()
+        return emb
+
+    def submit(self, faces):
+        """Queue faces for recognition, faces that don't fit are dropped."""
+        now = clock()
+        for face in faces:
+            if face.get('crop') is None or not face['crop'].size:
+                continue
+            if self._dead or self._stop.is_set():
+                self.dropped += 1
+                continue
+            try:
+                self._queue.put_nowait((now, face))
+                self.submitted += 1
+            except Full:
+                self.dropped += 1
+
+    def _dispatch(self):
+        while not self._stop.is_set():
+            try:
+                # the stop flag is seen even if the sentinel did not fit
+                item = self._queue.get(timeout=0.5)
+            except Empty:
+                continue
+            if item is None:
+                return
+            batch = [item]
+            deadline = item[0] + self.max_delay
+            stop = False
+            while len(batch) < self.max_batch:
+                timeout = deadline - clock()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            while not self._slots.acquire(timeout=0.5):
+                if self._stop.is_set():
+                    return
+            try:
+                self._submitBatch(batch)
+            except Exception as e:
+                self._slots.release()
+                self._onSubmitFailed(batch, e)
+            if stop:
+                return
+
+    def _onSubmitFailed(self, batch, error):
+        with self._lock:
+            self.failed += len(batch)
+        if self._dead or self._stop.is_set():
+            return
+        if not isinstance(error, BrokenProcessPool):
+            logger.error('face recognition failed: {}'.format(error))
+            return
+        if self.restarts >= self.max_restarts:
+            logger.error('recognition workers keep dying, recognition is '
+                         'off: {}'.format(error))
+            self._dead = True
+            return
+        logger.error('recognition worker died, restart the pool: '
+                     '{}'.format(error))
+        self._pool.shutdown(wait=False)
+        self._pool = self._makePool()
+        self.restarts += 1
+
+    def _submitBatch(self, batch):
+        now = clock()
+        for t, _ in batch:
+            self.wait_hist.record(now - t)
+        faces = [face for _, face in batch]
+        crops = [face['crop'] for face in faces]
+        if self.pool == 'process':
+            future = self._pool.submit(_embed_in_process, crops)
+        else:
+            future = self._pool.submit(lambda: self.embedder().embed(crops))
+        future.add_done_callback(
+            lambda f: self._finish(faces, f, now))
+
+    def _finish(self, faces, future, t0):
+        try:
+            embeddings = future.result()
+            self.hist.record(clock() - t0)
+            self.match(faces, embeddings)
+        except Exception as e:
+            logger.error('face recognition failed: {}'.format(e))
+            with self._lock:
+                self.failed += len(faces)
+            return
+        finally:
+            self._slots.release()
+        with self._lock:
+            self.batches += 1
+            self.faces += len(faces)
+        self.recognized.emit(faces)
+
+    def match(self, faces, embeddings):
+        """Attach embeddings and gallery matches to faces."""
+        for face, embedding in zip(faces, embeddings):
+            face['embedding'] = embedding
+        if self.gallery is None or not len(self.gallery):
+            return
+        results = self.gallery.search_batch(embeddings, 1)
+        for face, best in zip(faces, results):
+            if best and best[0][1] >= self.threshold:
+                face['person_id'], face['score'] = best[0]
+                face['text'] = face['person_id']
+                self.matched += 1
+                self.addPhoto(face)
+
+    def addPhoto(self, face):
+        photo = find_photo(self.photo_dir, face['person_id'])
+        if photo is None:
+            return
+        face['photo'] = photo
+        if self.thumbnails is not None:
+            thumb = self.thumbnails.photo(photo)
+            if thumb is not None:
+                face['thumb'] = thumb
+
+    def stats(self):
+        return {'submitted': self.submitted, 'dropped': self.dropped,
+                'batches': self.batches, 'faces': self.faces,
+                'matched': self.matched, 'failed': self.failed,
+                'restarts': self.restarts, 'queued': self._queue.qsize(),
+                'mean_batch': (round(self.faces / float(self.batches), 2)
+                               if self.batches else None)}
+
+    def shutdown(self):
+        self._stop.set()
+        try:
+            self._queue.put_nowait(None)
+        except Full:
+            pass
+        self._dispatcher.join()
+        self._pool.shutdown(wait=True)
@@ -0,0 +1,177 @@
+# -*- coding:utf-8 -*-
+import math
+import time
+import heapq
+import itertools
+from collections import OrderedDict
+
+from PyQt5.QtCore import *
+
+from utils.log import logger
+from utils.metrics import clock
+
+
+FRAME = 'frame'
+
+
+class _Subscriber(object):
+    __slots__ = ('name', 'fn', 'every', 'align', 'changed', 'due',
+                 'calls', 'skipped', 'total', 'max')
+
+    def __init__(self, name, fn, every, align, changed):
+        self.name = name
+        self.fn = fn
+        self.every = every
+        self.align = align
+        self.changed = changed
+        self.due = None
+        self.calls = 0
+        self.skipped = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+class FrameClock(QObject):
+    ''' One timer driving every periodic update of the window
+
+    Subscribers run with every=FRAME on ticks after requestFrame() (a
+    grabber's frameReady), every=N seconds, or with align=True on wall
+    clock multiples of N (every=1.0: on the second boundary). Everything
+    due within `slack` seconds runs in the same tick, so several streams
+    and timers cost one wakeup; aligned subscribers never run early.
+    A subscriber's changed() returning False skips the call. stats()
+    reports the time each subscriber takes per call.
+    '''
+    def __init__(self, slack=0.015, parent=None):
+        super(FrameClock, self).__init__(parent)
+        self.slack = slack
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setTimerType(Qt.PreciseTimer)
+        self.timer.timeout.connect(self.tick)
+        self._subs = OrderedDict()
+        self._later = []
+        self._order = itertools.count()
+        self._frame_pending = False
+        self.ticks = 0
+
+    def subscribe(self, name, fn, every=FRAME, align=False, changed=None):
+        """Call fn() at the given rate, replacing a subscriber of name."""
+        sub = _Subscriber(name, fn, every, align, changed)
+        sub.due = self._firstDue(sub, clock())
+        self._subs[name] = sub
+        self._arm()
+        return sub
+
+    def unsubscribe(self, name):
+        self._subs.pop(name, None)
+
+    def setRate(self, name, every):
+        sub = self._subs.get(name)
+        if sub is None or sub.every == every:
+            return
+        sub.every = every
+        sub.due = self._firstDue(sub, clock())
+        self._arm()
+
+    def requestFrame(self):
+        """A new frame is waiting, run the FRAME subscribers soon."""
+        if not self._frame_pending:
+            self._frame_pending = True
+            self._arm()
+
+    def callLater(self, delay, fn):
+        """Call fn() once after delay seconds."""
+        heapq.heappush(self._later, (clock() + delay, next(self._order), fn))
+        self._arm()
+
+    def _firstDue(self, sub, now):
+        if sub.every == FRAME:
+            return None
+        if sub.align:
+            wall = time.time()
+            boundary = (math.floor(wall / sub.every) + 1) * sub.every
+            # a hair late so the wall clock has surely moved on
+            return now + boundary - wall + 0.002
+        return now + sub.every
+
+    def _nextDue(self, sub, now):
+        if sub.align:
+            return self._firstDue(sub, now)
+        due = sub.due + sub.every
+        # after a stall run once, don't replay every missed tick
+        return due if due > now else now + sub.every
+
+    def tick(self):
+        now = clock()
+        frame, self._frame_pending = self._frame_pending, False
+        self.ticks += 1
+        for sub in list(self._subs.values()):
+            if sub.every == FRAME:
+                if not frame:
+                    continue
+            elif now + (0 if sub.align else self.slack) < sub.due:
+                continue
+            else:
+                sub.due = self._nextDue(sub, now)
+            if sub.changed is not None and not sub.changed():
+                sub.skipped += 1
+                continue
+            self._call(sub)
+        while self._later and self._later[0][0] <= now + self.slack:
+            fn = heapq.heappop(self._later)[2]
+            try:
+                fn()
+            except Exception:
+                logger.exception('scheduled call failed')
+        self._arm()
+
+    def _call(self, sub):
+        t0 = clock()
+        try:
+            sub.fn()
+        except Exception:
+            logger.exception('{} failed'.format(sub.name))
+        dt = clock() - t0
+        sub.calls += 1
+        sub.total += dt
+        if dt > sub.max:
+            sub.max = dt
+
+    def _arm(self):
+        if self._frame_pending:
+            due = clock()
+        else:
+            dues = [s.due for s in self._subs.values() if s.due is not None]
+            if self._later:
+                dues.append(self._later[0][0])
+            if not dues:
+                self.timer.stop()
+                return
+            due = min(dues)
+        ms = max(0, int(math.ceil((due - clock()) * 1000)))
+        if self.timer.isActive() and self.timer.remainingTime() <= ms:
+            return
+        self.timer.start(ms)
+
+    def stats(self):
+        subs = {}
+        for name, sub in self._subs.items():
+            subs[name] = {
+                'calls': sub.calls, 'skipped': sub.skipped,
+                'mean_ms': (round(sub.total / sub.calls * 1000, 3)
+                            if sub.calls else None),
+                'max_ms': round(sub.max * 1000, 3),
+            }
+        return {'ticks': self.ticks, 'subscribers': subs}
+
+
+_frame_clock = None
+
+
+def frameClock():
+    """The process-wide FrameClock, created on first use."""
+    global _frame_clock
+    if _frame_clock is None:
+        _frame_clock = FrameClock()
+    return _frame_clock
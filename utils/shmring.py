@@ -0,0 +1,365 @@
+# -*- coding:utf-8 -*-
+import atexit
+import threading
+import itertools
+import multiprocessing
+from multiprocessing import shared_memory
+from multiprocessing.connection import wait
+
+import numpy as np
+
+from utils.log import logger
+
+
+class FrameRing(object):
+    ''' Fixed ring of frame slots in one shared memory segment
+
+    The segment starts with a header row per slot (sequence number and
+    frame shape) followed by `slots` buffers of `max_shape`. The process
+    that creates the ring writes frames and is the only one to unlink it;
+    other processes attach() by spec() and get zero-copy read-only views.
+    Slots are handed out by the writer, so a slot is never written while
+    a reader holds it and no locks live in shared memory.
+    '''
+    _header = 4  # seq, height, width, channels
+
+    def __init__(self, slots, max_shape, name=None, create=True):
+        self.slots = slots
+        self.max_shape = tuple(max_shape)
+        self.slot_bytes = (int(np.prod(self.max_shape)) + 63) // 64 * 64
+        self.header_bytes = (slots * self._header * 8 + 63) // 64 * 64
+        size = self.header_bytes + slots * self.slot_bytes
+        self.shm = shared_memory.SharedMemory(name=name, create=create,
+                                              size=size if create else 0)
+        self.owner = create
+        self.header = np.ndarray((slots, self._header), np.int64,
+                                 buffer=self.shm.buf)
+        if create:
+            self.header[:] = 0
+        self._seq = itertools.count(1)
+
+    @classmethod
+    def attach(cls, spec):
+        return cls(spec['slots'], spec['max_shape'], name=spec['name'],
+                   create=False)
+
+    def spec(self):
+        return {'name': self.shm.name, 'slots': self.slots,
+                'max_shape': self.max_shape}
+
+    def fits(self, shape):
+        return (len(shape) == len(self.max_shape) and
+                all(s <= m for s, m in zip(shape, self.max_shape)))
+
+    def _array(self, slot, shape):
+        return np.ndarray(shape, np.uint8, buffer=self.shm.buf,
+                          offset=self.header_bytes + slot * self.slot_bytes)
+
+    def write(self, slot, frame):
+        """Copy a uint8 frame into slot, return its sequence number."""
+        if frame.dtype != np.uint8 or not self.fits(frame.shape):
+            raise ValueError('frame {} {} does not fit ring {}'.format(
+                frame.shape, frame.dtype, self.max_shape))
+        seq = next(self._seq)
+        self._array(slot, frame.shape)[...] = frame
+        shape = tuple(frame.shape) + (1,) * (3 - frame.ndim)
+        self.header[slot, 1:] = shape
+        # the sequence number last, it is what readers check
+        self.header[slot, 0] = seq
+        return seq
+
+    def view(self, slot, seq):
+        """Read-only view of the frame in slot, None if seq is stale."""
+        if self.header[slot, 0] != seq:
+            return None
+        h, w, c = (int(v) for v in self.header[slot, 1:])
+        arr = self._array(slot, (h, w, c) if c > 1 else (h, w))
+        arr.flags.writeable = False
+        return arr
+
+    def close(self):
+        # views must be gone before the buffer can be released
+        self.header = None
+        try:
+            self.shm.close()
+        except BufferError:
+            logger.warning('frame ring {} still has views'.format(
+                self.shm.name))
+
+    def unlink(self):
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+
+
+def _worker_main(spec, task_factory, conn):
+    """Worker process: run task(view, meta) for every slot message."""
+    ring = FrameRing.attach(spec)
+    task = task_factory()
+    try:
+        while True:
+            try:
+                msg = conn.recv()
+            except EOFError:
+                break
+            if msg is None:
+                break
+            slot, seq, meta = msg
+            frame = ring.view(slot, seq)
+            if frame is None:
+                conn.send((slot, seq, None, 'stale slot'))
+                continue
+            try:
+                result, error = task(frame, meta), None
+            except Exception as e:
+                result, error = None, '{}: {}'.format(type(e).__name__, e)
+            del frame
+            conn.send((slot, seq, result, error))
+    finally:
+        ring.close()
+
+
+class _Worker(object):
+    __slots__ = ('process', 'conn', 'job')
+
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+        # (slot, seq, meta) being processed or None
+        self.job = None
+
+
+class FrameWorkerPool(object):
+    ''' Worker processes fed with frames through a FrameRing
+
+    submit(frame, meta) copies the frame into a free slot and sends only
+    (slot, seq, meta) to an idle worker over a pipe; the worker calls
+    task(view, meta) on a zero-copy view, where task = task_factory() is
+    built once per process, and its (small, picklable) result comes back
+    to callback(meta, result, error) on the collector thread. submit()
+    returns False when every worker is busy, so frames are dropped rather
+    than queued. A worker that dies is restarted and its slot reclaimed;
+    its frame is reported with error 'worker died'.
+
+    The ring is built for `max_shape`, grown to fit larger frames as
+    they come. Building it, and rebuilding it for a frame that does not
+    fit, happens on the collector thread: submit() drops frames until
+    the new ring is up and never waits for workers to stop. Jobs in
+    flight on a replaced ring are reported with error 'ring rebuilt'.
+    close() (also run at exit) stops the workers and unlinks the segment.
+    '''
+    def __init__(self, task_factory, workers=2, callback=None, slots=None,
+                 max_shape=None):
+        self.task_factory = task_factory
+        self.workers = workers
+        self.slots = slots or workers + 1
+        self.max_shape = tuple(max_shape) if max_shape else None
+        self.callback = callback or (lambda meta, result, error: None)
+        self._ctx = multiprocessing.get_context('spawn')
+        self._lock = threading.Lock()
+        self._ring = None
+        # shape asked for and shape being built on the collector thread
+        self._want = None
+        self._building = None
+        self._workers = []
+        self._free = []
+        self._collector = None
+        self._wakeup_r, self._wakeup_w = self._ctx.Pipe(duplex=False)
+        self._closed = False
+        self.submitted = 0
+        self.dropped = 0
+        self.restarts = 0
+        self.rebuilds = 0
+        atexit.register(self.close)
+        if self.max_shape is not None:
+            # start the workers now, off this thread
+            with self._lock:
+                self._grow(self.max_shape)
+
+    def _spawn(self, ring):
+        parent, child = self._ctx.Pipe()
+        process = self._ctx.Process(
+            target=_worker_main, name='frame-worker',
+            args=(ring.spec(), self.task_factory, child), daemon=True)
+        process.start()
+        child.close()
+        return _Worker(process, parent)
+
+    def _grow(self, shape):
+        """Ask the collector for a ring that fits shape, holding the lock."""
+        base = (self._want or self._building or
+                (self._ring.max_shape if self._ring else None) or
+                self.max_shape)
+        if base is not None and len(base) == len(shape):
+            # never shrink, alternating 4:3 and 16:9 frames must not
+            # rebuild back and forth
+            shape = tuple(max(a, b) for a, b in zip(base, shape))
+        shape = tuple(shape)
+        if shape in (self._want, self._building):
+            return
+        self._want = shape
+        if self._collector is None:
+            self._collector = threading.Thread(
+                target=self._collect, name='frame-ring', daemon=True)
+            self._collector.start()
+        self._wakeup_w.send(None)
+
+    def _rebuild(self):
+        """Replace the ring and workers, on the collector thread."""
+        with self._lock:
+            shape, self._want = self._want, None
+            if shape is None or self._closed:
+                return
+            self._building = shape
+            old_ring, self._ring = self._ring, None
+            old_workers, self._workers = self._workers, []
+            jobs = [w.job for w in old_workers if w.job is not None]
+            self._free = []
+        self._stopWorkers(old_workers)
+        if old_ring is not None:
+            old_ring.close()
+            old_ring.unlink()
+            self.rebuilds += 1
+        for job in jobs:
+            self.callback(job[2], None, 'ring rebuilt')
+        try:
+            ring = FrameRing(self.slots, shape)
+            workers = [self._spawn(ring) for _ in range(self.workers)]
+        except Exception:
+            logger.exception('build frame ring of {} failed'.format(shape))
+            with self._lock:
+                self._building = None
+            return
+        with self._lock:
+            self._building = None
+            closed = self._closed
+            if not closed:
+                self._ring = ring
+                self._free = list(range(self.slots))
+                self._workers = workers
+        if closed:
+            self._stopWorkers(workers)
+            ring.close()
+            ring.unlink()
+            return
+        logger.info('frame ring {}: {} slots of {}, {} workers'.format(
+            ring.shm.name, self.slots, shape, self.workers))
+
+    def submit(self, frame, meta=None):
+        """Hand frame to an idle worker, return False if none is idle."""
+        with self._lock:
+            if self._closed:
+                return False
+            if self._ring is None or not self._ring.fits(frame.shape):
+                self._grow(frame.shape)
+                self.dropped += 1
+                return False
+            worker = next((w for w in self._workers if w.job is None), None)
+            if worker is None or not self._free:
+                self.dropped += 1
+                return False
+            slot = self._free.pop()
+            seq = self._ring.write(slot, frame)
+            worker.job = (slot, seq, meta)
+            try:
+                worker.conn.send(worker.job)
+            except (OSError, ValueError):
+                # dead worker, the collector restarts it
+                worker.job = None
+                self._free.append(slot)
+                self.dropped += 1
+                return False
+            self.submitted += 1
+            return True
+
+    def _collect(self):
+        while True:
+            if self._want is not None:
+                self._rebuild()
+            with self._lock:
+                if self._closed:
+                    return
+                waitables = [self._wakeup_r]
+                for w in self._workers:
+                    waitables += [w.conn, w.process.sentinel]
+            try:
+                ready = wait(waitables, timeout=1.0)
+            except (OSError, ValueError):
+                # a pipe was closed by a restart, rebuild the list
+                continue
+            if self._wakeup_r in ready:
+                self._wakeup_r.recv()
+            for worker in list(self._workers):
+                if worker.conn in ready:
+                    self._receive(worker)
+                elif worker.process.sentinel in ready:
+                    self._restart(worker)
+
+    def _receive(self, worker):
+        try:
+            slot, seq, result, error = worker.conn.recv()
+        except (EOFError, OSError):
+            self._restart(worker)
+            return
+        with self._lock:
+            job, worker.job = worker.job, None
+            if job is not None:
+                self._free.append(job[0])
+        if job is not None:
+            self.callback(job[2], result, error)
+
+    def _restart(self, worker):
+        # a closed pipe can be seen before the process is reaped
+        worker.process.join(0.5)
+        with self._lock:
+            if self._closed or worker not in self._workers:
+                return
+            logger.warning('frame worker {} exited with {}, restart'.format(
+                worker.process.pid, worker.process.exitcode))
+            job, worker.job = worker.job, None
+            if job is not None:
+                self._free.append(job[0])
+            worker.conn.close()
+            self._workers[self._workers.index(worker)] = self._spawn(
+                self._ring)
+            self.restarts += 1
+        if job is not None:
+            self.callback(job[2], None, 'worker died')
+
+    def _stopWorkers(self, workers):
+        for worker in workers:
+            try:
+                worker.conn.send(None)
+            except (OSError, ValueError):
+                pass
+        for worker in workers:
+            worker.process.join(2.0)
+            if worker.process.is_alive():
+                worker.process.terminate()
+                worker.process.join(1.0)
+            worker.conn.close()
+
+    def stats(self):
+        with self._lock:
+            busy = sum(1 for w in self._workers if w.job is not None)
+        return {'submitted': self.submitted, 'dropped': self.dropped,
+                'busy': busy, 'restarts': self.restarts,
+                'rebuilds': self.rebuilds}
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            workers, self._workers = self._workers, []
+            ring, self._ring = self._ring, None
+        self._stopWorkers(workers)
+        self._wakeup_w.send(None)
+        if (self._collector is not None and
+                self._collector is not threading.current_thread()):
+            self._collector.join(5.0)
+        if ring is not None:
+            ring.close()
+            ring.unlink()
@@ -0,0 +1,156 @@
+# -*- coding:utf-8 -*-
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import cv2
+
+from utils.log import logger
+
+
+# the 128 px ImageWidget label minus its 2 px border, so thumbnails are
+# shown without another scaling pass
+THUMB_SIZE = 126
+
+
+def crop_thumbnail(frame, box, size=THUMB_SIZE, margin=0.2):
+    """Square BGR thumbnail of box (x, y, w, h) in frame, or None.
+
+    The box is widened by `margin` on every side, made square and clipped
+    to the frame, then resized once with INTER_AREA to size x size.
+    """
+    x, y, w, h = box
+    side = int(max(w, h) * (1 + 2 * margin))
+    cx, cy = x + w // 2, y + h // 2
+    fh, fw = frame.shape[:2]
+    x0, y0 = max(0, cx - side // 2), max(0, cy - side // 2)
+    x1, y1 = min(fw, cx + side // 2), min(fh, cy + side // 2)
+    if x1 - x0 < 2 or y1 - y0 < 2:
+        return None
+    return cv2.resize(frame[y0:y1, x0:x1], (size, size),
+                      interpolation=cv2.INTER_AREA)
+
+
+def fit_thumbnail(img, size=THUMB_SIZE):
+    """Centre-crop img to a square and resize it to size x size."""
+    h, w = img.shape[:2]
+    side = min(h, w)
+    y0, x0 = (h - side) // 2, (w - side) // 2
+    return cv2.resize(img[y0:y0 + side, x0:x0 + side], (size, size),
+                      interpolation=cv2.INTER_AREA)
+
+
+PHOTO_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def find_photo(photo_dir, person_id):
+    """Path of the enrolled photo <photo_dir>/<person_id>.jpg|.png or
+    None."""
+    if not photo_dir:
+        return None
+    base = os.path.join(photo_dir, str(person_id))
+    for ext in PHOTO_EXTENSIONS:
+        if os.path.isfile(base + ext):
+            return base + ext
+    return None
+
+
+class ThumbnailCache(object):
+    ''' Thumbnails of enrolled photos, in memory and on disk
+
+    photo(path) returns a size x size BGR array. Lookups go through an
+    LRU capped at `max_bytes`, then `cache_dir` where each thumbnail is
+    a raw .npy keyed by the photo's path, mtime and the size, so a
+    repeat visitor never decodes the photo again and an edited photo is
+    picked up. Safe to call from worker threads.
+    '''
+    def __init__(self, cache_dir='cache/thumbs', size=THUMB_SIZE,
+                 max_bytes=16 << 20):
+        self.cache_dir = cache_dir
+        self.size = size
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _key(self, path):
+        stat = os.stat(path)
+        raw = '{}:{}:{}'.format(os.path.abspath(path), stat.st_mtime_ns,
+                                self.size)
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def photo(self, path):
+        """Thumbnail of the photo at path, None if it can't be read."""
+        try:
+            key = self._key(path)
+        except OSError:
+            return None
+        with self._lock:
+            thumb = self._items.get(key)
+            if thumb is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return thumb
+        thumb = self._load(key)
+        if thumb is not None:
+            self.disk_hits += 1
+        else:
+            img = cv2.imread(path)
+            if img is None:
+                logger.warning('cannot read photo {}'.format(path))
+                return None
+            self.misses += 1
+            thumb = fit_thumbnail(img, self.size)
+            self._save(key, thumb)
+        self._put(key, thumb)
+        return thumb
+
+    def _load(self, key):
+        if not self.cache_dir:
+            return None
+        try:
+            thumb = np.load(os.path.join(self.cache_dir, key + '.npy'))
+        except (IOError, OSError, ValueError):
+            return None
+        if thumb.shape != (self.size, self.size, 3):
+            return None
+        return thumb
+
+    def _save(self, key, thumb):
+        if not self.cache_dir:
+            return
+        path = os.path.join(self.cache_dir, key + '.npy')
+        tmp = '{}.{}.tmp'.format(path, threading.get_ident())
+        try:
+            with open(tmp, 'wb') as f:
+                np.save(f, thumb)
+            os.replace(tmp, path)
+        except (IOError, OSError) as e:
+            logger.warning('cache thumbnail failed: {}'.format(e))
+
+    def _put(self, key, thumb):
+        with self._lock:
+            if key in self._items:
+                return
+            self._items[key] = thumb
+            self._bytes += thumb.nbytes
+            while self._bytes > self.max_bytes and len(self._items) > 1:
+                _, old = self._items.popitem(last=False)
+                self._bytes -= old.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'disk_hits': self.disk_hits,
+                'misses': self.misses, 'items': len(self._items),
+                'bytes': self._bytes}
@@ -0,0 +1,304 @@
+# -*- coding:utf-8 -*-
+import time
+import threading
+import itertools
+
+import numpy as np
+import cv2
+
+from PyQt5.QtCore import *
+
+from utils.metrics import clock
+
+
+# tells the track ids of this run from those of earlier runs in the log
+SESSION = '{:x}'.format(int(time.time()))
+
+
+def iou_matrix(a, b):
+    """IoU of every (x, y, w, h) box in a against every box in b."""
+    a = np.asarray(a, np.float32).reshape(-1, 4)
+    b = np.asarray(b, np.float32).reshape(-1, 4)
+    ax1, ay1 = a[:, 0] + a[:, 2], a[:, 1] + a[:, 3]
+    bx1, by1 = b[:, 0] + b[:, 2], b[:, 1] + b[:, 3]
+    iw = np.minimum(ax1[:, None], bx1[None]) - np.maximum(a[:, None, 0],
+                                                          b[None, :, 0])
+    ih = np.minimum(ay1[:, None], by1[None]) - np.maximum(a[:, None, 1],
+                                                          b[None, :, 1])
+    inter = np.clip(iw, 0, None) * np.clip(ih, 0, None)
+    union = (a[:, 2] * a[:, 3])[:, None] + (b[:, 2] * b[:, 3])[None] - inter
+    return inter / np.maximum(union, 1e-6)
+
+
+class Track(object):
+    __slots__ = ('track_id', 'box', 'hits', 'last_seen', 'person_id',
+                 'text', 'score', 'verified', 'pending', 'arrived')
+
+    def __init__(self, track_id, box, now):
+        self.track_id = track_id
+        self.box = box
+        self.hits = 1
+        self.last_seen = now
+        self.person_id = None
+        self.text = None
+        self.score = None
+        self.verified = None
+        self.pending = None
+        self.arrived = False
+
+
+class FaceTracker(object):
+    ''' Carries face identities across sampled frames
+
+    update() associates the detected boxes with the live tracks, greedily
+    by IoU and then by centroid distance, and marks face['verify'] only
+    for faces whose track has no identity yet, was last verified more
+    than `reverify` seconds ago or scored below `min_score`. The other
+    faces get the track's person_id / text / score without running
+    recognition. identify() stores recognition results and returns the
+    faces whose track arrived: first identified, or identified as a
+    different person. A face recognition leaves without 'person_id' is
+    given its track's own id, 'track:<session>:[<name>:]<track_id>', so
+    two unknown visitors are never the same person; their 'text' stays
+    the display text. With flow=True track boxes are moved by sparse
+    Lucas-Kanade optical flow before association, which keeps fast
+    walkers on their track between sampled frames.
+
+    Thread safe, detection workers may call update() concurrently; a
+    frame older than the last one tracked is not associated.
+    '''
+    def __init__(self, iou_threshold=0.3, max_distance=0.75, max_age=2.0,
+                 reverify=3.0, min_score=0.6, pending_timeout=2.0,
+                 flow=False, flow_width=320, clock=clock, name=None):
+        self.iou_threshold = iou_threshold
+        self.max_distance = max_distance
+        self.max_age = max_age
+        self.reverify = reverify
+        self.min_score = min_score
+        self.pending_timeout = pending_timeout
+        self.flow = flow
+        self.flow_width = flow_width
+        self.clock = clock
+        self.name = name
+        self.id_prefix = 'track:{}:{}'.format(
+            SESSION, name + ':' if name else '')
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._tracks = {}
+        self._prev_gray = None
+        self._last_stamp = None
+        self.created = 0
+        self.arrivals = 0
+        self.verify = 0
+        self.reused = 0
+        self.stale = 0
+
+    def __len__(self):
+        return len(self._tracks)
+
+    def update(self, faces, frame=None, stamp=None):
+        """Annotate faces with 'track_id' and 'verify', return faces."""
+        now = self.clock()
+        stamp = now if stamp is None else stamp
+        with self._lock:
+            if self._last_stamp is not None and stamp < self._last_stamp:
+                self.stale += 1
+                for face in faces:
+                    face['track_id'] = None
+                    face['verify'] = False
+                return faces
+            self._last_stamp = stamp
+            if self.flow and frame is not None:
+                self._predict(frame)
+            for track_id in [t.track_id for t in self._tracks.values()
+                             if now - t.last_seen > self.max_age]:
+                del self._tracks[track_id]
+            tracks = list(self._tracks.values())
+            pairs = self._associate(tracks, [f['box'] for f in faces])
+            matched = dict((fi, tracks[ti]) for ti, fi in pairs)
+            for fi, face in enumerate(faces):
+                track = matched.get(fi)
+                if track is None:
+                    track = Track(next(self._ids), face['box'], now)
+                    self._tracks[track.track_id] = track
+                    self.created += 1
+                else:
+                    track.box = face['box']
+                    track.hits += 1
+                    track.last_seen = now
+                face['track_id'] = track.track_id
+                face['verify'] = self._needsVerify(track, now)
+                if face['verify']:
+                    track.pending = now
+                    self.verify += 1
+                elif track.person_id is not None:
+                    face['person_id'] = track.person_id
+                    face['text'] = track.text
+                    face['score'] = track.score
+                    self.reused += 1
+        return faces
+
+    def _needsVerify(self, track, now):
+        if track.pending is not None:
+            if now - track.pending < self.pending_timeout:
+                return False
+            # the recognition result was dropped, ask again
+            track.pending = None
+        if track.verified is None:
+            return True
+        if now - track.verified > self.reverify:
+            return True
+        return track.score is not None and track.score < self.min_score
+
+    def _associate(self, tracks, boxes):
+        if not tracks or not boxes:
+            return []
+        ious = iou_matrix([t.box for t in tracks], boxes)
+        pairs = []
+        used_t, used_f = set(), set()
+        for ti, fi in zip(*np.unravel_index(np.argsort(-ious, axis=None),
+                                            ious.shape)):
+            if ious[ti, fi] < self.iou_threshold:
+                break
+            if ti in used_t or fi in used_f:
+                continue
+            pairs.append((ti, fi))
+            used_t.add(ti)
+            used_f.add(fi)
+        # centroid fallback for boxes that moved too far to overlap
+        for ti, track in enumerate(tracks):
+            if ti in used_t:
+                continue
+            x, y, w, h = track.box
+            best, best_d = None, self.max_distance * max(w, h)
+            for fi, (bx, by, bw, bh) in enumerate(boxes):
+                if fi in used_f:
+                    continue
+                d = np.hypot(bx + bw / 2.0 - x - w / 2.0,
+                             by + bh / 2.0 - y - h / 2.0)
+                if d < best_d:
+                    best, best_d = fi, d
+            if best is not None:
+                pairs.append((ti, best))
+                used_t.add(ti)
+                used_f.add(best)
+        return pairs
+
+    def _predict(self, frame):
+        """Shift track boxes by the median optical flow inside them."""
+        h, w = frame.shape[:2]
+        scale = min(1.0, self.flow_width / float(w))
+        gray = frame if frame.ndim == 2 else cv2.cvtColor(
+            frame, cv2.COLOR_BGR2GRAY)
+        if scale < 1.0:
+            gray = cv2.resize(gray, (int(w * scale), int(h * scale)),
+                              interpolation=cv2.INTER_AREA)
+        prev, self._prev_gray = self._prev_gray, gray
+        if prev is None or prev.shape != gray.shape or not self._tracks:
+            return
+        for track in self._tracks.values():
+            x, y, bw, bh = [int(v * scale) for v in track.box]
+            mask = np.zeros_like(prev)
+            mask[max(0, y):y + bh, max(0, x):x + bw] = 255
+            pts = cv2.goodFeaturesToTrack(prev, 20, 0.01, 3, mask=mask)
+            if pts is None:
+                continue
+            moved, status, _ = cv2.calcOpticalFlowPyrLK(prev, gray, pts, None)
+            ok = status.ravel() == 1
+            if not ok.any():
+                continue
+            dx, dy = np.median((moved - pts).reshape(-1, 2)[ok], axis=0)
+            tx, ty, tw, th = track.box
+            track.box = (int(tx + dx / scale), int(ty + dy / scale), tw, th)
+
+    def identify(self, faces):
+        """Store recognition results, return the faces that arrived."""
+        now = self.clock()
+        arrived = []
+        with self._lock:
+            for face in faces:
+                track = self._tracks.get(face.get('track_id'))
+                if track is None:
+                    continue
+                track.pending = None
+                track.verified = now
+                person_id = face.get('person_id')
+                changed = (person_id is not None and
+                           track.person_id is not None and
+                           person_id != track.person_id)
+                if person_id is not None or track.person_id is None:
+                    track.person_id = person_id or '{}{}'.format(
+                        self.id_prefix, track.track_id)
+                    track.text = face['text']
+                    track.score = face.get('score')
+                if person_id is None:
+                    face['person_id'] = track.person_id
+                    face['text'] = track.text
+                if not track.arrived or changed:
+                    track.arrived = True
+                    self.arrivals += 1
+                    arrived.append(face)
+        return arrived
+
+    def stats(self):
+        return {'tracks': len(self._tracks), 'created': self.created,
+                'arrivals': self.arrivals, 'verify': self.verify,
+                'reused': self.reused, 'stale': self.stale}
+
+
+class TrackingStage(QObject):
+    ''' Routes detections through one FaceTracker per stream
+
+    Boxes of different cameras must never be matched against each other,
+    so tracker(stream) makes a FaceTracker(name=stream) with
+    tracker_factory on first use; faces are routed by their 'stream'.
+    onDetected() and onRecognized() may be called from worker threads.
+    Faces that need verifying go to `recognize` (RecognitionPipeline.
+    submit) or, without a recognizer, are identified with their
+    detection text at once. `arrived` is emitted once per track with the
+    faces that arrived.
+    '''
+    arrived = pyqtSignal(object)
+
+    def __init__(self, tracker_factory=FaceTracker, recognize=None,
+                 parent=None):
+        super(TrackingStage, self).__init__(parent)
+        self.tracker_factory = tracker_factory
+        self.recognize = recognize
+        self.trackers = {}
+        self._lock = threading.Lock()
+
+    def tracker(self, stream=None):
+        with self._lock:
+            tracker = self.trackers.get(stream)
+            if tracker is None:
+                tracker = self.trackers[stream] = self.tracker_factory(
+                    name=None if stream is None else str(stream))
+            return tracker
+
+    def onDetected(self, faces):
+        verify = [face for face in faces if face.get('verify')]
+        if not verify:
+            return
+        if self.recognize is not None:
+            self.recognize(verify)
+        else:
+            self.onRecognized(verify)
+
+    def onRecognized(self, faces):
+        streams = {}
+        for face in faces:
+            streams.setdefault(face.get('stream'), []).append(face)
+        arrived = []
+        for stream, group in streams.items():
+            arrived += self.tracker(stream).identify(group)
+        if arrived:
+            self.arrived.emit(arrived)
+
+    def stats(self):
+        with self._lock:
+            trackers = list(self.trackers.items())
+        if len(trackers) == 1:
+            return trackers[0][1].stats()
+        return dict((str(stream), tracker.stats())
+                    for stream, tracker in trackers)
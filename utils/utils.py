@@ -1,5 +1,6 @@
 # -*- coding:utf-8 -*-
 
+import threading
 from functools import wraps
 from time import time
 
@@ -10,6 +11,11 @@ import cv2
 from PyQt5.QtGui import *
 from PyQt5.QtCore import *
 from PyQt5.QtWidgets import *
+try:
+    from PyQt5 import sip
+except ImportError:
+    # PyQt5 < 5.11
+    import sip
 
 from utils.log import logger
 
@@ -39,7 +45,59 @@ def fn_timer(function):
     return function_timer
 
 
-def np2qimage(img, mode=None):
+class LatestFrameSlot(object):
+    ''' Single-slot, drop-oldest frame buffer shared between threads '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._frame = None
+        self._seq = 0
+        self.put_count = 0
+        self.take_count = 0
+        self.dropped = 0
+
+    def put(self, frame):
+        """Store frame, return True if the slot was empty before."""
+        with self._lock:
+            was_empty = self._frame is None
+            if not was_empty:
+                self.dropped += 1
+            self._frame = frame
+            self._seq += 1
+            self.put_count += 1
+        return was_empty
+
+    def take(self):
+        """Return (seq, frame) of the newest frame and empty the slot."""
+        with self._lock:
+            frame, self._frame = self._frame, None
+            if frame is not None:
+                self.take_count += 1
+            return self._seq, frame
+
+    def stats(self):
+        with self._lock:
+            return {'captured': self.put_count,
+                    'displayed': self.take_count,
+                    'dropped': self.dropped}
+
+
+HAS_BGR888 = hasattr(QImage, 'Format_BGR888')
+LITTLE_ENDIAN = QSysInfo.ByteOrder == QSysInfo.LittleEndian
+
+
+def native_bgr(channels):
+    """True if QImage can show BGR(A) data of `channels` without a swap."""
+    return HAS_BGR888 if channels == 3 else LITTLE_ENDIAN
+
+
+def np2qimage(img, mode=None, out=None):
+    """Wrap a HxWx3 / HxWx4 uint8 array in a QImage.
+
+    With mode='bgr' the channels are swapped, natively through
+    Format_BGR888 (Qt >= 5.14) or Format_ARGB32 when possible, otherwise
+    into `out` (a preallocated array of the same shape) or a new array.
+    The returned QImage holds a reference to the array it points to.
+    """
     if len(img.shape) != 3:
         raise ValueError("np2QImage can only convert 3D arrays")
     if img.shape[2] not in (3, 4):
@@ -47,40 +105,153 @@ def np2qimage(img, mode=None):
             "rgb2QImage can expects the last dimension to contain exactly "
             "three or four channels")
     height, width, channels = img.shape
-    strides = img.strides[0]
-    if mode == 'bgr':
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    if (img.strides[0] < width * channels or img.strides[1] != channels
+            or img.strides[2] != 1):
+        img = np.ascontiguousarray(img)
 
+    swap = mode == 'bgr' and not native_bgr(channels)
     if channels == 3:
-        qim = QImage(img.data, width, height, strides,
-                     QImage.Format_RGB888)
-        return qim
-    elif channels == 4:
-        qim = QImage(img.data, width, height, strides,
-                     QImage.Format_RGB888)
-        return qim
-    return None
-
-
-def qimage2np(qimage, mode='bgr'):
-    qimage = qimage.convertToFormat(QImage.Format_RGB888)
-    width = qimage.width()
-    height = qimage.height()
-    ptr = qimage.bits()
-    ptr.setsize(qimage.byteCount())
-    img_np = np.array(ptr).reshape((height, width, 3))
-    if mode == 'bgr':
-        img_np = cv2.cvtColor(img_np, cv2.COLOR_RGB2BGR)
-    return img_np
-
-def convertQImageToMat(incomingImage):
-    ''' Converts a QImage into an opencv MAT format '''
-    incomingImage = incomingImage.convertToFormat(4)
-    width = incomingImage.width()
-    height = incomingImage.height()
-    ptr = incomingImage.bits()
-    ptr.setsize(incomingImage.byteCount())
-    arr = np.array(ptr).reshape(height, width, 4)
+        if mode == 'bgr' and not swap:
+            fmt = QImage.Format_BGR888
+        else:
+            fmt = QImage.Format_RGB888
+        if swap:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst=out)
+    else:
+        # BGRA bytes are ARGB32 on little endian machines
+        if mode == 'bgr' and not swap:
+            fmt = QImage.Format_ARGB32
+        else:
+            fmt = QImage.Format_RGBA8888
+        if swap:
+            img = cv2.cvtColor(img, cv2.COLOR_BGRA2RGBA, dst=out)
+
+    # by address, img.data of a row-strided view (a crop) is not a
+    # contiguous buffer and sip rejects it
+    qim = QImage(sip.voidptr(img.ctypes.data), width, height,
+                 img.strides[0], fmt)
+    # QImage does not own the memory, keep the array alive with it
+    qim._ndarray = img
+    return qim
+
+
+class FrameConverter(object):
+    ''' np2qimage with reused double buffers for the swap path '''
+    def __init__(self, mode='bgr', buffers=2):
+        self.mode = mode
+        self._buffers = [None] * buffers
+        self._index = 0
+
+    def _buffer(self, img):
+        self._index = (self._index + 1) % len(self._buffers)
+        buf = self._buffers[self._index]
+        if buf is None or buf.shape != img.shape or buf.dtype != img.dtype:
+            buf = np.empty_like(img)
+            self._buffers[self._index] = buf
+        return buf
+
+    def __call__(self, img):
+        out = None
+        if (self.mode == 'bgr' and img.ndim == 3
+                and not native_bgr(img.shape[2])):
+            out = self._buffer(img)
+        return np2qimage(img, mode=self.mode, out=out)
+
+
+class _QImageBuffer(object):
+    ''' Array interface over QImage pixels, keeps the image alive '''
+    def __init__(self, qimage, shape, strides):
+        self.qimage = qimage
+        self.__array_interface__ = {
+            'version': 3, 'typestr': '|u1', 'shape': shape,
+            'strides': strides,
+            # constBits() does not detach a shared image
+            'data': (int(qimage.constBits()), True),
+        }
+
+
+# channels per pixel of the formats that can be viewed without converting
+_VIEW_CHANNELS = {
+    QImage.Format_Grayscale8: 1,
+    QImage.Format_RGB888: 3,
+    QImage.Format_RGB32: 4,
+    QImage.Format_ARGB32: 4,
+    QImage.Format_ARGB32_Premultiplied: 4,
+    QImage.Format_RGBX8888: 4,
+    QImage.Format_RGBA8888: 4,
+}
+if HAS_BGR888:
+    _VIEW_CHANNELS[QImage.Format_BGR888] = 3
+
+
+def qimage_view(qimage, copy=False, out=None):
+    """Return the pixels of qimage as a uint8 array.
+
+    Grayscale8 gives HxW, RGB888 / BGR888 HxWx3 and the 32 bit formats
+    HxWx4 in their memory byte order (BGRA for RGB32 / ARGB32 on little
+    endian machines). The result is a read-only view using the image's
+    real bytesPerLine, so padded rows are skipped; it keeps qimage alive.
+    With copy=True the pixels are copied into `out` (a preallocated array
+    of the same shape) or a new contiguous array. Other formats are
+    converted to RGB32 first.
+    """
+    channels = _VIEW_CHANNELS.get(qimage.format())
+    if channels is None:
+        qimage = qimage.convertToFormat(QImage.Format_RGB32)
+        channels = 4
+    height, width = qimage.height(), qimage.width()
+    if channels == 1:
+        shape, strides = (height, width), (qimage.bytesPerLine(), 1)
+    else:
+        shape = (height, width, channels)
+        strides = (qimage.bytesPerLine(), channels, 1)
+    view = np.asarray(_QImageBuffer(qimage, shape, strides))
+    if out is not None:
+        np.copyto(out, view)
+        return out
+    return view.copy() if copy else view
+
+
+def qimage2np(qimage, mode='bgr', out=None):
+    """Convert qimage to a HxWx3 BGR (mode='bgr') or RGB array.
+
+    Reads the pixels in place and writes them with one pass into `out`
+    (a preallocated HxWx3 uint8 array) or a new array.
+    """
+    fmt = qimage.format()
+    if fmt not in _VIEW_CHANNELS:
+        qimage = qimage.convertToFormat(QImage.Format_RGB32)
+        fmt = QImage.Format_RGB32
+    view = qimage_view(qimage)
+    if out is None:
+        out = np.empty((view.shape[0], view.shape[1], 3), np.uint8)
+    if view.ndim == 2:
+        return cv2.cvtColor(view, cv2.COLOR_GRAY2BGR, dst=out)
+    if view.shape[2] == 3:
+        is_bgr = HAS_BGR888 and fmt == QImage.Format_BGR888
+        if is_bgr == (mode == 'bgr'):
+            np.copyto(out, view)
+            return out
+        return cv2.cvtColor(view, cv2.COLOR_RGB2BGR, dst=out)
+    if fmt in (QImage.Format_RGBX8888, QImage.Format_RGBA8888):
+        code = cv2.COLOR_RGBA2BGR if mode == 'bgr' else cv2.COLOR_RGBA2RGB
+        return cv2.cvtColor(view, code, dst=out)
+    if not LITTLE_ENDIAN:
+        # 0xAARRGGBB stored as A, R, G, B
+        np.copyto(out, view[..., 3:0:-1] if mode == 'bgr' else view[..., 1:])
+        return out
+    code = cv2.COLOR_BGRA2BGR if mode == 'bgr' else cv2.COLOR_BGRA2RGB
+    return cv2.cvtColor(view, code, dst=out)
+
+
+def convertQImageToMat(incomingImage, out=None, copy=True):
+    ''' Converts a QImage into an opencv MAT format (HxWx4, BGRA bytes on
+    little endian machines), a read-only view when copy=False '''
+    if incomingImage.format() not in (QImage.Format_RGB32,
+                                      QImage.Format_ARGB32):
+        incomingImage = incomingImage.convertToFormat(QImage.Format_RGB32)
+    return qimage_view(incomingImage, copy=copy, out=out)
+
 
 def get_similarity(x, y):
     return np.dot(x, y) / (norm(x) * norm(y))
@@ -0,0 +1,196 @@
+# -*- coding:utf-8 -*-
+import sqlite3
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+import pytz
+
+from utils.log import logger
+
+
+# days and times of the kiosk, the GUI and offline runs log in this zone
+timezone = pytz.timezone('Asia/Shanghai')
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS visits (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    person_id TEXT NOT NULL,
+    name TEXT
+);
+CREATE INDEX IF NOT EXISTS visits_ts ON visits (ts);
+CREATE INDEX IF NOT EXISTS visits_person ON visits (person_id, ts);
+CREATE TABLE IF NOT EXISTS daily_visitors (
+    day TEXT NOT NULL,
+    person_id TEXT NOT NULL,
+    PRIMARY KEY (day, person_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS daily_counts (
+    day TEXT PRIMARY KEY,
+    visitors INTEGER NOT NULL
+);
+'''
+
+
+class VisitLog(object):
+    ''' Persistent visit log with an in-memory cache for the UI
+
+    record() only touches memory: it updates today's distinct visitor set
+    and the latest visits, then hands the row to a background writer that
+    inserts in batches into SQLite (WAL mode). Distinct visitors per day
+    are kept in a counter table maintained on insert, so neither the UI
+    nor a restart ever counts over the whole visits table.
+    '''
+    def __init__(self, path='visits.db', latest=10, tz=None, batch_size=64,
+                 flush_interval=0.5):
+        self.path = path
+        self.tz = tz
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._pending = []
+        self._writing = False
+        self._closed = False
+        self._latest = deque(maxlen=latest)
+        self._day = None
+        self._today = set()
+        self._today_count = 0
+
+        db = self._connect()
+        try:
+            self._loadCache(db)
+        finally:
+            db.close()
+        self._writer = threading.Thread(target=self._run, name='VisitLog')
+        self._writer.daemon = True
+        self._writer.start()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=10)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.executescript(SCHEMA)
+        return db
+
+    def dayOf(self, stamp):
+        return datetime.fromtimestamp(stamp, self.tz).strftime('%Y-%m-%d')
+
+    def _loadCache(self, db):
+        self._day = self.dayOf(time.time())
+        self._today = set(r[0] for r in db.execute(
+            'SELECT person_id FROM daily_visitors WHERE day = ?',
+            (self._day,)))
+        self._today_count = len(self._today)
+        rows = db.execute(
+            'SELECT ts, person_id, name FROM visits ORDER BY ts DESC LIMIT ?',
+            (self._latest.maxlen,)).fetchall()
+        self._latest.extend(rows)
+
+    def record(self, person_id, name=None, stamp=None):
+        """Log a visit, return True if it is person_id's first one today."""
+        if stamp is None:
+            stamp = time.time()
+        day = self.dayOf(stamp)
+        row = (stamp, person_id, name if name is not None else person_id)
+        with self._lock:
+            if self._closed:
+                raise ValueError('record on closed VisitLog')
+            if day != self._day and day > self._day:
+                self._day = day
+                self._today = set()
+                self._today_count = 0
+            first = day == self._day and person_id not in self._today
+            if first:
+                self._today.add(person_id)
+                self._today_count += 1
+            self._latest.appendleft(row)
+            self._pending.append((day,) + row)
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify()
+        return first
+
+    def todayCount(self):
+        """Distinct visitors today."""
+        with self._lock:
+            if self._day != self.dayOf(time.time()):
+                return 0
+            return self._today_count
+
+    def seenToday(self, person_id):
+        with self._lock:
+            return (self._day == self.dayOf(time.time()) and
+                    person_id in self._today)
+
+    def latest(self, n=None):
+        """Latest visits as (ts, person_id, name), newest first."""
+        with self._lock:
+            rows = list(self._latest)
+        return rows if n is None else rows[:n]
+
+    def countOn(self, day):
+        """Distinct visitors of a past day ('YYYY-MM-DD'), from disk."""
+        self.flush()
+        db = sqlite3.connect(self.path, timeout=10)
+        try:
+            row = db.execute('SELECT visitors FROM daily_counts WHERE day = ?',
+                             (day,)).fetchone()
+        finally:
+            db.close()
+        return row[0] if row else 0
+
+    def _write(self, db, batch):
+        with db:
+            db.executemany(
+                'INSERT INTO visits (ts, person_id, name) VALUES (?, ?, ?)',
+                [row[1:] for row in batch])
+            for day, _, person_id, _ in batch:
+                cur = db.execute('INSERT OR IGNORE INTO daily_visitors '
+                                 '(day, person_id) VALUES (?, ?)',
+                                 (day, person_id))
+                if cur.rowcount:
+                    db.execute('INSERT INTO daily_counts (day, visitors) '
+                               'VALUES (?, 1) ON CONFLICT(day) DO UPDATE '
+                               'SET visitors = visitors + 1', (day,))
+
+    def _run(self):
+        db = self._connect()
+        try:
+            while True:
+                with self._lock:
+                    if not self._pending and not self._closed:
+                        self._cond.wait(self.flush_interval)
+                    batch, self._pending = self._pending, []
+                    self._writing = bool(batch)
+                    closed = self._closed
+                if batch:
+                    try:
+                        self._write(db, batch)
+                    except sqlite3.Error as e:
+                        logger.error('write visit log failed: {}'.format(e))
+                    with self._lock:
+                        self._writing = False
+                        self._cond.notify_all()
+                if closed and not batch:
+                    break
+        finally:
+            db.close()
+
+    def flush(self, timeout=5.0):
+        """Block until everything recorded so far is on disk."""
+        deadline = time.time() + timeout
+        with self._lock:
+            self._cond.notify_all()
+            while ((self._pending or self._writing)
+                   and time.time() < deadline):
+                self._cond.wait(0.05)
+            return not (self._pending or self._writing)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._cond.notify_all()
+        self._writer.join()
@@ -3,23 +3,33 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import queue
-import pytz
+import math
+import time
+from functools import partial
+from collections import deque
 from datetime import datetime
 
 import cv2
+import numpy as np
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 
 from ui import *
 from utils.log import logger
-from utils.utils import np2qimage
-
-videoCapture = cv2.VideoCapture(0)
-videoCapture.set(cv2.CAP_PROP_FRAME_WIDTH, 1280)
-videoCapture.set(cv2.CAP_PROP_FRAME_HEIGHT, 720)
-timezone = pytz.timezone('Asia/Shanghai')
+from utils.utils import FrameConverter, LatestFrameSlot, np2qimage
+from utils.detection import DetectionPipeline, detectors
+from utils.recognition import RecognitionPipeline, embedders
+from utils.gallery import FaceGallery
+from utils.tracker import FaceTracker, TrackingStage
+from utils.visitlog import VisitLog, timezone
+from utils.greeting import GreetingScheduler
+from utils.thumbnails import ThumbnailCache
+from utils.capture import openCapture, loadStreams, captureInfo
+from utils.profile import startup
+from utils.metrics import metrics, clock
+from utils.motion import MotionGate, PowerMeter
+from utils.scheduler import frameClock
 
 
 class ToolBar(QToolBar):
@@ -98,6 +108,440 @@ def subHLayout(add_list):
     return layout
 
 
+def fitWidthRect(iw, ih, aw, ah):
+    """Rect of an iw x ih frame scaled to the width of an aw x ah area."""
+    if iw <= 0 or ih <= 0:
+        return QRectF()
+    scale = aw / iw
+    h = ih * scale
+    y = (ah - h) / 2 if ah > h else 0
+    return QRectF(0, y, aw, h)
+
+
+def fitRect(iw, ih, aw, ah):
+    """Rect of an iw x ih frame fitted and centred inside an aw x ah area."""
+    if iw <= 0 or ih <= 0:
+        return QRectF()
+    scale = min(aw / iw, ah / ih)
+    w, h = iw * scale, ih * scale
+    return QRectF((aw - w) / 2, (ah - h) / 2, w, h)
+
+
+def tileCells(count, layout, aw, ah, margin=10):
+    """Cells of `count` streams in a grid or picture-in-picture layout.
+
+    A grid returns every cell, the ones after `count` are left empty.
+    """
+    if count == 1:
+        return [QRect(0, 0, aw, ah)]
+    if layout == 'pip':
+        cells = [QRect(0, 0, aw, ah)]
+        w, h = aw // 4, ah // 4
+        for i in range(1, count):
+            cells.append(QRect(aw - w - margin,
+                               ah - i * (h + margin), w, h))
+        return cells
+    cols = int(math.ceil(math.sqrt(count)))
+    rows = int(math.ceil(count / float(cols)))
+    cells = []
+    for i in range(rows * cols):
+        r, c = divmod(i, cols)
+        x0, x1 = aw * c // cols, aw * (c + 1) // cols
+        y0, y1 = ah * r // rows, ah * (r + 1) // rows
+        cells.append(QRect(x0, y0, x1 - x0, y1 - y0))
+    return cells
+
+
+def disconnectAll(signal):
+    try:
+        signal.disconnect()
+    except TypeError:
+        # nothing connected
+        pass
+
+
+def openglAvailable():
+    context = QOpenGLContext()
+    return context.create() and context.isValid()
+
+
+class FrameGrabber(QThread):
+    ''' Reads one capture continuously into a latest-frame slot
+
+    The slot holds (frame, display, small, moving) items: the full
+    frame, a copy already downscaled to the tile size set with
+    setDisplaySize(), so the painter never has to scale, a frame at least
+    `detect_width` wide for detection or None, and the verdict of the
+    motion gate. Once the gate is idle only one still frame every
+    `idle_interval` seconds is scaled and delivered; the first moving
+    frame is delivered at once.
+
+    An MJPG camera (capture.MjpegCapture) is decoded here. While the
+    gate is idle a DCT-scaled decode is gated and used for detection,
+    the full decode only runs for the frames that are delivered; a
+    moving scene is decoded in full once and gated on that. The gate
+    reseeds when it switches between the two decodes. Otherwise `small`
+    is left to the detection pipeline's single INTER_AREA resize.
+    `fourcc`, `fps` and `buffer_size` are negotiated with cameras; the
+    settings they settle on are logged and kept in `info`.
+    '''
+    frameReady = pyqtSignal()
+    opened = pyqtSignal(bool)
+    idleChanged = pyqtSignal(bool)
+
+    def __init__(self, source=0, width=None, height=None, parent=None,
+                 loop=True, name=None, fourcc=None, fps=None,
+                 buffer_size=None):
+        super(FrameGrabber, self).__init__(parent)
+        self.source = source
+        self.width = width
+        self.height = height
+        self.fourcc = fourcc
+        self.fps = fps
+        self.buffer_size = buffer_size
+        self.loop = loop
+        self.info = {}
+        self.name = name if name is not None else str(source)
+        self.slot = LatestFrameSlot()
+        self.capture_hist = metrics.histogram('capture')
+        self.display_size = None
+        self.fast_scaling = False
+        # set for detection streams, a plain attribute read by run()
+        self.detect_width = None
+        self.gate = MotionGate()
+        self.idle_interval = 0.5
+        self.idle_skipped = 0
+        self._delivered = 0.0
+        self._running = False
+
+    def openCapture(self):
+        return openCapture(self.source, self.width, self.height, self.loop,
+                           self.fourcc, self.fps, self.buffer_size)
+
+    def logSettings(self, cap):
+        self.info = info = captureInfo(cap)
+        asked = [(key, value) for key, value in (
+            ('width', self.width), ('height', self.height),
+            ('fourcc', self.fourcc), ('fps', self.fps),
+            ('buffer_size', self.buffer_size)) if value]
+        other = ', '.join('{} {} not {}'.format(key, info[key] or '-', value)
+                          for key, value in asked if info[key] != value)
+        logger.info('capture {}: {} {}x{} @ {} fps, buffer {}{}{}{}'.format(
+            self.name, info['fourcc'] or '-', info['width'], info['height'],
+            info['fps'], info['buffer_size'] or '-',
+            ', ' + info['backend'] if info.get('backend') else '',
+            ', JPEG decoded here' if info['encoded'] else '',
+            ' (got {})'.format(other) if other else ''))
+
+    def setDisplaySize(self, size):
+        """(width, height) to downscale to, or None for full frames."""
+        # a single attribute store, safe to read from run()
+        self.display_size = size
+
+    def start(self, *args):
+        self._running = True
+        super(FrameGrabber, self).start(*args)
+
+    def scaled(self, frame):
+        size = self.display_size
+        h, w = frame.shape[:2]
+        if size is None or size == (w, h) or size[0] <= 0 or size[1] <= 0:
+            return frame
+        if self.fast_scaling:
+            interp = cv2.INTER_NEAREST
+        elif size[0] < w:
+            interp = cv2.INTER_AREA
+        else:
+            interp = cv2.INTER_LINEAR
+        return cv2.resize(frame, size, interpolation=interp)
+
+    def run(self):
+        cap = self.openCapture()
+        self.opened.emit(cap.isOpened())
+        if not cap.isOpened():
+            logger.warning('open capture {} failed'.format(self.source))
+        else:
+            self.logSettings(cap)
+        encoded = getattr(cap, 'encoded', False)
+        try:
+            while self._running:
+                # grab() waits for the next frame, the capture cost is
+                # what comes after it
+                b = cap.grab()
+                t0 = clock()
+                b, frame = cap.retrieve() if b else (False, None)
+                small = None
+                if b and encoded:
+                    packet = frame
+                    if self.gate.idle:
+                        # most idle frames are skipped, a reduced
+                        # decode is enough to tell
+                        small = cap.decodeReduced(
+                            packet, self.detect_width or 320)
+                        frame = packet if small is not None else None
+                    else:
+                        frame = cap.decode(packet)
+                self.capture_hist.record(clock() - t0)
+                if not b or frame is None:
+                    self.msleep(10)
+                    continue
+                idle = self.gate.idle
+                # a DCT-scaled decode differs from the full one
+                moving = (self.gate.update(frame) if small is None else
+                          self.gate.update(small, source='reduced'))
+                if self.gate.idle != idle:
+                    self.idleChanged.emit(self.gate.idle)
+                now = clock()
+                if (self.gate.idle and
+                        now - self._delivered < self.idle_interval):
+                    self.idle_skipped += 1
+                    continue
+                if small is not None:
+                    frame = cap.decode(packet)
+                    if frame is None:
+                        continue
+                    if not self.detect_width:
+                        small = None
+                self._delivered = now
+                # only notify the GUI when it has consumed the last frame,
+                # otherwise the newer frame just replaces the older one
+                if self.slot.put((frame, self.scaled(frame), small, moving)):
+                    self.frameReady.emit()
+        finally:
+            cap.release()
+
+    def stop(self):
+        self._running = False
+        self.wait()
+
+    def takeFrame(self):
+        """(frame, display, small, moving) of the newest frame or Nones."""
+        item = self.slot.take()[1]
+        return item if item is not None else (None, None, None, False)
+
+    def stats(self):
+        stats = self.slot.stats()
+        stats.update(self.gate.stats())
+        stats['idle_skipped'] = self.idle_skipped
+        if self.info:
+            stats['capture'] = self.info
+        return stats
+
+
+class BackgroundLoader(QThread):
+    ''' Runs slow startup work (models, databases) off the GUI thread '''
+    loaded = pyqtSignal(str, object)
+    failed = pyqtSignal(str, str)
+
+    def __init__(self, parent=None):
+        super(BackgroundLoader, self).__init__(parent)
+        self.tasks = []
+
+    def add(self, name, fn):
+        self.tasks.append((name, fn))
+
+    def run(self):
+        for name, fn in self.tasks:
+            try:
+                result = fn()
+            except Exception as e:
+                self.failed.emit(name, str(e))
+            else:
+                self.loaded.emit(name, result)
+
+
+class VideoTile(object):
+    ''' One stream of the compositor: its grabber, image and layout '''
+    def __init__(self, grabber, detect=False, placeholder=None):
+        self.grabber = grabber
+        self.detect = detect
+        self.name = grabber.name
+        self.image = placeholder if placeholder is not None else QImage()
+        self.converter = FrameConverter(mode='bgr')
+        self.source_size = (self.image.width(), self.image.height())
+        self.cell = QRect()
+        self.target = QRectF()
+        self.bars = []
+
+    def layout(self, cell, fit_width=False):
+        """Place the stream in cell, keeping its aspect ratio."""
+        self.cell = cell
+        iw, ih = self.source_size
+        if iw <= 0 or ih <= 0:
+            self.target = QRectF()
+            self.bars = [cell]
+            return
+        if fit_width:
+            rect = fitWidthRect(iw, ih, cell.width(), cell.height())
+        else:
+            rect = fitRect(iw, ih, cell.width(), cell.height())
+        self.target = rect.translated(cell.x(), cell.y())
+        target = self.target.toAlignedRect().intersected(cell)
+        self.bars = [r for r in (
+            QRect(cell.left(), cell.top(), cell.width(),
+                  target.top() - cell.top()),
+            QRect(cell.left(), target.bottom() + 1, cell.width(),
+                  cell.bottom() - target.bottom()),
+            QRect(cell.left(), target.top(), target.left() - cell.left(),
+                  target.height()),
+            QRect(target.right() + 1, target.top(),
+                  cell.right() - target.right(), target.height()))
+            if r.width() > 0 and r.height() > 0]
+        size = self.target.toAlignedRect().size()
+        self.grabber.setDisplaySize((size.width(), size.height()))
+
+
+class GLVideoSurface(QOpenGLWidget):
+    ''' Video surface that scales frames on the GPU as a texture '''
+    initFailed = pyqtSignal()
+
+    vertex_shader = '''
+    attribute vec2 pos;
+    attribute vec2 uv;
+    varying vec2 v_uv;
+    void main() {
+        gl_Position = vec4(pos, 0.0, 1.0);
+        v_uv = uv;
+    }
+    '''
+    fragment_shader = '''
+    uniform sampler2D tex;
+    varying vec2 v_uv;
+    void main() {
+        gl_FragColor = texture2D(tex, v_uv);
+    }
+    '''
+    tex_coords = [QVector2D(0, 1), QVector2D(1, 1),
+                  QVector2D(0, 0), QVector2D(1, 0)]
+
+    def __init__(self, parent=None, fast_scaling=False):
+        super(GLVideoSurface, self).__init__(parent)
+        self.fast_scaling = fast_scaling
+        self.frame = None
+        self.gl = None
+        self.program = None
+        self.texture = None
+        self._tex_shape = None
+        self._dirty = False
+        self._transfer = QOpenGLPixelTransferOptions()
+        # rows of 3 channel frames are not 4 byte aligned in general
+        self._transfer.setAlignment(1)
+
+    def setFrame(self, frame):
+        self.frame = frame
+        self._dirty = True
+        self.update()
+
+    def setFastScaling(self, fast):
+        self.fast_scaling = fast
+        self._tex_shape = None
+        self._dirty = True
+        self.update()
+
+    def initializeGL(self):
+        try:
+            profile = QOpenGLVersionProfile()
+            profile.setVersion(2, 0)
+            self.gl = self.context().versionFunctions(profile)
+            if self.gl is None:
+                raise RuntimeError('OpenGL 2.0 functions unavailable')
+            self.gl.initializeOpenGLFunctions()
+            program = QOpenGLShaderProgram(self)
+            if not (program.addShaderFromSourceCode(
+                    QOpenGLShader.Vertex, self.vertex_shader) and
+                    program.addShaderFromSourceCode(
+                        QOpenGLShader.Fragment, self.fragment_shader) and
+                    program.link()):
+                raise RuntimeError(program.log())
+            self.program = program
+        except Exception as e:
+            logger.warning('init opengl surface failed: {}'.format(e))
+            self.gl = None
+            # let the owner swap surfaces once this call has returned
+            QTimer.singleShot(0, self.initFailed.emit)
+            return
+        ctx = self.context()
+        logger.info('opengl surface: {} {}'.format(
+            self.gl.glGetString(self.gl.GL_RENDERER),
+            'GLES' if ctx.isOpenGLES() else 'desktop GL'))
+
+    def uploadFrame(self):
+        frame = np.ascontiguousarray(self.frame)
+        h, w = frame.shape[:2]
+        channels = frame.shape[2] if frame.ndim == 3 else 1
+        if self._tex_shape != frame.shape:
+            if self.texture is not None:
+                self.texture.destroy()
+            self.texture = QOpenGLTexture(QOpenGLTexture.Target2D)
+            self.texture.setFormat(QOpenGLTexture.RGBA8_UNorm
+                                   if channels == 4 else
+                                   QOpenGLTexture.RGB8_UNorm)
+            self.texture.setSize(w, h)
+            self.texture.setMipLevels(1)
+            filt = (QOpenGLTexture.Nearest if self.fast_scaling
+                    else QOpenGLTexture.Linear)
+            self.texture.setMinMagFilters(filt, filt)
+            self.texture.setWrapMode(QOpenGLTexture.ClampToEdge)
+            self.texture.allocateStorage()
+            self._tex_shape = frame.shape
+        src = {1: QOpenGLTexture.Luminance, 3: QOpenGLTexture.BGR,
+               4: QOpenGLTexture.BGRA}[channels]
+        # storage exists already, so this is a glTexSubImage2D update
+        self.texture.setData(src, QOpenGLTexture.UInt8,
+                             frame.ctypes.data, self._transfer)
+        self._dirty = False
+
+    def paintGL(self):
+        gl = self.gl
+        if gl is None:
+            return
+        t0 = clock()
+        try:
+            self.drawFrame(gl)
+        finally:
+            metrics.record('paint', clock() - t0)
+
+    def drawFrame(self, gl):
+        gl.glClearColor(0, 0, 0, 1)
+        gl.glClear(gl.GL_COLOR_BUFFER_BIT)
+        if self.frame is None:
+            return
+        if self._dirty:
+            self.uploadFrame()
+        h, w = self.frame.shape[:2]
+        aw, ah = self.width(), self.height()
+        rect = fitWidthRect(w, h, aw, ah)
+        # window coordinates to normalized device coordinates
+        x0, x1 = -1.0, 1.0
+        y0 = 1.0 - 2.0 * rect.bottom() / ah
+        y1 = 1.0 - 2.0 * rect.top() / ah
+        vertices = [QVector2D(x0, y0), QVector2D(x1, y0),
+                    QVector2D(x0, y1), QVector2D(x1, y1)]
+        self.program.bind()
+        self.texture.bind(0)
+        self.program.setUniformValue('tex', 0)
+        pos = self.program.attributeLocation('pos')
+        uv = self.program.attributeLocation('uv')
+        self.program.enableAttributeArray(pos)
+        self.program.enableAttributeArray(uv)
+        self.program.setAttributeArray(pos, vertices)
+        self.program.setAttributeArray(uv, self.tex_coords)
+        gl.glDrawArrays(gl.GL_TRIANGLE_STRIP, 0, 4)
+        self.program.disableAttributeArray(pos)
+        self.program.disableAttributeArray(uv)
+        self.texture.release()
+        self.program.release()
+
+    def releaseGL(self):
+        if self.gl is None:
+            return
+        self.makeCurrent()
+        if self.texture is not None:
+            self.texture.destroy()
+            self.texture = None
+        self.doneCurrent()
+
+
 class MovableFrame(QFrame):
     def __init__(self, parent=None):
         super(MovableFrame, self).__init__(parent)
@@ -133,42 +577,26 @@ class MovableFrame(QFrame):
                 return
 
 
-class ImageWidget(QFrame):
-    def __init__(self, pixmap=None, parent=None, min_size=QSize(128, 128),
-                 margin=5):
-        super(ImageWidget, self).__init__(parent)
-        self.default_pixmap = QPixmap('images/head.png')
-        self.pixmap = pixmap
-        self.imageLabel = QLabel()
-        self.imageLabel.setMinimumSize(min_size)
-        self.imageLabel.setMaximumSize(QSize(128, 128))
-        layout = QHBoxLayout()
-        layout.setContentsMargins(margin, margin, margin, margin)
-        layout.addWidget(self.imageLabel)
-        self.setLayout(layout)
-        self.setStyleSheet('''
-        QLabel {
-        border-top: 2px solid rgb(255, 255, 255, 180);
-        border-left: 2px solid rgb(255, 255, 255, 180);
-        border-right: 2px solid rgb(255, 255, 255, 180);
-        border-bottom: 2px solid rgb(255, 255, 255, 180);
-        border-radius: 6px
-        }
-        ''')
-
-    def paintEvent(self, event):
-        self.updateImage()
-        super(ImageWidget, self).paintEvent(event)
-
-    def updateImage(self):
-        if self.pixmap:
-            show_map = self.pixmap.copy()
-        else:
-            show_map = self.default_pixmap.copy()
-        size = self.imageLabel.width() - 2
-        show_map = show_map.scaledToWidth(size,
-                                          Qt.SmoothTransformation)
-        self.imageLabel.setPixmap(show_map)
+class MetricsWidget(MovableFrame):
+    ''' HUD with the frame pipeline metrics, shown in debug mode '''
+    def __init__(self, parent=None, interval=1000):
+        super(MetricsWidget, self).__init__(parent)
+        self.ui = UI_MetricsWidget()
+        self.ui.setupUI(self)
+        self.interval = interval / 1000.0
+
+    def start_timer(self):
+        logger.debug('{}: start timer'.format(self.__class__))
+        frameClock().subscribe('hud', self.updateMetrics, self.interval,
+                               changed=self.isVisible)
+
+    def stop_timer(self):
+        logger.debug('{}: stop timer'.format(self.__class__))
+        frameClock().unsubscribe('hud')
+
+    def updateMetrics(self):
+        self.ui.label.setText(metrics.formatText())
+        self.adjustSize()
 
 
 class NoticeWidget(MovableFrame):
@@ -184,22 +612,26 @@ class DatetimeWidget(MovableFrame):
         self.ui = UI_DatetimeWidget()
         self.ui.setupUI(self)
 
-        self.timer = QTimer()
-        self.timer.setInterval(200)
+        self._shown = None
         self.start_timer()
-        self.timer.timeout.connect(self.updateDatetime)
-
 
     def start_timer(self):
         logger.debug('{}: start timer'.format(self.__class__))
-        self.timer.start()
+        self.updateDatetime()
+        # the clock shows seconds, tick on the wall clock second
+        frameClock().subscribe('datetime', self.updateDatetime, 1.0,
+                               align=True, changed=self.secondChanged)
 
     def stop_timer(self):
         logger.debug('{}: stop timer'.format(self.__class__))
-        self.timer.stop()
+        frameClock().unsubscribe('datetime')
+
+    def secondChanged(self):
+        return int(time.time()) != self._shown
 
     def updateDatetime(self):
-        now = timezone.localize(datetime.now())
+        self._shown = int(time.time())
+        now = timezone.localize(datetime.fromtimestamp(self._shown))
         time_now = '{:02d}:{:02d}:{:02d}'.format(
             now.hour, now.minute, now.second)
         date_now = '{}年{}月{}日'.format(now.year, now.month, now.day)
@@ -207,61 +639,154 @@ class DatetimeWidget(MovableFrame):
         self.ui.dateLabel.setText(date_now)
 
 
+class VisitTableModel(QAbstractTableModel):
+    ''' Latest visits, newest first, in a bounded ring buffer
+
+    A sighting of a name that is already listed within `merge_window`
+    seconds refreshes its time and moves its row to the top, anything
+    else inserts one row at the top and drops the oldest row when the
+    buffer is full.
+    '''
+    headers = ['姓名', '访问时间']
+    row_colors = [QColor(193, 108, 91, 200), QColor(255, 102, 51, 200)]
+
+    def __init__(self, max_rows=10, merge_window=60, parent=None):
+        super(VisitTableModel, self).__init__(parent)
+        self.max_rows = max_rows
+        self.merge_window = merge_window
+        self._records = deque(maxlen=max_rows)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._records)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.headers)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.headers[section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self._records):
+            return None
+        if role == Qt.DisplayRole:
+            _, name, stamp = self._records[index.row()]
+            if index.column() == 0:
+                return name
+            return datetime.fromtimestamp(stamp, timezone).strftime(
+                '%H:%M:%S')
+        if role == Qt.TextAlignmentRole:
+            return Qt.AlignCenter
+        if role == Qt.BackgroundRole:
+            return self.row_colors[index.row() % 2]
+        return None
+
+    def records(self):
+        """(name, stamp) of the rows, newest first."""
+        return [(name, stamp) for _, name, stamp in self._records]
+
+    def addRecord(self, name, stamp, person_id=None):
+        """Add a row, or refresh the time of person_id's row (by default
+        keyed by name) if it is within the merge window."""
+        key = person_id if person_id is not None else name
+        for row, (other, _, other_stamp) in enumerate(self._records):
+            if other == key and stamp - other_stamp < self.merge_window:
+                if row:
+                    self.beginMoveRows(QModelIndex(), row, row,
+                                       QModelIndex(), 0)
+                    del self._records[row]
+                    self._records.appendleft((key, name, stamp))
+                    self.endMoveRows()
+                else:
+                    self._records[0] = (key, name, stamp)
+                # the time and the row stripes above the old row changed
+                self.dataChanged.emit(self.index(0, 0), self.index(row, 1))
+                return False
+        if len(self._records) == self.max_rows:
+            last = self.max_rows - 1
+            self.beginRemoveRows(QModelIndex(), last, last)
+            self._records.pop()
+            self.endRemoveRows()
+        self.beginInsertRows(QModelIndex(), 0, 0)
+        self._records.appendleft((key, name, stamp))
+        self.endInsertRows()
+        return True
+
+
 class TableWidget(MovableFrame):
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, visit_log=None):
         super(TableWidget, self).__init__(parent)
         self.ui = UI_TableWidget()
         self.ui.setupUI(self)
 
-        self.timer = QTimer()
-        self.timer.setInterval(1000)
+        self.model = VisitTableModel(max_rows=10, parent=self)
+        self.ui.table.setModel(self.model)
+        self.visit_log = None
+        self._visitors = set()
+        self._day = None
+        self.setVisitLog(visit_log)
         self.start_timer()
-        self.timer.timeout.connect(self.updateState)
 
     def start_timer(self):
         logger.debug('{}: start timer'.format(self.__class__))
-        self.timer.start()
+        # the count starts over at midnight, check on every wall minute
+        frameClock().subscribe('visitors', self.updateAccessNum, 60.0,
+                               align=True)
 
     def stop_timer(self):
         logger.debug('{}: stop timer'.format(self.__class__))
-        self.timer.stop()
+        frameClock().unsubscribe('visitors')
+
+    def setVisitLog(self, visit_log):
+        self.visit_log = visit_log
+        if visit_log is not None:
+            for stamp, person_id, name in reversed(visit_log.latest()):
+                self.model.addRecord(name, stamp, person_id)
+        self.updateAccessNum()
 
     def getAccessNum(self):
-        # TODO: add update Access fun
-        num = 2
-        return num
+        if self.visit_log is not None:
+            return self.visit_log.todayCount()
+        if datetime.fromtimestamp(time.time(), timezone).date() != self._day:
+            return 0
+        return len(self._visitors)
 
     def updateAccessNum(self):
         num = self.getAccessNum()
         if num is not None:
             self.ui.label.setText('今日到访人数： {}'.format(num))
 
-    def getTableData(self):
-        # TODO: add update table data fun
-        data = [['test1', '00:00:00'], ['test2', '00:00:00']]
-        return data
-
-    def updateTable(self):
-        table_data = self.getTableData()
-        if table_data is not None:
-            get_len = len(table_data)
-            for i in range(self.ui.table.rowCount()):
-                name_item = self.ui.table.item(i, 0)
-                time_item = self.ui.table.item(i, 1)
-                if i < get_len:
-                    name_item.setText(table_data[i][0])
-                    time_item.setText(table_data[i][1])
-                else:
-                    name_item.setText('')
-                    time_item.setText('')
-
-    def updateState(self):
-        self.updateAccessNum()
-        self.updateTable()
+    def addVisit(self, name, stamp=None, person_id=None):
+        if stamp is None:
+            stamp = time.time()
+        if person_id is None:
+            # untracked faces have nothing better than their text
+            person_id = name
+        # repeated sightings within the merge window are not new visits
+        if not self.model.addRecord(name, stamp, person_id):
+            return
+        if self.visit_log is not None:
+            first = self.visit_log.record(person_id, name, stamp)
+        else:
+            day = datetime.fromtimestamp(stamp, timezone).date()
+            if day != self._day:
+                self._day = day
+                self._visitors.clear()
+            first = person_id not in self._visitors
+            self._visitors.add(person_id)
+        if first:
+            self.updateAccessNum()
+
+    def onDetection(self, faces):
+        """Slot for DetectionPipeline.detected."""
+        stamp = time.time()
+        for face in faces:
+            self.addVisit(face['text'], stamp, face.get('person_id'))
 
 
 class WelcomeWidget(MovableFrame):
-    def __init__(self, parent=None, width=400, height=300):
+    def __init__(self, parent=None, width=400, height=300, visit_log=None):
         super(WelcomeWidget, self).__init__(parent)
         self.ui = UI_WelcomeWidget()
         self.ui.setupUI(self)
@@ -271,52 +796,60 @@ class WelcomeWidget(MovableFrame):
         self.animation.setStartValue(QSize(20, 20))
         self.animation.setEndValue(QSize(self.ui.default_width,
                                          self.ui.default_height))
+        self.visit_log = visit_log
         self.detect_activate = True
-        self.detect_queue = queue.Queue(10)
-
-        self.timer = QTimer()
-        self.timer.setInterval(1000)
-        self.start_timer()
-        self.timer.timeout.connect(self.updateState)
+        self.scheduler = GreetingScheduler()
         self.animation.finished.connect(self.after_animation)
 
-    def start_timer(self):
-        logger.debug('{}: start timer'.format(self.__class__))
-        self.timer.start()
-
-    def stop_timer(self):
-        logger.debug('{}: stop timer'.format(self.__class__))
-        self.timer.stop()
-
-    def updateDetection(self):
-         # TODO: modify update detection fun
-        if self.detect_activate and not self.detect_queue.full():
-            self.detect_queue.put(['test 20岁', None])
+    def onDetection(self, faces):
+        """Slot for DetectionPipeline.detected."""
+        for face in faces:
+            person_id = face.get('person_id') or face['text']
+            first_today = (self.visit_log is not None and
+                           not self.visit_log.seenToday(person_id))
+            image = face.get('thumb')
+            if image is None:
+                image = face.get('crop')
+            self.scheduler.offer(person_id, face['text'], image,
+                                 vip=face.get('vip', False),
+                                 first_today=first_today)
+        self.updateState()
 
     def updateState(self):
-        self.updateDetection()
-        logger.debug('detect_activate: {}'.format(self.detect_activate))
-        if not self.detect_queue.empty():
-            self.detect_activate = False
-            detect_data = self.detect_queue.get()
-            logger.debug('detect_data: {}'.format(detect_data))
-            self.ui.infoLabel.setText(detect_data[0])
-            if detect_data[1] is None:
-                self.ui.image.pixmap = None
-            else:
-                self.ui.image.pixmap = QPixmap(detect_data[1])
-            self.show()
-            self.animation.start()
+        if not self.detect_activate:
+            return
+        entry = self.scheduler.pop()
+        if entry is None:
+            return
+        self.detect_activate = False
+        logger.debug('greet {} ({} pending)'.format(
+            entry['text'], len(self.scheduler)))
+        self.ui.infoLabel.setText(entry['text'])
+        image = entry['image']
+        if image is None:
+            self.ui.image.pixmap = None
+        elif isinstance(image, np.ndarray):
+            self.ui.image.pixmap = QPixmap.fromImage(
+                np2qimage(image, mode='bgr'))
+        else:
+            self.ui.image.pixmap = QPixmap(image)
+        self.show()
+        self.animation.start()
 
     def after_animation(self):
-        QTimer.singleShot(1500, self.after_action)
+        frameClock().callLater(self.scheduler.holdTime(), self.after_action)
 
     def after_action(self):
         self.hide()
-        QTimer.singleShot(1000, self.after_hide)
+        frameClock().callLater(self.scheduler.cooldownTime(),
+                               self.after_hide)
 
     def after_hide(self):
         self.detect_activate = True
+        self.updateState()
+
+    def stats(self):
+        return self.scheduler.stats()
 
 
 class WindowMixin(object):
@@ -338,65 +871,417 @@ class WindowMixin(object):
 
 
 class MainWindow(QMainWindow, WindowMixin):
-    def __init__(self, parent=None, debug=False):
+    def __init__(self, parent=None, debug=False, fast_scaling=False,
+                 renderer='raster', detector='haar', detect_every=5,
+                 visit_log='visits.db', streams=None, layout='grid',
+                 metrics_file=None, autostart=True,
+                 thumb_cache='cache/thumbs', recognizer='none',
+                 gallery='gallery', photos=None, recognize_batch=8,
+                 recognize_delay=0.02, recognize_workers=1,
+                 recognize_pool='thread',
+                 track=True, track_flow=False, detect_pool='thread'):
         QWidget.__init__(self, parent)
         self.setMinimumSize(800, 600)
         self.resize(800, 600)
+        # every pixel is painted by paintEvent, skip the background erase
+        self.setAttribute(Qt.WA_OpaquePaintEvent)
         self._painter = QPainter()
-        self.pixmap = QPixmap('test.jpg')
+        self.fast_scaling = fast_scaling
+        self.layout_mode = layout
+        self._blank_rects = []
         self.setWindowIcon(QIcon('images/main.png'))
+        # every periodic update of the window runs off this one timer
+        self.clock = frameClock()
 
         self.notice = NoticeWidget(self)
         self.datetime = DatetimeWidget(self)
+        self.visit_log = None
         self.table = TableWidget(self)
         self.welcome = WelcomeWidget(self)
         self.welcome.close()
+        self.welcome.animation.valueChanged.connect(self.centerWelcome)
+
+        if streams is None:
+            layout, streams = loadStreams()
+        placeholder = QImage('test.jpg')
+        self.tiles = []
+        for stream in streams:
+            grabber = FrameGrabber(stream['source'], stream['width'],
+                                   stream['height'], parent=self,
+                                   loop=stream.get('loop', True),
+                                   name=stream.get('name'),
+                                   fourcc=stream.get('fourcc'),
+                                   fps=stream.get('fps'),
+                                   buffer_size=stream.get('buffer_size'))
+            grabber.fast_scaling = fast_scaling
+            tile = VideoTile(grabber, stream.get('detect', False),
+                             placeholder)
+            # frames of all streams are taken in one clock tick
+            grabber.frameReady.connect(self.clock.requestFrame)
+            grabber.idleChanged.connect(self.onIdleChanged)
+            self.tiles.append(tile)
+        self.grabber = self.tiles[0].grabber
+
+        self.surface = None
+        if renderer == 'opengl' and len(self.tiles) > 1:
+            logger.warning('opengl renderer shows one stream, use raster')
+        elif renderer == 'opengl':
+            self.useOpenGL()
+
+        # models and databases load after the first paint, off the GUI
+        # thread, so the window and the placeholder show at once
+        self.detection = None
+        self.recognition = None
+        self.thumbnails = None
+        # one greeting per tracked person instead of one per detection
+        self.tracking = None
+        if track:
+            self.tracking = TrackingStage(
+                partial(FaceTracker, flow=track_flow), parent=self)
+        # autostart=False leaves capture and loading to startDeferred()
+        self.autostart = autostart
+        self._started = False
+        self._callbacks = {}
+        self.loader = BackgroundLoader(self)
+        self.loader.loaded.connect(self.onLoaded)
+        self.loader.failed.connect(self.onLoadFailed)
+        if visit_log:
+            self.loadInBackground(
+                'visit_log', partial(VisitLog, visit_log, tz=timezone),
+                self.setVisitLog)
+        if detector in detectors:
+            self.loadInBackground(
+                'thumbnails', partial(ThumbnailCache, thumb_cache),
+                self.setThumbnails)
+            factory = detectors[detector]
+            self.loadInBackground(
+                'detector', factory,
+                lambda det: self.setDetector(factory, detect_every,
+                                             detect_pool))
+        if recognizer in embedders:
+            if photos is None and gallery:
+                photos = gallery + '_photos'
+            options = dict(max_batch=recognize_batch, photo_dir=photos,
+                           max_delay=recognize_delay,
+                           workers=recognize_workers, pool=recognize_pool)
+            self.loadInBackground(
+                'recognizer',
+                partial(self.loadRecognizer, embedders[recognizer], gallery),
+                lambda result: self.setRecognizer(*result, **options))
         self.notice.move(25, 200)
         self.datetime.move(580, 235)
         self.table.move(260, 100)
-        self.videoTimer = QTimer()
-        self.videoTimer.setInterval(40)
+        self.grabber.opened.connect(self.onCameraOpened)
+
+        self.updateLayoutCache()
+
+        self.clock.subscribe('video', self.updateFrames)
+        if debug:
+            self.clock.subscribe('stats', self.logStats, 10.0)
+
+        self.convert_hist = metrics.histogram('convert')
+        self.paint_hist = metrics.histogram('paint')
+        metrics.setCounter('dropped', lambda: sum(
+            tile.grabber.stats()['dropped'] for tile in self.tiles))
+        metrics.setCounter('detect_dropped', lambda: (
+            self.detection.dropped if self.detection is not None else 0))
+        self.hud = MetricsWidget(self)
+        self.hud.move(25, 420)
+        if debug:
+            self.hud.start_timer()
+        else:
+            self.hud.hide()
+        self.metrics_file = metrics_file
+        if metrics_file:
+            self.clock.subscribe('metrics', self.dumpMetrics, 5.0)
+
+        # with the lobby empty on every stream the housekeeping
+        # subscribers slow down too
+        self.idle_slowdown = 5
+        self._rates = {'hud': self.hud.interval, 'metrics': 5.0,
+                       'stats': 10.0}
+        self.power = PowerMeter()
+        self.motion_skipped = 0
+
+    def loadInBackground(self, name, fn, callback):
+        """Run fn() on the loader thread, then callback(result) here."""
+        self._callbacks[name] = callback
+        self.loader.add(name, fn)
+
+    def onLoaded(self, name, result):
+        startup.mark('loaded ' + name)
+        self._callbacks.pop(name)(result)
+        if not self._callbacks:
+            startup.mark('background loaded')
+
+    def onLoadFailed(self, name, error):
+        if name == 'detector':
+            logger.error('load detector failed, face detection is off: '
+                         '{}'.format(error))
+        else:
+            logger.warning('load {} failed: {}'.format(name, error))
+        self._callbacks.pop(name)
+        if not self._callbacks:
+            startup.mark('background loaded')
+
+    def setVisitLog(self, visit_log):
+        self.visit_log = visit_log
+        self.table.setVisitLog(visit_log)
+        self.welcome.visit_log = visit_log
+
+    def setThumbnails(self, thumbnails):
+        self.thumbnails = thumbnails
+        if self.detection is not None:
+            self.detection.thumbnails = thumbnails
+        if self.recognition is not None:
+            self.recognition.thumbnails = thumbnails
+
+    def setDetector(self, factory, detect_every, pool='thread'):
+        trackers = self.tracking.tracker if self.tracking else None
+        self.detection = DetectionPipeline(factory, every=detect_every,
+                                           thumbnails=self.thumbnails,
+                                           trackers=trackers, pool=pool,
+                                           parent=self)
+        for tile in self.tiles:
+            if tile.detect:
+                tile.grabber.detect_width = self.detection.detect_width
+        self.connectPipelines()
+
+    @staticmethod
+    def loadRecognizer(factory, gallery):
+        """Build one embedder to fail early, then open the gallery."""
+        embedder = factory()
+        dim = getattr(embedder, 'dim', 128)
+        return factory, FaceGallery.open(gallery, dim) if gallery else None
+
+    def setRecognizer(self, factory, gallery, **options):
+        self.recognition = RecognitionPipeline(factory, gallery,
+                                               thumbnails=self.thumbnails,
+                                               parent=self, **options)
+        self.connectPipelines()
+
+    def connectPipelines(self):
+        """detection -> [tracking ->] [recognition ->] welcome and table."""
+        if self.detection is None:
+            return
+        disconnectAll(self.detection.detected)
+        if self.recognition is not None:
+            disconnectAll(self.recognition.recognized)
+        if self.tracking is not None:
+            disconnectAll(self.tracking.arrived)
+        source = self.detection.detected
+        if self.tracking is not None:
+            # the tracker only sends the faces it needs verified
+            source.connect(self.tracking.onDetected, Qt.DirectConnection)
+            if self.recognition is not None:
+                self.tracking.recognize = self.recognition.submit
+                self.recognition.recognized.connect(
+                    self.tracking.onRecognized, Qt.DirectConnection)
+            source = self.tracking.arrived
+        elif self.recognition is not None:
+            # submit() is thread safe, batch straight from the workers
+            source.connect(self.recognition.submit, Qt.DirectConnection)
+            source = self.recognition.recognized
+        source.connect(self.welcome.onDetection)
+        source.connect(self.table.onDetection)
+
+    def startDeferred(self):
+        if self._started:
+            return
+        self._started = True
         self.start_timer()
-
-        self.videoTimer.timeout.connect(self.updateCamera)
+        if self._callbacks:
+            self.loader.start()
+        else:
+            startup.mark('background loaded')
+
+    def onCameraOpened(self, ok):
+        startup.mark('camera opened' if ok else 'camera failed')
+        if not ok:
+            startup.mark('first frame')
+        metrics.tick('display')
+
+    def onIdleChanged(self, *args):
+        """Idle mode once every stream is idle, active on any motion."""
+        idle = all(tile.grabber.gate.idle for tile in self.tiles)
+        if idle == self.power.idle:
+            return
+        logger.info('enter idle mode' if idle else 'leave idle mode')
+        self.power.setIdle(idle)
+        factor = self.idle_slowdown if idle else 1
+        for name, every in self._rates.items():
+            self.clock.setRate(name, every * factor)
 
     def start_timer(self):
-        logger.debug('{}: start timer'.format(self.__class__))
-        self.videoTimer.start()
+        logger.debug('{}: start grabbers'.format(self.__class__))
+        for tile in self.tiles:
+            tile.grabber.start()
 
     def stop_timer(self):
-        logger.debug('{}: stop timer'.format(self.__class__))
-        self.videoTimer.stop()
-
-    def updateCamera(self):
-        b, frame = videoCapture.read()
-        if frame is not None:
-            qImg = np2qimage(frame, mode='bgr')
-            self.pixmap = QPixmap(qImg)
+        logger.debug('{}: stop grabbers'.format(self.__class__))
+        for tile in self.tiles:
+            tile.grabber.stop()
+
+    def stats(self):
+        stats = {'streams': dict((tile.name, tile.grabber.stats())
+                                 for tile in self.tiles)}
+        if self.detection is not None:
+            stats['detection'] = self.detection.stats()
+        if self.recognition is not None:
+            stats['recognition'] = self.recognition.stats()
+        if self.tracking is not None:
+            stats['tracking'] = self.tracking.stats()
+        stats['power'] = self.power.stats()
+        stats['scheduler'] = self.clock.stats()
+        stats['power']['detect_skipped'] = self.motion_skipped
+        if self.thumbnails is not None:
+            stats['thumbnails'] = self.thumbnails.stats()
+        stats['greeting'] = self.welcome.stats()
+        return stats
+
+    def dumpMetrics(self):
+        try:
+            metrics.dump(self.metrics_file)
+        except (IOError, OSError) as e:
+            logger.warning('dump metrics failed: {}'.format(e))
+
+    def logStats(self):
+        logger.debug('camera stats: {}'.format(self.stats()))
+
+    def useOpenGL(self):
+        if not openglAvailable():
+            logger.warning('no opengl context, use raster renderer')
+            return
+        self.surface = GLVideoSurface(self, fast_scaling=self.fast_scaling)
+        self.surface.initFailed.connect(self.useRaster)
+        self.surface.setGeometry(self.rect())
+        # keep the floating frames composited on top of the video
+        self.surface.lower()
+        self.surface.show()
+        # the GPU scales, hand over full frames
+        self.grabber.setDisplaySize(None)
+        logger.info('use opengl renderer')
+
+    def useRaster(self):
+        if self.surface is None:
+            return
+        logger.warning('fall back to raster renderer')
+        self.surface.hide()
+        self.surface.deleteLater()
+        self.surface = None
+        self.updateLayoutCache()
+        self.update()
+
+    def closeEvent(self, event):
+        self.stop_timer()
+        for name in ('video', 'stats', 'metrics'):
+            self.clock.unsubscribe(name)
+        self.hud.stop_timer()
+        self.datetime.stop_timer()
+        self.table.stop_timer()
+        self.loader.wait()
+        if self.detection is not None:
+            self.detection.shutdown()
+        if self.recognition is not None:
+            self.recognition.shutdown()
+        if self.surface is not None:
+            self.surface.releaseGL()
+        if self.visit_log is not None:
+            self.visit_log.close()
+        self.logStats()
+        if self.metrics_file:
+            self.dumpMetrics()
+        super(MainWindow, self).closeEvent(event)
+
+    def updateFrames(self):
+        for tile in self.tiles:
+            self.updateCamera(tile)
+
+    def updateCamera(self, tile):
+        frame, display, small, moving = tile.grabber.takeFrame()
+        if frame is None:
+            return
+        startup.mark('first frame')
+        metrics.tick('display')
+        if tile.detect and self.detection is not None:
+            if moving:
+                self.detection.submit(frame, small, tile.grabber.name)
+            else:
+                # same scene as before, the tracker already knows it
+                self.motion_skipped += 1
+        if self.surface is not None:
+            # the texture upload takes the BGR frame as it is
+            self.surface.setFrame(frame)
+            return
+        # draw the QImage directly, a QPixmap would be one more copy
+        t0 = clock()
+        tile.image = tile.converter(display)
+        self.convert_hist.record(clock() - t0)
+        h, w = frame.shape[:2]
+        if (w, h) != tile.source_size:
+            tile.source_size = (w, h)
+            self.updateLayoutCache()
             self.update()
+        else:
+            # the letterbox bars did not change, repaint the video only
+            self.update(tile.target.toAlignedRect())
+
+    def setFastScaling(self, fast):
+        self.fast_scaling = fast
+        for tile in self.tiles:
+            tile.grabber.fast_scaling = fast
+        if self.surface is not None:
+            self.surface.setFastScaling(fast)
+        self.update()
+
+    def updateLayoutCache(self):
+        """Recompute tile cells, video rects and letterbox bars."""
+        if self.surface is not None:
+            return
+        cells = tileCells(len(self.tiles), self.layout_mode,
+                          self.width(), self.height())
+        single = len(self.tiles) == 1
+        for tile, cell in zip(self.tiles, cells):
+            tile.layout(cell, fit_width=single)
+        self._blank_rects = cells[len(self.tiles):]
+
+    def showEvent(self, event):
+        super(MainWindow, self).showEvent(event)
+        # in case the video surface covers the window and it never paints
+        if self.autostart:
+            QTimer.singleShot(100, self.startDeferred)
+
+    def resizeEvent(self, event):
+        if self.surface is not None:
+            self.surface.setGeometry(self.rect())
+        self.updateLayoutCache()
+        self.centerWelcome()
+        super(MainWindow, self).resizeEvent(event)
+
+    def centerWelcome(self, *args):
+        off_set = self.offsetToCenter(
+            self.welcome.width(), self.welcome.height(), scale=False)
+        self.welcome.move(int(off_set.x()), int(off_set.y()))
 
     def paintEvent(self, ev):
-        if self.isEnabled():
+        if not self._started and self.autostart:
+            startup.mark('first paint')
+            QTimer.singleShot(0, self.startDeferred)
+        if self.isEnabled() and self.surface is None:
+            t0 = clock()
             p = self._painter
             p.begin(self)
-            p.setRenderHint(QPainter.Antialiasing)
-            p.setRenderHint(QPainter.HighQualityAntialiasing)
-            p.setRenderHint(QPainter.SmoothPixmapTransform)
-
-            bg_pixmap = QPixmap(self.width(), self.height())
-            bg_pixmap.fill(Qt.black)
-            p.drawPixmap(0, 0, bg_pixmap)
-            scale = self.width() / self.pixmap.width()
-            # print(scale)
-            p.scale(scale, scale)
-            p.translate(self.offsetToCenter(
-                self.pixmap.width(), self.pixmap.height()))
-            p.drawPixmap(0, 0, self.pixmap)
+            p.setRenderHint(QPainter.SmoothPixmapTransform,
+                            not self.fast_scaling)
+            for rect in self._blank_rects:
+                p.fillRect(rect, Qt.black)
+            for tile in self.tiles:
+                for rect in tile.bars:
+                    p.fillRect(rect, Qt.black)
+                if not tile.target.isEmpty():
+                    p.drawImage(tile.target, tile.image)
             p.end()
-
-            off_set = self.offsetToCenter(
-                self.welcome.width(), self.welcome.height(), scale=False)
-            self.welcome.move(int(off_set.x()), int(off_set.y()))
+            self.paint_hist.record(clock() - t0)
 
     def mousePressEvent(self, event):
         focused_widget = QApplication.focusWidget()